@@ -1,110 +1,227 @@
 const core = require('@actions/core');
 const github = require('@actions/github');
 const AdmZip = require('adm-zip');
+const fs = require('fs');
 
 let verbose = false;
 let log = null;
 let debug = (msg) => { if (verbose) { log(msg); } }
 
-async function analyze(name, count, token, owner, repo, branch) {
+// the Monitor action uploads the permissions of every job as `<job>-permissions-<random hex>`
+const artifactPattern = /^([^ "]+)-permissions-[a-z0-9]{32}$/;
+
+// runs fn for every item with at most limit of them at the same time
+async function mapConcurrently(items, limit, fn) {
+  const results = new Array(items.length);
+  let next = 0;
+  async function worker() {
+    while (next < items.length) {
+      const i = next++;
+      results[i] = await fn(items[i]);
+    }
+  }
+  await Promise.all(Array.from({ length: Math.min(limit, items.length) }, worker));
+  return results;
+}
+
+// the names of the permission artifacts uploaded by the successful jobs, as printed in their logs,
+// and whether they were found in the logs of all of them
+async function successfulArtifactNames(octokit, owner, repo, jobs, concurrency) {
+  const names = new Set();
+  let complete = true;
+  await mapConcurrently(jobs.filter(job => job.conclusion === 'success'), concurrency, async job => {
+    debug(`${job.name} ${job.id} was successful...`);
+    debug(`Downloading logs for job id ${job.id}...`);
+
+    let workflowRunLog = null;
+    try {
+      workflowRunLog = await octokit.rest.actions.downloadJobLogsForWorkflowRun({
+        owner: owner,
+        repo: repo,
+        job_id: job.id,
+      });
+    } catch (e) {
+      debug(`Logs for the job ${job.id} are not available.`);
+      complete = false;
+      return;
+    }
+
+    const logUploadMatch = workflowRunLog.data.match(/([^ "]+-permissions-[a-z0-9]{32})/m);
+    if (!logUploadMatch) {
+      debug(`Cannot find the magic string in the logs of the job ${job.id}. Skipping.`);
+      complete = false;
+      return;
+    }
+    names.add(logUploadMatch[1]);
+  });
+  return [names, complete];
+}
+
+// the last execution of every job, a re-run lists the jobs of the earlier attempts too
+function latestJobs(jobs) {
+  const latest = new Map();
+  for (const job of jobs) {
+    const seen = latest.get(job.name);
+    if (!seen || (job.run_attempt || 1) > (seen.run_attempt || 1))
+      latest.set(job.name, job);
+  }
+  return [...latest.values()];
+}
+
+// the permission artifacts uploaded by the successful jobs of the run and whether all of them were found
+async function runArtifacts(octokit, owner, repo, run, concurrency) {
+  debug(`Analyzing run ${run.id}...`);
+
+  const artifacts = (await octokit.paginate(octokit.rest.actions.listWorkflowRunArtifacts, {
+    owner: owner,
+    repo: repo,
+    run_id: run.id,
+    per_page: 100,
+  })).filter(artifact => !artifact.expired && artifactPattern.test(artifact.name));
+
+  debug(`${artifacts.length} permission artifacts...`);
+  if (artifacts.length === 0)
+    return [[], false];
+
+  const jobs = latestJobs(await octokit.paginate(octokit.rest.actions.listJobsForWorkflowRun, {
+    owner: owner,
+    repo: repo,
+    run_id: run.id,
+    filter: 'all',
+    per_page: 100,
+  }));
+
+  debug(`Found ${jobs.length} jobs.`)
+
+  if ((run.run_attempt || 1) === 1 && jobs.every(job => job.conclusion === 'success' || job.conclusion === 'skipped'))
+    return [artifacts, true];
+
+  // The Monitor uploads the artifact even if the job fails (with continue-on-error the run still succeeds),
+  // and the artifacts of all the attempts of a re-run are listed together, but the artifact names don't tell
+  // which job or attempt they belong to. Fall back to finding them in the logs of the last executions of the successful jobs.
+  debug(`Not all jobs of the run ${run.id} were successful or it was re-run, matching the artifacts by the job logs.`);
+  const [names, complete] = await successfulArtifactNames(octokit, owner, repo, jobs, concurrency);
+  return [artifacts.filter(artifact => names.has(artifact.name)), complete];
+}
+
+async function downloadPermissions(octokit, owner, repo, artifact) {
+  debug(`Downloading artifact id ${artifact.id}`);
+  const download = await octokit.rest.actions.downloadArtifact({
+    owner: owner,
+    repo: repo,
+    artifact_id: artifact.id,
+    archive_format: 'zip',
+  });
+
+  const zip = new AdmZip(Buffer.from(download.data));
+  const zipEntries = zip.getEntries();
+  const extracted = zip.readAsText(zipEntries[0]);
+  return JSON.parse(extracted);
+}
+
+// The permissions already extracted from the past runs:
+// `owner/repo/workflow@branch` -> run id -> artifact id -> the job and its permissions.
+// A completed run never changes, so it is analyzed once and only the new runs are fetched later.
+function loadCache(cachePath) {
+  if (!cachePath || !fs.existsSync(cachePath))
+    return { workflows: {} };
+
+  try {
+    const cache = JSON.parse(fs.readFileSync(cachePath, 'utf8'));
+    return cache.workflows ? cache : { workflows: {} };
+  } catch (e) {
+    debug(`The cache ${cachePath} can't be read, starting from scratch: ${e.message}`);
+    return { workflows: {} };
+  }
+}
+
+function saveCache(cachePath, cache) {
+  if (!cachePath)
+    return;
+
+  // write to a temporary file first, an interrupted run doesn't leave a partially written cache behind
+  fs.writeFileSync(`${cachePath}.tmp`, JSON.stringify(cache));
+  fs.renameSync(`${cachePath}.tmp`, cachePath);
+}
+
+async function analyze(name, count, token, owner, repo, branch, cachePath, concurrency = 8) {
   log(`Analyzing ${name} for the last ${count} successful runs.\n`);
   const octokit = github.getOctokit(token)
+  count = parseInt(count);
 
-  const runs = await octokit.rest.actions.listWorkflowRuns({
+  // the most recent runs first, at most 100 of them per page
+  const runs = [];
+  for await (const response of octokit.paginate.iterator(octokit.rest.actions.listWorkflowRuns, {
     owner: owner,
     repo: repo,
     workflow_id: name,
     branch: branch,
     status: 'success',
-    per_page: count,
-    page: 1,
-  });
+    per_page: Math.min(count, 100),
+  })) {
+    runs.push(...response.data);
+    if (runs.length >= count)
+      break;
+  }
+  runs.splice(count);
+
+  const cache = loadCache(cachePath);
+  const workflow = `${owner}/${repo}/${name}@${branch}`;
+  const cached = cache.workflows[workflow] || {};
+  const newRuns = runs.filter(run => !cached[run.id]);
+  debug(`${runs.length - newRuns.length} runs are already in the cache.`);
+
+  // only the small permission artifacts are downloaded, several runs and artifacts at the same time
+  const found = await mapConcurrently(newRuns, concurrency, run => runArtifacts(octokit, owner, repo, run, concurrency));
+  const artifacts = newRuns.flatMap((run, i) => found[i][0].map(artifact => [run, artifact]));
+  const downloads = await mapConcurrently(artifacts, concurrency, ([, artifact]) => downloadPermissions(octokit, owner, repo, artifact));
+
+  const results = {};
+  for (const run of runs) {
+    results[run.id] = cached[run.id] || {};
+  }
+  for (const [i, [run, artifact]] of artifacts.entries()) {
+    results[run.id][artifact.id] = {
+      job: artifact.name.split('-').slice(0, -2).join('-'),
+      permissions: downloads[i],
+    };
+  }
+
+  // Only the last runs of the workflow on the branch are kept. The runs without any artifact found or with some
+  // of the job logs not available are not cached, their artifacts may not be uploaded yet or the logs may come later.
+  cache.workflows[workflow] = {};
+  for (const run of runs) {
+    const i = newRuns.indexOf(run);
+    if (i === -1 || (found[i][1] && Object.keys(results[run.id]).length > 0))
+      cache.workflows[workflow][run.id] = results[run.id];
+  }
+  saveCache(cachePath, cache);
 
   let permissions = new Map();
   let wasUnknown = false;
 
-  for (const run of runs.data.workflow_runs) {
-    debug(`Analyzing run ${run.id}...`);
-
-    const jobs = await octokit.rest.actions.listJobsForWorkflowRun({
-      owner: owner,
-      repo: repo,
-      run_id: run.id,
-    });
-
-    debug(`Found ${jobs.data.jobs.length} jobs.`)
+  const jobs = runs.flatMap(run => Object.values(results[run.id]));
+  for (const job of jobs) {
+    const jobName = job.job;
+    const jobPermissions = new Map(Object.entries(job.permissions));
 
-    const artifacts = await octokit.rest.actions.listWorkflowRunArtifacts({
-      owner: owner,
-      repo: repo,
-      run_id: run.id,
-    });
-
-    debug(`${artifacts.data.artifacts.length} artifacts...`)
-
-    for (const job of jobs.data.jobs) {
-      if (job.conclusion !== 'success')
-        continue;
-
-      debug(`${job.name} ${job.id} was successful...`);
-      debug(`Downloading logs for job id ${job.id}...`);
-
-      let workflowRunLog = null;
-      try {
-        workflowRunLog = await octokit.rest.actions.downloadJobLogsForWorkflowRun({
-          owner: owner,
-          repo: repo,
-          job_id: job.id,
-        });
-      } catch (e) {
-        debug(`Logs for the job ${job.id} are not available.`);
-        continue;
-      }
+    if (!permissions.has(jobName)) {
+      permissions.set(jobName, new Map());
+    }
 
-      const logUploadMatch = workflowRunLog.data.match(/([^ "]+-permissions-[a-z0-9]{32})/m);
-      if (!logUploadMatch) {
-        debug(`Cannot find the magic string. Skipping.`);
+    const p = permissions.get(jobName);
+    for (const [kind, perm] of jobPermissions) {
+      if (kind === 'unknown') {
+        wasUnknown = true;
         continue;
       }
-      const artifactName = logUploadMatch[1];
-      debug(`Looking for artifactName ${artifactName}`);
-      const jobName = artifactName.split('-').slice(0, -2).join('-');
-
-      for (const artifact of artifacts.data.artifacts) {
-        if (artifact.name === artifactName) {
-          debug(`Downloading artifact id ${artifact.id}`);
-          const download = await octokit.rest.actions.downloadArtifact({
-            owner: owner,
-            repo: repo,
-            artifact_id: artifact.id,
-            archive_format: 'zip',
-          });
-
-          const zip = new AdmZip(Buffer.from(download.data));
-          const zipEntries = zip.getEntries();
-          const extracted = zip.readAsText(zipEntries[0]);
-          const jobPermissions = new Map(Object.entries(JSON.parse(extracted)));
-
-          if (!permissions.has(jobName)) {
-            permissions.set(jobName, new Map());
-          }
 
-          const p = permissions.get(jobName);
-          for (const [kind, perm] of jobPermissions) {
-            if (kind === 'unknown') {
-              wasUnknown = true;
-              continue;
-            }
-
-            if (p.has(kind)) {
-              if (perm === "write") {
-                p.set(kind, perm)
-              }
-            } else {
-              p.set(kind, perm)
-            }
-          }
+      if (p.has(kind)) {
+        if (perm === "write") {
+          p.set(kind, perm)
         }
+      } else {
+        p.set(kind, perm)
       }
     }
   }
@@ -112,8 +229,8 @@ async function analyze(name, count, token, owner, repo, branch) {
   return [permissions, wasUnknown];
 }
 
-async function run(token, name, count, owner, repo, branch, format) {
-  const [permissions, wasUnknown] = await analyze(name, count, token, owner, repo, branch);
+async function run(token, name, count, owner, repo, branch, format, cachePath) {
+  const [permissions, wasUnknown] = await analyze(name, count, token, owner, repo, branch, cachePath);
 
   let summary = core.summary.addHeading(`Minimal required permissions for ${name}:`);
   log(`Minimal required permissions for ${name}:`);
@@ -160,8 +277,8 @@ async function run(token, name, count, owner, repo, branch, format) {
 }
 
 function printUsageAndExit() {
-  console.log('Usage: node index.js <number_of_the_last_runs> <github_owner> <repo_name> <branch_name> [--format yaml] [--verbose]');
-  console.log('For example: node index.js ci.yml 10 github actions-permissions main --format yaml --verbose');
+  console.log('Usage: node index.js <workflow_name.yml> <number_of_the_last_runs> <github_owner> <repo_name> <branch_name> [--format yaml] [--verbose] [--cache <file>]');
+  console.log('For example: node index.js ci.yml 10 github actions-permissions main --format yaml --verbose --cache permissions-cache.json');
   process.exit(1);
 }
 
@@ -172,11 +289,12 @@ if (process.env.GITHUB_ACTIONS) {
   const name = core.getInput('name');
   const count = core.getInput('count');
   const token = core.getInput('token');
+  const cachePath = core.getInput('cache_path');
   verbose = process.env.RUNNER_DEBUG ? true : false;
   const branch = github.context.ref.split('/').slice(-1)[0];
   const format = null;
 
-  run(token, name, count, github.context.repo.owner, github.context.repo.repo, branch, format).catch(error => {
+  run(token, name, count, github.context.repo.owner, github.context.repo.repo, branch, format, cachePath).catch(error => {
     core.setFailed(error.message);
   });
 } else {
@@ -195,6 +313,16 @@ if (process.env.GITHUB_ACTIONS) {
     args.splice(outputIndex, 2); // Remove --output and its value from args
   }
 
+  const cacheIndex = args.indexOf('--cache');
+  let cachePath = '';
+  if (cacheIndex !== -1) {
+    if (cacheIndex + 1 >= args.length) {
+      printUsageAndExit();
+    }
+    cachePath = args[cacheIndex + 1];
+    args.splice(cacheIndex, 2); // Remove --cache and its value from args
+  }
+
   const debugIndex = args.indexOf('--verbose');
   if (debugIndex !== -1) {
     verbose = true;
@@ -210,7 +338,7 @@ if (process.env.GITHUB_ACTIONS) {
     log = () => {};
   }
 
-  run(process.env.GITHUB_TOKEN, name, count, owner, repo, branch, format).catch(error => {
+  run(process.env.GITHUB_TOKEN, name, count, owner, repo, branch, format, cachePath).catch(error => {
     console.error(`Error: ${error.message}`);
     exit(2);
   });
@@ -0,0 +1,126 @@
+"""
+Builds the precompiled permission index (permissions.index) loaded by the proxy addon at startup.
+
+The index is the route trie of the addon stored with marshal: the endpoints from a local copy
+of GitHub's REST API OpenAPI description with their required permissions, overridden by the hand written ROUTES.
+
+The public OpenAPI description lists the endpoints, but not the permissions a token needs to call them.
+GitHub publishes them separately for the GitHub Apps (the server-to-server permissions data used by the docs):
+    {"<permission>": {"permissions": [{"verb": "get", "requestPath": "/repos/{owner}/{repo}/...", "access": "read",
+                                       "additional-permissions": false}, ...]}, ...}
+
+Usage:
+    python build_index.py --openapi api.github.com.json --permissions server-to-server-permissions.json [--output permissions.index]
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mitm_plugin  # noqa: E402
+
+
+# the permissions the GITHUB_TOKEN can be granted
+TOKEN_PERMISSIONS = {
+    'actions',
+    'attestations',
+    'checks',
+    'contents',
+    'deployments',
+    'discussions',
+    'id-token',
+    'issues',
+    'models',
+    'packages',
+    'pages',
+    'pull-requests',
+    'repository-projects',
+    'security-events',
+    'statuses',
+}
+
+# reading these from a public repository doesn't require the permission
+PUBLIC_READ_PERMISSIONS = {'actions', 'contents'}
+
+METHODS = ('get', 'post', 'put', 'patch', 'delete')
+
+
+def read_operations(path):
+    with open(path) as f:
+        openapi = json.load(f)
+
+    return {(method, route) for route, operations in openapi['paths'].items() for method in operations if method in METHODS}
+
+
+def read_permissions(path):
+    # (method, path) -> [(permission, access, additional)]
+    with open(path) as f:
+        data = json.load(f)
+
+    endpoints = {}
+    for name, permission in data.items():
+        for endpoint in permission['permissions']:
+            key = (endpoint['verb'].lower(), endpoint['requestPath'])
+            endpoints.setdefault(key, []).append((name.replace('_', '-'), endpoint['access'], endpoint.get('additional-permissions', False)))
+    return endpoints
+
+
+def generate_route(method, path, permissions):
+    # returns the route in the ROUTES format or None if the GITHUB_TOKEN can't call the endpoint
+    # metadata is granted to every token
+    required = [(name, access) for name, access, _ in permissions if name != 'metadata']
+    if not required:
+        return (method.upper(), path, None, None, None)
+
+    if any(name not in TOKEN_PERMISSIONS for name, _ in required):
+        return None
+
+    # The alternative permissions (like issues or pull-requests) can't be told apart without a lookup,
+    # the safest bet is to require all of them, the same as for the additional permissions
+    names = list(dict.fromkeys(name for name, _ in required))
+    access = {name: 'read' for name in names}
+    for name, level in required:
+        if level == 'write':
+            access[name] = 'write'
+
+    levels = [access[name] for name in names]
+    permission = levels[0] if len(set(levels)) == 1 else ','.join(levels)
+    lookup = None
+    if method == 'get' and set(names) <= PUBLIC_READ_PERMISSIONS and permission == 'read':
+        lookup = 'public'
+    return (method.upper(), path, ','.join(names), permission, lookup)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the precompiled permission index for the proxy addon.')
+    parser.add_argument('--openapi', required=True, help="GitHub's REST API OpenAPI description (JSON)")
+    parser.add_argument('--permissions', required=True, help='the permissions required by the endpoints (JSON)')
+    parser.add_argument('--output', default=mitm_plugin.INDEX_PATH, help='the index file to write')
+    args = parser.parse_args()
+
+    operations = read_operations(args.openapi)
+    permissions = read_permissions(args.permissions)
+
+    routes = []
+    skipped = 0
+    for method, path in sorted(operations & permissions.keys()):
+        route = generate_route(method, path, permissions[(method, path)])
+        if route:
+            routes.append(route)
+        else:
+            skipped += 1
+
+    # the hand written routes go last to override the generated ones
+    tree = mitm_plugin.compile_routes(routes + list(mitm_plugin.ROUTES), mitm_plugin.GHActionsProxy.methods_map)
+    mitm_plugin.save_index(args.output, tree, mitm_plugin.ROUTES)
+
+    print('endpoints:                    %d' % len(operations))
+    print('with the permissions:         %d' % len(operations & permissions.keys()))
+    print('not available to the token:   %d' % skipped)
+    print('indexed (+ hand written):     %d (+ %d)' % (len(routes), len(mitm_plugin.ROUTES)))
+    print('written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Microbenchmark of the per-flow overhead of the proxy addon.
+
+Times the requestheaders hook of the addon for the typical kinds of traffic, one kind at a time:
+the ignored requests to the other hosts with and without an authorization header and the intercepted
+requests to the monitored hosts with the token in the Bearer and basic authentication forms, and with a foreign token.
+The intercepted requests hit the routes that don't need the enrichment lookups, so only the hook itself is measured.
+
+Usage:
+    python flow_bench.py [--flows N] [--plugin PATH] [--debug]
+
+--plugin benchmarks another version of mitm_plugin.py, for example the one before a change.
+--debug enables the debug logging of the addon, which logs every intercepted request.
+"""
+import argparse
+import asyncio
+import base64
+import importlib.util
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from mitmproxy import http
+from mitmproxy.test import taddons
+from mitmproxy.test import tflow
+
+
+REPOSITORY = 'octo-org/octo-repo'
+TOKEN = 'ghs_bench'
+BASIC = 'Basic %s' % base64.b64encode(('x-access-token:%s' % TOKEN).encode()).decode()
+
+TRAFFIC = (
+    ('ignored', 'GET', 'https://registry.npmjs.org/package', {}),
+    ('ignored, authorization', 'GET', 'https://registry.npmjs.org/package', {'Authorization': 'Bearer npm_token'}),
+    ('intercepted, bearer', 'GET', 'https://api.github.com/repos/%s/labels' % REPOSITORY, {'Authorization': 'Bearer %s' % TOKEN}),
+    ('intercepted, basic', 'GET', 'https://github.com/%s/info/refs?service=git-upload-pack' % REPOSITORY, {'Authorization': BASIC}),
+    ('monitored, other token', 'GET', 'https://api.github.com/repos/%s/labels' % REPOSITORY, {'Authorization': 'Bearer ghp_other'}),
+)
+
+
+def load_plugin(path):
+    spec = importlib.util.spec_from_file_location('mitm_plugin', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_flow(method, url, headers):
+    flow = tflow.tflow()
+    # the Host header is set like the clients do
+    flow.request = http.Request.make(method, url, headers={'Host': url.split('/')[2], **headers})
+    return flow
+
+
+async def bench(plugin, flows, debug=False, rounds=3):
+    addon = plugin.GHActionsProxy()
+    results = []
+    with taddons.context(addon) as tctx:
+        tctx.configure(
+            addon,
+            summary='summary.json',
+            token=TOKEN,
+            hosts='api.github.com,github.com',
+            GITHUB_REPOSITORY=REPOSITORY,
+            GITHUB_REPOSITORY_ID='42',
+            GITHUB_API_URL='https://api.github.com',
+            debug='true' if debug else '',
+        )
+        # the visibility of the repository is known already, like after the first lookup of a job
+        addon.cache.set('visibility:%s' % REPOSITORY, False)
+        for name, method, url, headers in TRAFFIC:
+            # the best of several rounds, the flows are created outside of the measured time
+            timings = []
+            for _ in range(rounds):
+                batch = [make_flow(method, url, headers) for _ in range(flows)]
+                started = time.perf_counter()
+                for flow in batch:
+                    await addon.requestheaders(flow)
+                timings.append((time.perf_counter() - started) / flows)
+            results.append((name, min(timings), statistics.median(timings)))
+        await addon.done()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the per-flow overhead of the proxy addon.')
+    parser.add_argument('--flows', type=int, default=5000, help='number of the flows of every kind per round')
+    parser.add_argument('--debug', action='store_true', help='enable the debug logging of the addon')
+    parser.add_argument('--plugin', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mitm_plugin.py'))
+    args = parser.parse_args()
+
+    plugin = load_plugin(os.path.abspath(args.plugin))
+    # the addon writes its state to the current directory
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        results = asyncio.run(bench(plugin, args.flows, args.debug))
+
+    print('%-26s %12s %12s' % ('traffic', 'best us', 'median us'))
+    for name, best, median in results:
+        print('%-26s %12.2f %12.2f' % (name, best * 1e6, median * 1e6))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
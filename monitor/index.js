@@ -2,6 +2,246 @@ const core = require('@actions/core');
 const {DefaultArtifactClient} = require('@actions/artifact')
 const crypto = require("crypto");
 const fs = require('fs');
+const net = require('net');
+const { execSync } = require('child_process');
+
+const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
+// ask the proxy to persist its in-memory state and wait until it is done
+async function flushProxy(rootDir) {
+  const pidFile = `${rootDir}/mitmdump.pid`;
+  if (!fs.existsSync(pidFile))
+    return;
+
+  const pid = parseInt(fs.readFileSync(pidFile, 'utf8').trim());
+  execSync(`sudo kill -USR1 ${pid}`);
+  for (let counter = 0; counter < 100; counter++) {
+    if (fs.existsSync(`${rootDir}/flush.done`))
+      return;
+    await sleep(100);
+  }
+  core.warning('The proxy did not respond to the flush request in time.');
+}
+
+// sends a command to the control socket of a persistent proxy and returns its response
+function control(socketPath, command) {
+  return new Promise((resolve, reject) => {
+    let data = '';
+    const socket = net.createConnection(socketPath, () => socket.write(`${JSON.stringify(command)}\n`));
+    socket.setEncoding('utf8');
+    socket.on('data', chunk => {
+      data += chunk;
+      const end = data.indexOf('\n');
+      if (end !== -1) {
+        socket.end();
+        try {
+          resolve(JSON.parse(data.slice(0, end)));
+        } catch (error) {
+          reject(error);
+        }
+      }
+    });
+    socket.on('error', reject);
+    socket.on('close', () => reject(new Error('The proxy closed the control connection without a response')));
+  });
+}
+
+// runs fn for every item with at most limit of them at the same time
+async function mapConcurrently(items, limit, fn) {
+  const results = new Array(items.length);
+  let next = 0;
+  async function worker() {
+    while (next < items.length) {
+      const i = next++;
+      results[i] = await fn(items[i]);
+    }
+  }
+  await Promise.all(Array.from({ length: Math.min(limit, items.length) }, worker));
+  return results;
+}
+
+// the same enrichment lookups as the proxy makes, returns [answer, whether it is definitive and can be cached]
+async function lookup(token, { lookup, repo, number }) {
+  const repoPath = `${process.env.GITHUB_API_URL}/${repo.includes('/') ? 'repos' : 'repositories'}/${repo}`;
+  const url = {
+    public: repoPath,
+    issue_number: `${repoPath}/pulls/${number}`,
+    comment_id: `${repoPath}/issues/comments/${number}`,
+    event_id: `${repoPath}/issues/events/${number}`,
+  }[lookup];
+
+  let response;
+  try {
+    response = await fetch(url, {
+      headers: {
+        Authorization: `Bearer ${token}`,
+        Accept: 'application/vnd.github+json',
+        'X-GitHub-Api-Version': '2022-11-28',
+      },
+    });
+  } catch (error) {
+    core.warning(`Failed to look up ${url}: ${error.message}`);
+    response = null;
+  }
+
+  if (lookup === 'public') {
+    if (response && response.status === 200)
+      return [(await response.json()).private === false, true];
+    return [false, false];
+  }
+  if (lookup === 'issue_number') {
+    if (response && response.status === 200)
+      return ['pull-requests', true];
+    return ['issues', !!response && response.status === 404];
+  }
+  if (response && response.status === 200) {
+    const data = await response.json();
+    const htmlUrl = lookup === 'comment_id' ? data.html_url : data.issue.html_url;
+    return [htmlUrl.includes('/pull/') ? 'pull-requests' : 'issues', true];
+  }
+  return [null, false];
+}
+
+// resolves the permissions the proxy recorded with the lookups left to the post step
+// every distinct lookup is made once, at most concurrency of them at the same time
+async function resolveDeferred(deferred, token, concurrency = 8) {
+  const keyOf = entry => entry.lookup === 'public' ? `visibility:${entry.repo.toLowerCase()}` : `${entry.lookup}:${entry.repo.toLowerCase()}:${entry.number}`;
+  const lookups = new Map();
+  for (const entry of deferred) {
+    if (!lookups.has(keyOf(entry)))
+      lookups.set(keyOf(entry), entry);
+  }
+
+  const keys = Array.from(lookups.keys());
+  const answers = await mapConcurrently(keys, concurrency, key => lookup(token, lookups.get(key)));
+  const resolved = new Map(keys.map((key, i) => [key, answers[i]]));
+
+  const permissions = [];
+  const unknown = [];
+  for (const entry of deferred) {
+    const [answer] = resolved.get(keyOf(entry));
+    if (entry.lookup === 'public') {
+      if (!answer)
+        permissions.push([entry.kind, entry.permission]);
+    } else if (answer) {
+      permissions.push([answer, entry.permission]);
+    } else {
+      unknown.push(entry);
+    }
+  }
+  // the definitive answers in the enrichment cache format
+  const cache = Array.from(resolved).filter(([, [, definitive]]) => definitive).map(([key, [answer]]) => [key, answer]);
+  return { permissions, unknown, cache };
+}
+
+// adds the entries to the enrichment cache file, so the next runs don't need to look them up again
+function updateCache(cachePath, entries) {
+  let cache = { entries: [] };
+  if (fs.existsSync(cachePath))
+    cache = JSON.parse(fs.readFileSync(cachePath, 'utf8'));
+  const keys = new Set(entries.map(([key]) => key));
+  const stored = Date.now() / 1000;
+  cache.entries = cache.entries.filter(([key]) => !keys.has(key)).concat(entries.map(([key, value]) => [key, value, stored]));
+  fs.writeFileSync(cachePath, JSON.stringify(cache));
+}
+
+// merges the summaries of the proxy workers into one report
+function mergeReports(reports) {
+  const merged = { permissions: {}, calls: [], calls_overflow: 0, unknown: [], unknown_count: 0, deferred: [] };
+  const calls = new Map();
+  for (const report of reports) {
+    for (const [kind, perm] of Object.entries(report.permissions)) {
+      if (merged.permissions[kind] !== 'write')
+        merged.permissions[kind] = perm;
+    }
+    for (const call of report.calls) {
+      const key = `${call.method} ${call.host}${call.path}`;
+      if (calls.has(key))
+        calls.get(key).count += call.count;
+      else
+        calls.set(key, { ...call });
+    }
+    merged.unknown.push(...report.unknown);
+    merged.unknown_count += report.unknown_count;
+    merged.calls_overflow += report.calls_overflow || 0;
+    merged.deferred.push(...(report.deferred || []));
+  }
+  merged.calls = Array.from(calls.values());
+  return merged;
+}
+
+// the upper bound of the bucket in milliseconds, the same way the proxy computes it
+function percentile(histogram, p) {
+  let seen = 0;
+  for (const bucket of Object.keys(histogram.buckets_us).map(Number).sort((a, b) => a - b)) {
+    seen += histogram.buckets_us[bucket];
+    if (seen >= histogram.count * p / 100)
+      return bucket / 1000;
+  }
+  return 0;
+}
+
+// merges the metrics of the proxy workers, the counters and the histogram buckets add up
+function mergeMetrics(allMetrics) {
+  const merged = { histograms: {}, counters: {} };
+  for (const metrics of allMetrics) {
+    for (const [name, value] of Object.entries(metrics.counters))
+      merged.counters[name] = (merged.counters[name] || 0) + value;
+    for (const [name, histogram] of Object.entries(metrics.histograms)) {
+      const total = merged.histograms[name] ||= { count: 0, total_ms: 0, max_ms: 0, buckets_us: {} };
+      total.count += histogram.count;
+      total.total_ms += histogram.total_ms;
+      total.max_ms = Math.max(total.max_ms, histogram.max_ms);
+      for (const [bucket, count] of Object.entries(histogram.buckets_us))
+        total.buckets_us[bucket] = (total.buckets_us[bucket] || 0) + count;
+    }
+  }
+  for (const histogram of Object.values(merged.histograms)) {
+    histogram.p50_ms = percentile(histogram, 50);
+    histogram.p99_ms = percentile(histogram, 99);
+  }
+  return merged;
+}
+
+function hitRate(hits, misses) {
+  const total = (hits || 0) + (misses || 0);
+  return total ? `${(100 * (hits || 0) / total).toFixed(1)}% of ${total}` : '-';
+}
+
+// the job summary table of the proxy metrics
+function metricsTable(metrics) {
+  const counters = metrics.counters;
+  const rows = [[
+    { data: 'Metric', header: true },
+    { data: 'Count', header: true },
+    { data: 'p50 (ms)', header: true },
+    { data: 'p99 (ms)', header: true },
+    { data: 'Max (ms)', header: true },
+    { data: 'Total (ms)', header: true },
+  ]];
+  const latencies = [
+    ['requestheaders', 'Request hook'],
+    ['get_permission', 'Permission lookup'],
+    ['graphql', 'GraphQL classification'],
+    ['enrichment', 'Enrichment lookup'],
+    ['github_api', 'GitHub API call'],
+  ];
+  for (const [name, label] of latencies) {
+    const histogram = metrics.histograms[name];
+    if (histogram) {
+      rows.push([label, `${histogram.count}`, histogram.p50_ms.toFixed(3), histogram.p99_ms.toFixed(3),
+        histogram.max_ms.toFixed(3), histogram.total_ms.toFixed(1)]);
+    }
+  }
+  rows.push(['Intercepted / ignored flows', `${counters.flows_intercepted || 0} / ${counters.flows_ignored || 0}`, '', '', '', '']);
+  rows.push(['Route memo hit rate', hitRate(counters.route_memo_hits, counters.route_memo_misses), '', '', '', '']);
+  rows.push(['GraphQL document memo hit rate', hitRate(counters.graphql_memo_hits, counters.graphql_memo_misses), '', '', '', '']);
+  rows.push(['Visibility cache hit rate', hitRate(counters.visibility_cache_hits, counters.visibility_cache_misses), '', '', '', '']);
+  rows.push(['Issue cache hit rate', hitRate(counters.issue_cache_hits, counters.issue_cache_misses), '', '', '', '']);
+  rows.push(['DNS hit rate', hitRate(counters.dns_hits, counters.dns_misses), '', '', '', '']);
+  rows.push(['Rate limited API calls', `${counters.github_api_rate_limited || 0}`, '', '', '', '']);
+  return rows;
+}
 
 async function run() {
   try {
@@ -19,6 +259,18 @@ async function run() {
     if (!config.hasOwnProperty('debug')) {
       config['debug'] = false;
     }
+    if (!config.hasOwnProperty('cache_path')) {
+      config['cache_path'] = '';
+    }
+    if (!config.hasOwnProperty('defer_lookups')) {
+      config['defer_lookups'] = false;
+    }
+    if (!config.hasOwnProperty('daemon_socket')) {
+      config['daemon_socket'] = '';
+    }
+    if (!config.hasOwnProperty('workers')) {
+      config['workers'] = 1;
+    }
 
     if (!config.enabled)
       return;
@@ -36,57 +288,87 @@ async function run() {
       hosts.add(process.env.ACTIONS_ID_TOKEN_REQUEST_URL.split('/')[2].toLowerCase());
     }
 
-    if (!!core.getState('isPost')) {
-
-      let rootDir = '';
-      if (process.env.RUNNER_OS === 'Linux') {
-        rootDir = '/home/mitmproxyuser';
-      } else if (process.env.RUNNER_OS === 'macOS') {
-        rootDir = '/Users/mitmproxyuser';
-      }
+    let rootDir = '';
+    if (process.env.RUNNER_OS === 'Linux') {
+      rootDir = '/home/mitmproxyuser';
+    } else if (process.env.RUNNER_OS === 'macOS') {
+      rootDir = '/Users/mitmproxyuser';
+    }
 
-      const debugLog = `${rootDir}/debug.log`;
-      if (fs.existsSync(debugLog)) {
-        // using core.info instead of core.debug to print even if the runner itself doesn't run in debug mode
-        core.info(fs.readFileSync(debugLog, 'utf8'));
-      }
+    // several proxy workers are started on Linux only, every one of them keeps its output in its own directory
+    let workerDirs = [rootDir];
+    if (config.workers > 1 && process.env.RUNNER_OS === 'Linux' && !config.daemon_socket) {
+      workerDirs = Array.from({ length: config.workers }, (_, i) => `${rootDir}/worker-${i}`);
+    }
 
-      const data = fs.readFileSync(`${rootDir}/out.txt`, 'utf8');
-      if (debug)
-        console.log(`logged: ${data}`);
+    if (!!core.getState('isPost')) {
 
-      const errorLog = `${rootDir}/error.log`;
-      if (fs.existsSync(errorLog)) {
-        core.setFailed(fs.readFileSync(errorLog, 'utf8'));
-        process.exit(1);
-      }
+      let report = { permissions: {}, calls: [], unknown: [], unknown_count: 0 };
+      if (config.daemon_socket) {
+        // the persistent proxy returns the aggregate of the calls of the job's session, its logs stay with the proxy
+        const response = await control(config.daemon_socket, { command: 'end-session', session: core.getState('session') });
+        if (response.error)
+          throw new Error(`The proxy failed to end the session: ${response.error}`);
+        report = response.summary;
+      } else {
+        await Promise.all(workerDirs.map(flushProxy));
 
-      const results = JSON.parse(`[${data.trim().replace(/\r?\n|\r/g, ',')}]`);
+        if (config.cache_path && fs.existsSync(`${rootDir}/cache.json`)) {
+          fs.copyFileSync(`${rootDir}/cache.json`, config.cache_path);
+        }
 
-      let permissions = new Map();
-      let wasUnknown = false;
-      for (const result of results) {
-        if (!hosts.has(result.host.toLowerCase()))
-          continue;
+        const reports = [];
+        for (const workerDir of workerDirs) {
+          const debugLog = `${workerDir}/debug.log`;
+          if (fs.existsSync(debugLog)) {
+            // using core.info instead of core.debug to print even if the runner itself doesn't run in debug mode
+            core.info(fs.readFileSync(debugLog, 'utf8'));
+          }
 
-        for (const p of result.permissions) {
-          const kind = Object.keys(p)[0];
-          const perm = p[kind];
+          const rawLog = `${workerDir}/out.txt`;
+          if (debug && fs.existsSync(rawLog))
+            console.log(`logged: ${fs.readFileSync(rawLog, 'utf8')}`);
 
-          if (kind === 'unknown') {
-            core.warning(`The github token was used to call ${result.method} ${result.host}${result.path} but the permission is unknown. Please report this to the action author.`);
-            wasUnknown = true;
-            continue;
+          const errorLog = `${workerDir}/error.log`;
+          if (fs.existsSync(errorLog)) {
+            core.setFailed(fs.readFileSync(errorLog, 'utf8'));
+            process.exit(1);
           }
 
-          if (permissions.has(kind)) {
-            if (perm === "write") {
-              permissions.set(kind, perm)
-            }
-          } else {
-            permissions.set(kind, perm)
+          // the proxy aggregates the calls itself, it doesn't write the summary if the token wasn't used at all
+          const summaryFile = `${workerDir}/summary.json`;
+          if (fs.existsSync(summaryFile)) {
+            reports.push(JSON.parse(fs.readFileSync(summaryFile, 'utf8')));
           }
         }
+        if (reports.length > 0)
+          report = mergeReports(reports);
+      }
+
+      if (debug)
+        console.log(`summary: ${JSON.stringify(report)}`);
+
+      const permissions = new Map(Object.entries(report.permissions));
+      let wasUnknown = report.unknown_count > 0;
+      for (const call of report.unknown) {
+        core.warning(`The github token was used to call ${call.method} ${call.host}${call.path} but the permission is unknown. Please report this to the action author.`);
+      }
+
+      if (report.deferred && report.deferred.length > 0) {
+        const resolved = await resolveDeferred(report.deferred, core.getInput('token'));
+        for (const [kind, perm] of resolved.permissions) {
+          if (permissions.get(kind) !== 'write')
+            permissions.set(kind, perm);
+        }
+        for (const entry of resolved.unknown) {
+          wasUnknown = true;
+          core.warning(`The github token was used to access ${entry.lookup.replace('_', ' ')} ${entry.number} of ${entry.repo}, but it couldn't be determined if it is an issue or a pull request.`);
+        }
+        if (config.cache_path && resolved.cache.length > 0)
+          updateCache(config.cache_path, resolved.cache);
+      }
+      if (report.unknown_count > report.unknown.length) {
+        core.warning(`${report.unknown_count - report.unknown.length} more calls with unknown permissions were not listed.`);
       }
 
       let summary = 'permissions:';
@@ -105,8 +387,20 @@ async function run() {
 
       core.summary
         .addRaw('#### Minimal required permissions:\n')
-        .addCodeBlock(summary, 'yaml')
-        .write();
+        .addCodeBlock(summary, 'yaml');
+
+      // the overhead of the monitor itself
+      const metricsFiles = workerDirs.map(workerDir => `${workerDir}/metrics.json`).filter(fs.existsSync);
+      if (!config.daemon_socket && metricsFiles.length > 0) {
+        const metrics = mergeMetrics(metricsFiles.map(metricsFile => JSON.parse(fs.readFileSync(metricsFile, 'utf8'))));
+        if (debug)
+          console.log(`metrics: ${JSON.stringify(metrics)}`);
+        core.summary
+          .addRaw('\n#### Monitor overhead:\n')
+          .addTable(metricsTable(metrics));
+      }
+
+      core.summary.write();
 
       if (config.create_artifact) {
         const tempDirectory = process.env['RUNNER_TEMP'];
@@ -119,6 +413,21 @@ async function run() {
         );
       }
     }
+    else if (config.daemon_socket) {
+      // the persistent proxy is already set up on the runner, only tell it about the job
+      const response = await control(config.daemon_socket, {
+        command: 'begin-session',
+        token: core.getInput('token'),
+        repository: process.env.GITHUB_REPOSITORY,
+        repository_id: process.env.GITHUB_REPOSITORY_ID,
+        id_token_request_url: process.env.ACTIONS_ID_TOKEN_REQUEST_URL,
+        id_token_request_token: process.env.ACTIONS_ID_TOKEN_REQUEST_TOKEN,
+      });
+      if (response.error)
+        throw new Error(`The proxy failed to begin the session: ${response.error}`);
+      core.saveState('session', response.session);
+      core.saveState('isPost', true);
+    }
     else {
       core.saveState('isPost', true)
       const { spawn } = require('child_process');
@@ -127,22 +436,34 @@ async function run() {
       if (debug)
         bashArgs.unshift('-v');
 
-      const command = spawn('bash', bashArgs, { cwd: `${__dirname}/..` })
+      const command = spawn('bash', bashArgs, {
+        cwd: `${__dirname}/..`,
+        env: {
+          ...process.env,
+          PERMISSIONS_CACHE: config.cache_path,
+          PERMISSIONS_DEFER_LOOKUPS: config.defer_lookups ? 'true' : 'false',
+          PERMISSIONS_WORKERS: `${config.workers}`,
+        }
+      })
 
       command.stdout.on('data', output => {
         console.log(output.toString())
-        if (output.toString().includes('--all done--')) {
-          process.exit(0)
-        }
       })
       command.stderr.on('data', output => {
         console.log(`stderr: ${output.toString()}`)
       })
+      // the setup waits for the proxy to signal it is ready,
+      // but mitmdump keeps the output pipes open, so exit explicitly instead of waiting for them to close
       command.on('exit', code => {
         if (code !== 0) {
           core.setFailed(`Exited with code ${code}`);
           process.exit(code);
         }
+        if (!workerDirs.every(workerDir => fs.existsSync(`${workerDir}/ready`))) {
+          core.setFailed('The proxy did not signal it is ready');
+          process.exit(1);
+        }
+        process.exit(0);
       })
     }
   } catch (error) {
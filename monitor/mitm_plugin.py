@@ -1,409 +1,1897 @@
+import asyncio
+import atexit
 import base64
-import requests
+import email.utils
+import hashlib
+import httpx
+import json
+import marshal
+import os
+import re
+import secrets
+import signal
 import socket
+import sqlite3
 import sys
+import threading
+import time
 import traceback
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from urllib.parse import urlsplit
-from urllib.parse import urlparse
 from urllib.parse import parse_qs
 from mitmproxy import ctx
 
 
 class HTTP(Enum):
+    ANY = 0
     GET = 1
     POST = 2
-    PUT = 3,
-    DELETE = 4,
+    PUT = 3
+    DELETE = 4
     PATCH = 5
 
 
-class GHActionsProxy:
-    def add_to_maps(self, dns):
-        ip = socket.gethostbyname(dns)
-        # in case of transparent proxy, host name is not available, so we build a map of ip -> dns
-        self.ip_map[ip] = dns
-        # to make the proxy universal let's build a map of dns -> ip when the proxy is used explicitly
-        self.dns_map[dns] = ip
+# All the known REST API and git endpoints: (method, path, permission type, permission, lookup)
+#
+# '*' method matches any HTTP method, the HEAD requests are matched as GET.
+# A literal path segment takes precedence over a {placeholder}, a segment matching a literal never matches the placeholder.
+# A path ending with '/**' matches the path itself and anything below it, when nothing more specific matches.
+# The repository scoped paths are written in the /repos/{owner}/{repo}/... form only,
+# the /repositories/{id}/... form is normalized to the same shape before the lookup.
+# None permission type means no permission is required.
+# The permission is 'read', 'write', 'read/write' (read for GET, write for the other methods)
+# or 'service' (depends on the git service in the query: read for git-upload-pack, write for git-receive-pack).
+# The lookup is 'public' if reading from a public repository doesn't require the permission.
+# The 'issues/pull-requests' permission type requires a lookup if the issue is a pull request, it is added automatically.
+# 'issues,pull-requests' means it is impossible to distinguish between issues and pull requests.
+ROUTES = (
+    ('GET',     '/repos/{owner}/{repo}/codeowners/errors',                                     'contents',                'read',       None),
+    ('PUT',     '/repos/{owner}/{repo}/pulls/{pull_number}/merge',                             'contents',                'write',      None),
+    ('PUT',     '/repos/{owner}/{repo}/pulls/{pull_number}/update-branch',                     'contents',                'write',      None),
+    ('POST',    '/repos/{owner}/{repo}/comments/{comment_id}/reactions',                       'contents',                'write',      None),
+    ('DELETE',  '/repos/{owner}/{repo}/comments/{comment_id}/reactions/{reaction_id}',         'contents',                'write',      None),
+    ('GET',     '/repos/{owner}/{repo}/branches',                                              'contents',                'read',       None),
 
-    def rebuild_cache(self):
-        for host in ctx.options.hosts.split(','):
-            self.add_to_maps(host.strip())
+    ('POST',    '/repos/{owner}/{repo}/merge-upstream',                                        'contents',                'write',      None),
+    ('POST',    '/repos/{owner}/{repo}/merges',                                                'contents',                'write',      None),
+    ('PATCH',   '/repos/{owner}/{repo}/comments/{comment_id}',                                 'contents',                'write',      None),
+    ('DELETE',  '/repos/{owner}/{repo}/comments/{comment_id}',                                 'contents',                'write',      None),
+    ('POST',    '/repos/{owner}/{repo}/dispatches',                                            'contents',                'write',      None),
 
-    def is_public_repo(self, repo):
-        if repo in self.repo_map:
-            return self.repo_map[repo]
+    ('POST',    '/repos/{owner}/{repo}/issues/{issue_number}/assignees',                       'issues/pull-requests',    'write',      None),
+    ('DELETE',  '/repos/{owner}/{repo}/issues/{issue_number}/assignees',                       'issues/pull-requests',    'write',      None),
+    ('GET',     '/repos/{owner}/{repo}/issues/{issue_number}/comments',                        'issues/pull-requests',    'read',       None),
+    ('POST',    '/repos/{owner}/{repo}/issues/{issue_number}/comments',                        'issues/pull-requests',    'write',      None),
+    ('GET',     '/repos/{owner}/{repo}/issues/comments',                                       'issues,pull-requests',    'read',       None),
+    ('GET',     '/repos/{owner}/{repo}/issues/comments/{comment_id}',                          'issues/pull-requests',    'read',       None),
+    ('PATCH',   '/repos/{owner}/{repo}/issues/comments/{comment_id}',                          'issues/pull-requests',    'write',      None),
+    ('DELETE',  '/repos/{owner}/{repo}/issues/comments/{comment_id}',                          'issues/pull-requests',    'write',      None),
+    ('GET',     '/repos/{owner}/{repo}/issues/{issue_number}/events',                          'issues/pull-requests',    'read',       None),
+    ('GET',     '/repos/{owner}/{repo}/issues/events',                                         'issues,pull-requests',    'read',       None),
+    ('GET',     '/repos/{owner}/{repo}/issues/events/{event_id}',                              'issues/pull-requests',    'read',       None),
+    ('GET',     '/repos/{owner}/{repo}/issues/{issue_number}/timeline',                        'issues/pull-requests',    'read',       None),
+    ('GET',     '/repos/{owner}/{repo}/assignees',                                             'issues,pull-requests',    'read',       None),
+    ('GET',     '/repos/{owner}/{repo}/issues',                                                'issues,pull-requests',    'read',       None),
+    ('POST',    '/repos/{owner}/{repo}/issues',                                                'issues',                  'write',      None),
+    ('GET',     '/repos/{owner}/{repo}/issues/{issue_number}',                                 'issues/pull-requests',    'read',       None),
+    ('PATCH',   '/repos/{owner}/{repo}/issues/{issue_number}',                                 'issues/pull-requests',    'write',      None),
+    ('PUT',     '/repos/{owner}/{repo}/issues/{issue_number}/lock',                            'issues/pull-requests',    'write',      None),
+    ('DELETE',  '/repos/{owner}/{repo}/issues/{issue_number}/lock',                            'issues/pull-requests',    'write',      None),
+    ('GET',     '/repos/{owner}/{repo}/issues/{issue_number}/labels',                          'issues/pull-requests',    'read',       None),
+    ('POST',    '/repos/{owner}/{repo}/issues/{issue_number}/labels',                          'issues/pull-requests',    'write',      None),
+    ('PUT',     '/repos/{owner}/{repo}/issues/{issue_number}/labels',                          'issues/pull-requests',    'write',      None),
+    ('DELETE',  '/repos/{owner}/{repo}/issues/{issue_number}/labels',                          'issues/pull-requests',    'write',      None),
+    ('GET',     '/repos/{owner}/{repo}/labels',                                                'issues',                  'read',       None),
+    ('POST',    '/repos/{owner}/{repo}/labels',                                                'issues',                  'write',      None),
+    ('GET',     '/repos/{owner}/{repo}/milestones/{milestone_number}/labels',                  'issues',                  'read',       None),
+    ('GET',     '/repos/{owner}/{repo}/milestones',                                            'issues',                  'read',       None),
+    ('POST',    '/repos/{owner}/{repo}/milestones',                                            'issues',                  'write',      None),
+    ('GET',     '/repos/{owner}/{repo}/milestones/{milestone_number}',                         'issues',                  'read',       None),
+    ('PATCH',   '/repos/{owner}/{repo}/milestones/{milestone_number}',                         'issues',                  'write',      None),
+    ('DELETE',  '/repos/{owner}/{repo}/milestones/{milestone_number}',                         'issues',                  'write',      None),
+    ('GET',     '/repos/{owner}/{repo}/issues/{issue_number}/reactions',                       'issues/pull-requests',    'read',       None),
+    ('POST',    '/repos/{owner}/{repo}/issues/{issue_number}/reactions',                       'issues/pull-requests',    'write',      None),
+    ('DELETE',  '/repos/{owner}/{repo}/issues/{issue_number}/reactions/{reaction_id}',         'issues/pull-requests',    'write',      None),
+    ('GET',     '/repos/{owner}/{repo}/issues/comments/{comment_id}/reactions',                'issues/pull-requests',    'read',       None),
+    ('POST',    '/repos/{owner}/{repo}/issues/comments/{comment_id}/reactions',                'issues/pull-requests',    'write',      None),
+    ('DELETE',  '/repos/{owner}/{repo}/issues/comments/{comment_id}/reactions',                'issues/pull-requests',    'write',      None),
+    ('DELETE',  '/repos/{owner}/{repo}/issues/{issue_number}/labels/{name}',                   'issues/pull-requests',    'write',      None),
+    ('GET',     '/repos/{owner}/{repo}/labels/{name}',                                         'issues',                  'read',       None),
+    ('PATCH',   '/repos/{owner}/{repo}/labels/{name}',                                         'issues',                  'write',      None),
+    ('DELETE',  '/repos/{owner}/{repo}/labels/{name}',                                         'issues',                  'write',      None),
 
-        repo_path = 'repos' if '/' in repo else 'repositories'
-        url = f'{ctx.options.GITHUB_API_URL}/{repo_path}/{repo}'
-        response = requests.get(url, headers={'Authorization': 'Bearer %s' % ctx.options.token})
-        if response.status_code == 200:
-            self.repo_map[repo] = response.json()['private'] == False
-            return self.repo_map[repo]
+    ('*',       '/repos/{owner}/{repo}/actions/**',                                            'actions',                 'read/write', 'public'),
+    ('*',       '/repos/{owner}/{repo}/environments/**',                                       'actions',                 'read/write', 'public'),
+    ('*',       '/repos/{owner}/{repo}/check-runs/**',                                         'checks',                  'read/write', None),
+    ('*',       '/repos/{owner}/{repo}/check-suites/**',                                       'checks',                  'read/write', None),
+    ('*',       '/repos/{owner}/{repo}/releases/**',                                           'contents',                'read/write', 'public'),
+    ('*',       '/repos/{owner}/{repo}/git/**',                                                'contents',                'read/write', 'public'),
+    ('*',       '/repos/{owner}/{repo}/commits/**',                                            'contents',                'read/write', 'public'),
+    ('*',       '/repos/{owner}/{repo}/deployments/**',                                        'deployments',             'read/write', None),
+    ('*',       '/repos/{owner}/{repo}/pages/**',                                              'pages',                   'read/write', None),
+    ('*',       '/repos/{owner}/{repo}/pulls/**',                                              'pull-requests',           'read/write', None),
+    ('*',       '/repos/{owner}/{repo}/projects/**',                                           'repository-projects',     'read/write', None),
+    ('*',       '/repos/{owner}/{repo}/code-scanning/**',                                      'security-events',         'read/write', None),
+    ('*',       '/repos/{owner}/{repo}/statuses/**',                                           'statuses',                'read/write', None),
+    ('GET',     '/repos/{owner}/{repo}',                                                       None,                      None,         None),
+
+    ('*',       '/orgs/{org}/packages/**',                                                     'packages',                'read/write', None),
+    ('*',       '/users/{username}/packages/**',                                               'packages',                'read/write', None),
+    ('*',       '/user/packages/**',                                                           'packages',                'read/write', None),
+    ('*',       '/projects/{id}/**',                                                           'repository-projects',     'read/write', None),
+    ('GET',     '/users/{username}',                                                           None,                      None,         None),
+
+    ('GET',     '/{owner}/{repo}/info/refs',                                                   'contents',                'service',    'public'),
+    ('*',       '/{owner}/{repo}/git-upload-pack',                                             'contents',                'read',       'public'),
+    ('*',       '/{owner}/{repo}/git-receive-pack',                                            'contents',                'write',      None),
+    ('*',       '/{owner}/{repo}/releases/download/**',                                        None,                      None,         None),
+)
+
+
+# The special trie keys. The path segments are strings and the HTTP methods are positive integers,
+# negative integers never collide with either of them.
+ANY_SEGMENT = -1     # {placeholder}, matches any path segment
+PREFIX_SEGMENT = -2  # **, matches the rest of the path
+REPO_SEGMENT = -3    # normalized /repos/{owner}/{repo} or /repositories/{id}
+
+# The precompiled route trie generated by build_index.py, the hand written ROUTES are compiled if it doesn't exist.
+# The version is the hash of the routes and of the trie layout, an index built from other routes is not loaded,
+# so it can't shadow the edited ROUTES. INDEX_FORMAT is bumped whenever compile_routes changes the layout.
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'permissions.index')
+INDEX_FORMAT = 2
+
+
+def routes_version(routes):
+    layout = (INDEX_FORMAT, ANY_SEGMENT, PREFIX_SEGMENT, REPO_SEGMENT, [(method.name, method.value) for method in HTTP])
+    return hashlib.blake2b(repr((layout, routes)).encode(), digest_size=16).hexdigest()
+
+
+INDEX_VERSION = routes_version(ROUTES)
+
+
+def normalize_path(path):
+    # returns the repository ('owner/repo', the repository id or None) and the path segments
+    # with the repository part replaced by REPO_SEGMENT
+    segments = path.split('/')[1:]
+    if len(segments) >= 3 and segments[0] == 'repos':
+        return f'{segments[1]}/{segments[2]}', [REPO_SEGMENT] + segments[3:]
+    elif len(segments) >= 2 and segments[0] == 'repositories':
+        return segments[1], [REPO_SEGMENT] + segments[2:]
+    return None, segments
+
+
+def compile_routes(routes, methods_map):
+    # build a trie of path segments for the lookup in the time proportional to the path depth
+    # A trie node may contain the links to the next nodes by the path segment
+    # or a link to the HTTP method type (GET, POST, etc.) with the route
+    # Here is the trick: the HTTP method type and the special segments are integers while the path segments are strings
+    # We use both types as keys in the same dictionary
+    # It prevents from unlikely collision if the next path segment name was the same as the HTTP method type
+    # The trie consists of dicts, tuples, strings, integers and None only, so it can be stored with marshal
+    # The later routes override the earlier ones for the same path and method
+    # The route keeps its path, the calls of the same endpoint are counted under it in the summary
+    tree = {}
+    for method, path, type, permission, lookup in routes:
+        _, segments = normalize_path(path)
+        node = tree
+        index = None
+        for i, segment in enumerate(segments):
+            if segment == '**':
+                segment = PREFIX_SEGMENT
+            elif isinstance(segment, str) and segment.startswith('{'):
+                # Every pull request is an issue, but not every issue is a pull request.
+                # issues/pull-requests is a special case, we need to check if the issue is a pull request
+                # The check depends on the available information from the request
+                # To identify the type of check we remember the id and its position in the path
+                if type == 'issues/pull-requests' and lookup is None and segment in ('{issue_number}', '{comment_id}', '{event_id}'):
+                    lookup = segment[1:-1]
+                    index = i
+                # we keep {milestone_number}, {issue_number} and etc. just for readability
+                segment = ANY_SEGMENT
+
+            node = node.setdefault(segment, {})
+
+        node[methods_map[method].value] = (type, permission, lookup, index, path)
+    return tree
+
+
+def load_index(path):
+    # returns the precompiled route trie or None if it doesn't exist or was built for another version of the plugin
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        version, tree = marshal.load(f)
+    return tree if version == INDEX_VERSION else None
+
+
+def save_index(path, tree, routes=ROUTES):
+    # routes are the hand written routes the index was built with
+    # the index ships with the action, the marshal version 4 is read by every Python 3 of the runners
+    with open(path, 'wb') as f:
+        marshal.dump((routes_version(routes), tree), f, 4)
+
+
+SHA_PATTERN = re.compile('[0-9a-f]{40}')
+
+
+def collapse_ids(segments):
+    # collapse the numeric ids and the commit shas, so the calls of the same endpoint share the template
+    collapsed = list(segments)
+    for i, segment in enumerate(collapsed):
+        if not isinstance(segment, str):
+            continue
+        if segment.isdigit():
+            collapsed[i] = '{id}'
+        elif len(segment) == 40 and SHA_PATTERN.fullmatch(segment):
+            collapsed[i] = '{sha}'
+    return collapsed
+
+
+def path_template(path):
+    return '/'.join(collapse_ids(path.split('/')))
+
+
+# GraphQL root mutations and the permission they require, the permission is always 'write'
+# 'issues/pull-requests' means the permission depends on the type of the node the mutation is applied to
+# A comma separated type means several permissions
+GRAPHQL_MUTATIONS = {
+    'addComment':                       'issues/pull-requests',
+    'updateIssueComment':               'issues/pull-requests',
+    'deleteIssueComment':               'issues/pull-requests',
+    'addLabelsToLabelable':             'issues/pull-requests',
+    'removeLabelsFromLabelable':        'issues/pull-requests',
+    'clearLabelsFromLabelable':         'issues/pull-requests',
+    'addAssigneesToAssignable':         'issues/pull-requests',
+    'removeAssigneesFromAssignable':    'issues/pull-requests',
+    'replaceActorsForAssignable':       'issues/pull-requests',
+    'lockLockable':                     'issues/pull-requests',
+    'unlockLockable':                   'issues/pull-requests',
+    'minimizeComment':                  'issues/pull-requests',
+    'unminimizeComment':                'issues/pull-requests',
+    'addReaction':                      'issues/pull-requests',
+    'removeReaction':                   'issues/pull-requests',
+    'createIssue':                      'issues',
+    'updateIssue':                      'issues',
+    'closeIssue':                       'issues',
+    'reopenIssue':                      'issues',
+    'deleteIssue':                      'issues',
+    'pinIssue':                         'issues',
+    'unpinIssue':                       'issues',
+    'transferIssue':                    'issues',
+    'addSubIssue':                      'issues',
+    'removeSubIssue':                   'issues',
+    'reprioritizeSubIssue':             'issues',
+    'createLabel':                      'issues',
+    'updateLabel':                      'issues',
+    'deleteLabel':                      'issues',
+    'createPullRequest':                'pull-requests',
+    'updatePullRequest':                'pull-requests',
+    'closePullRequest':                 'pull-requests',
+    'reopenPullRequest':                'pull-requests',
+    'mergePullRequest':                 'pull-requests',
+    'revertPullRequest':                'pull-requests',
+    'updatePullRequestBranch':          'pull-requests',
+    'markPullRequestReadyForReview':    'pull-requests',
+    'convertPullRequestToDraft':        'pull-requests',
+    'enablePullRequestAutoMerge':       'pull-requests',
+    'disablePullRequestAutoMerge':      'pull-requests',
+    'enqueuePullRequest':               'pull-requests',
+    'dequeuePullRequest':               'pull-requests',
+    'requestReviews':                   'pull-requests',
+    'addPullRequestReview':             'pull-requests',
+    'submitPullRequestReview':          'pull-requests',
+    'updatePullRequestReview':          'pull-requests',
+    'deletePullRequestReview':          'pull-requests',
+    'dismissPullRequestReview':         'pull-requests',
+    'addPullRequestReviewComment':      'pull-requests',
+    'updatePullRequestReviewComment':   'pull-requests',
+    'deletePullRequestReviewComment':   'pull-requests',
+    'addPullRequestReviewThread':       'pull-requests',
+    'addPullRequestReviewThreadReply':  'pull-requests',
+    'resolveReviewThread':              'pull-requests',
+    'unresolveReviewThread':            'pull-requests',
+    'markFileAsViewed':                 'pull-requests',
+    'unmarkFileAsViewed':               'pull-requests',
+    'createDiscussion':                 'discussions',
+    'updateDiscussion':                 'discussions',
+    'deleteDiscussion':                 'discussions',
+    'closeDiscussion':                  'discussions',
+    'reopenDiscussion':                 'discussions',
+    'addDiscussionComment':             'discussions',
+    'updateDiscussionComment':          'discussions',
+    'deleteDiscussionComment':          'discussions',
+    'markDiscussionCommentAsAnswer':    'discussions',
+    'unmarkDiscussionCommentAsAnswer':  'discussions',
+    'addDiscussionPollVote':            'discussions',
+    'addUpvote':                        'discussions',
+    'removeUpvote':                     'discussions',
+    'createCommitOnBranch':             'contents',
+    'createRef':                        'contents',
+    'updateRef':                        'contents',
+    'updateRefs':                       'contents',
+    'deleteRef':                        'contents',
+    'mergeBranch':                      'contents',
+    'createCheckRun':                   'checks',
+    'updateCheckRun':                   'checks',
+    'createCheckSuite':                 'checks',
+    'rerequestCheckSuite':              'checks',
+    'createProject':                    'repository-projects',
+    'updateProject':                    'repository-projects',
+    'deleteProject':                    'repository-projects',
+    'addProjectColumn':                 'repository-projects',
+    'updateProjectColumn':              'repository-projects',
+    'moveProjectColumn':                'repository-projects',
+    'deleteProjectColumn':              'repository-projects',
+    'addProjectCard':                   'repository-projects',
+    'updateProjectCard':                'repository-projects',
+    'moveProjectCard':                  'repository-projects',
+    'deleteProjectCard':                'repository-projects',
+}
+
+# the fields of the repository query and the permission required to read them, the other fields are metadata
+GRAPHQL_REPOSITORY_FIELDS = {
+    'issue':                'issues',
+    'issues':               'issues',
+    'label':                'issues',
+    'labels':               'issues',
+    'milestone':            'issues',
+    'milestones':           'issues',
+    'issueOrPullRequest':   'issues,pull-requests',
+    'pullRequest':          'pull-requests',
+    'pullRequests':         'pull-requests',
+    'discussion':           'discussions',
+    'discussions':          'discussions',
+    'discussionCategory':   'discussions',
+    'discussionCategories': 'discussions',
+    'pinnedDiscussions':    'discussions',
+    'object':               'contents',
+    'ref':                  'contents',
+    'refs':                 'contents',
+    'defaultBranchRef':     'contents',
+    'release':              'contents',
+    'releases':             'contents',
+    'latestRelease':        'contents',
+    'deployments':          'deployments',
+    'environment':          'actions',
+    'environments':         'actions',
+    'project':              'repository-projects',
+    'projects':             'repository-projects',
+}
+
+# the root query fields that don't require any permission
+GRAPHQL_PUBLIC_FIELDS = {
+    '__typename', '__schema', '__type', 'rateLimit', 'meta',
+    'license', 'licenses', 'codeOfConduct', 'codesOfConduct',
+}
+
+# the root query fields of the repository owners, they are public but the repositories are reachable through them
+GRAPHQL_OWNER_FIELDS = {'viewer', 'user', 'organization', 'repositoryOwner'}
+
+# the documents nested deeper are not classified, the parser and the classification are recursive
+GRAPHQL_MAX_DEPTH = 64
+
+# the most fields searched for the repositories under an owner, the fragment spreads may repeat a subtree many times
+GRAPHQL_MAX_FIELDS = 10000
+
+# the GraphQL types of the global node ids and the permission required to access them, None means no permission
+# An issue comment may belong to an issue or a pull request, the safest bet is to require both
+GRAPHQL_NODE_TYPES = {
+    'Repository':               None,
+    'Issue':                    'issues',
+    'IssueComment':             'issues,pull-requests',
+    'PullRequest':              'pull-requests',
+    'PullRequestReview':        'pull-requests',
+    'PullRequestReviewComment': 'pull-requests',
+    'PullRequestReviewThread':  'pull-requests',
+    'Discussion':               'discussions',
+    'DiscussionComment':        'discussions',
+}
+
+# the prefixes of the node ids in the new format (PR_kwDOABCD...)
+GRAPHQL_NODE_PREFIXES = {
+    'R':    'Repository',
+    'I':    'Issue',
+    'IC':   'IssueComment',
+    'PR':   'PullRequest',
+    'PRR':  'PullRequestReview',
+    'PRRC': 'PullRequestReviewComment',
+    'PRRT': 'PullRequestReviewThread',
+    'D':    'Discussion',
+    'DC':   'DiscussionComment',
+}
+
+GRAPHQL_TOKEN = re.compile(r'''
+    (?P<ignored>[\s,\ufeff]+|\#[^\n\r]*)
+    |(?P<block>"""(?:\\"""|[^"]|"(?!""))*""")
+    |(?P<string>"(?:\\.|[^"\\\n\r])*")
+    |(?P<spread>\.\.\.)
+    |(?P<punctuator>[!$&():=@\[\]{}|])
+    |(?P<name>[_A-Za-z][_0-9A-Za-z]*)
+    |(?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+''', re.VERBOSE)
+
+LEGACY_NODE_ID = re.compile(r'\d+:([A-Za-z]+)\d+')
+
+# get_issue_type result when the lookup is left to the post step
+DEFERRED = 'deferred'
+
+# the GraphQL endpoint on github.com and on GitHub Enterprise Server
+GRAPHQL_PATHS = ('/graphql', '/api/graphql')
+
+# the flow metadata key of the GraphQL requests waiting for their body
+GRAPHQL_METADATA = 'permissions-graphql'
+
+
+def tokenize_graphql(query):
+    tokens = []
+    position = 0
+    while position < len(query):
+        match = GRAPHQL_TOKEN.match(query, position)
+        if not match:
+            raise ValueError('Unexpected character %r at %d' % (query[position], position))
+        if match.lastgroup != 'ignored':
+            tokens.append((match.lastgroup, match.group()))
+        position = match.end()
+    return tokens
+
+
+class GraphQLParser:
+    # A minimal parser of the executable GraphQL documents, it keeps only what the permissions depend on.
+    # A field is (name, arguments, selections), a fragment spread is kept as the fragment name
+    # and resolved when the operation is classified, the inline fragments are merged into the selections.
+    # The argument values are python values, the variables are ('$', name) tuples.
+    def __init__(self, query):
+        self.tokens = tokenize_graphql(query)
+        self.position = 0
+        self.depth = 0
+
+    def enter(self):
+        self.depth += 1
+        if self.depth > GRAPHQL_MAX_DEPTH:
+            raise ValueError('The document is nested deeper than %d levels' % GRAPHQL_MAX_DEPTH)
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise ValueError('Unexpected end of the document')
+        self.position += 1
+        return token
+
+    def expect(self, value):
+        kind, token = self.next()
+        if token != value:
+            raise ValueError('Expected %s, got %s' % (value, token))
+
+    def skip(self, value):
+        if self.peek()[1] == value:
+            self.position += 1
+            return True
+        return False
+
+    def parse(self):
+        # returns the operations as {name: (type, selections)} and the fragments as {name: selections}
+        operations = {}
+        fragments = {}
+        while self.peek()[0] is not None:
+            kind, token = self.peek()
+            if token == '{':
+                operations[None] = ('query', self.selections())
+            elif token == 'fragment':
+                self.next()
+                name = self.next()[1]
+                self.expect('on')
+                self.next()
+                self.directives()
+                fragments[name] = self.selections()
+            elif token in ('query', 'mutation', 'subscription'):
+                self.next()
+                name = self.next()[1] if self.peek()[0] == 'name' else None
+                if self.peek()[1] == '(':
+                    self.variable_definitions()
+                self.directives()
+                operations[name] = (token, self.selections())
+            else:
+                raise ValueError('Unexpected %s' % token)
+        return operations, fragments
+
+    def variable_definitions(self):
+        # the types and the default values don't matter, skip to the matching parenthesis
+        depth = 0
+        while True:
+            token = self.next()[1]
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def directives(self):
+        while self.skip('@'):
+            self.next()
+            self.arguments()
+
+    def arguments(self):
+        arguments = {}
+        if self.skip('('):
+            while not self.skip(')'):
+                name = self.next()[1]
+                self.expect(':')
+                arguments[name] = self.value()
+        return arguments
+
+    def value(self):
+        kind, token = self.next()
+        if token == '$':
+            return ('$', self.next()[1])
+        elif token == '[':
+            self.enter()
+            values = []
+            while not self.skip(']'):
+                values.append(self.value())
+            self.depth -= 1
+            return values
+        elif token == '{':
+            self.enter()
+            values = {}
+            while not self.skip('}'):
+                name = self.next()[1]
+                self.expect(':')
+                values[name] = self.value()
+            self.depth -= 1
+            return values
+        elif kind == 'string':
+            try:
+                return json.loads(token)
+            except ValueError:
+                return token[1:-1]
+        elif kind == 'block':
+            return token[3:-3]
+        elif kind == 'name':
+            return {'true': True, 'false': False, 'null': None}.get(token, token)
+        elif kind == 'number':
+            return token
+        raise ValueError('Unexpected %s' % token)
+
+    def selections(self):
+        selections = []
+        self.expect('{')
+        self.enter()
+        while not self.skip('}'):
+            if self.skip('...'):
+                if self.peek()[1] in ('on', '@', '{'):
+                    if self.skip('on'):
+                        self.next()
+                    self.directives()
+                    selections.extend(self.selections())
+                else:
+                    selections.append(self.next()[1])
+                    self.directives()
+                continue
+
+            name = self.next()[1]
+            if self.skip(':'):
+                # an alias
+                name = self.next()[1]
+            arguments = self.arguments()
+            self.directives()
+            children = self.selections() if self.peek()[1] == '{' else []
+            selections.append((name, arguments, children))
+        self.depth -= 1
+        return selections
+
+
+def parse_graphql(query):
+    return GraphQLParser(query).parse()
+
+
+def expand_fields(selections, fragments, seen=()):
+    # the fields of the selections with the fragment spreads resolved
+    for selection in selections:
+        if isinstance(selection, str):
+            if selection in fragments and selection not in seen and len(seen) < GRAPHQL_MAX_DEPTH:
+                yield from expand_fields(fragments[selection], fragments, seen + (selection,))
         else:
-            return False
+            yield selection
+
+
+def resolve_variables(value, variables):
+    if isinstance(value, tuple):
+        return variables.get(value[1])
+    elif isinstance(value, list):
+        return [resolve_variables(v, variables) for v in value]
+    elif isinstance(value, dict):
+        return {k: resolve_variables(v, variables) for k, v in value.items()}
+    return value
+
+
+def node_ids(arguments):
+    # the node ids in the (resolved) arguments of a field: id, subjectId, labelableId, etc.
+    for name, value in arguments.items():
+        if isinstance(value, str) and (name == 'id' or name.endswith('Id')):
+            yield value
+        elif isinstance(value, dict):
+            yield from node_ids(value)
 
+
+def legacy_node_id(type, id):
+    return base64.b64encode(('0%d:%s%s' % (len(type), type, id)).encode()).decode()
+
+
+def node_type(id):
+    # returns the GraphQL type of the node id or None if it is unknown
+    # Both the new (PR_kwDOABCD...) and the legacy (base64 of 011:PullRequest1) formats are supported
+    prefix, separator, _ = id.partition('_')
+    if separator:
+        return GRAPHQL_NODE_PREFIXES.get(prefix)
+
+    try:
+        match = LEGACY_NODE_ID.fullmatch(base64.b64decode(id, validate=True).decode())
+    except ValueError:
+        return None
+    return match.group(1) if match else None
+
+
+def token_fingerprints(token):
+    # The authorization header values carrying the token in the common forms, with the scheme in the lower case:
+    # the Bearer and token schemes of the API clients and the basic authentication of git (actions/checkout).
+    token = token.encode()
+    return [b'bearer ' + token, b'token ' + token, b'basic ' + base64.b64encode(b'x-access-token:' + token)]
+
+
+class Memo:
+    # a bounded LRU of the resolved routes by (method, path template) and of the parsed GraphQL documents by the query hash
+    # the results are the same for all the requests with the same key, the network lookups they may need are not memoized
+    MISSING = object()
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.routes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        route = self.routes.get(key, self.MISSING)
+        if route is self.MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.routes.move_to_end(key)
+        return route
+
+    def set(self, key, route):
+        self.routes[key] = route
+        if len(self.routes) > self.max_size:
+            self.routes.popitem(last=False)
+
+
+class PermissionSummary:
+    # a running deduplicated aggregate of the recorded calls for the post step:
+    # the maximum permission per kind, the number of calls per endpoint and a capped sample of the unknown calls
+    def __init__(self, max_unknown=100, max_calls=1000):
+        self.max_unknown = max_unknown
+        self.max_calls = max_calls
+        self.permissions = {}
+        self.calls = {}
+        # the calls of the endpoints beyond max_calls
+        self.calls_overflow = 0
+        self.unknown = []
+        self.unknown_count = 0
+        # (kind, permission, lookup) -> count of the calls whose permission depends on a lookup made by the post step
+        self.deferred = {}
+        self.dirty = False
+
+    def add(self, permissions, method, host, path, template=None):
+        # the calls are counted by the route they matched, the paths without a route by their template
+        key = (method, host, template or path_template(path))
+        if key in self.calls:
+            self.calls[key] += 1
+        elif len(self.calls) < self.max_calls:
+            self.calls[key] = 1
+        else:
+            self.calls_overflow += 1
+        for kind, permission, *lookup in permissions:
+            if lookup:
+                key = (kind, permission, lookup[0])
+                self.deferred[key] = self.deferred.get(key, 0) + 1
+            elif kind == 'unknown':
+                self.unknown_count += 1
+                if len(self.unknown) < self.max_unknown:
+                    self.unknown.append({'method': method, 'host': host, 'path': path})
+            elif self.permissions.get(kind) != 'write':
+                self.permissions[kind] = permission
+        self.dirty = True
+
+    def to_json(self):
+        return {
+            'permissions': self.permissions,
+            'calls': [{'method': method, 'host': host, 'path': template, 'count': count} for (method, host, template), count in self.calls.items()],
+            'calls_overflow': self.calls_overflow,
+            'unknown': self.unknown,
+            'unknown_count': self.unknown_count,
+            'deferred': [{'kind': kind, 'permission': permission, 'lookup': lookup[0], 'repo': lookup[1], 'number': lookup[2] if len(lookup) > 2 else None, 'count': count}
+                         for (kind, permission, lookup), count in self.deferred.items()],
+        }
+
+    def save(self, path):
+        if not path or not self.dirty:
+            return
+
+        summary = self.to_json()
+        # write to a temporary file first, so the post step never sees a partially written summary
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w') as f:
+            json.dump(summary, f)
+        os.replace(tmp, path)
+        self.dirty = False
+
+
+class Histogram:
+    # latency histogram with power of two buckets in microseconds
     def __init__(self):
-        self.ip_map = {}
-        self.dns_map = {}
-        self.repo_map = {}
-
-        self.methods_map = {
-            'GET':      HTTP.GET,
-            'POST':     HTTP.POST,
-            'PUT':      HTTP.PUT,
-            'DELETE':   HTTP.DELETE,
-            'PATCH':    HTTP.PATCH
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        bucket = 1 << max(int(seconds * 1000000), 1).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, p):
+        # the upper bound of the bucket in milliseconds
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= self.count * p / 100:
+                return bucket / 1000
+        return 0
+
+    def to_json(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total * 1000,
+            'max_ms': self.max * 1000,
+            'p50_ms': self.percentile(50),
+            'p99_ms': self.percentile(99),
+            'buckets_us': {str(bucket): count for bucket, count in sorted(self.buckets.items())},
         }
 
-        # a map of tricky permissions, that do not fall into a pattern of (GET|POST|etc) /repos/{owner}/{repo}/{what}/{id} -> {what, permission}
-        map = {
-            ('GET',     '/repos/{owner}/{repo}/codeowners/errors',                                  'contents',                 'read'),
-            ('GET',     '/repositories/{id}/codeowners/errors',                                     'contents',                 'read'),
-            ('PUT',     '/repos/{owner}/{repo}/pulls/{pull_number}/merge',                          'contents',                 'write'),
-            ('PUT',     '/repositories/{id}/pulls/{pull_number}/merge',                             'contents',                 'write'),
-            ('PUT',     '/repos/{owner}/{repo}/pulls/{pull_number}/update-branch',                  'contents',                 'write'),
-            ('PUT',     '/repositories/{id}/pulls/{pull_number}/update-branch',                     'contents',                 'write'),
-            ('POST',    '/repos/{owner}/{repo}/comments/{comment_id}/reactions',                    'contents',                 'write'),
-            ('POST',    '/repositories/{id}/comments/{comment_id}/reactions',                       'contents',                 'write'),
-            ('DELETE',  '/repos/{owner}/{repo}/comments/{comment_id}/reactions/{reaction_id}',      'contents',                 'write'),
-            ('DELETE',  '/repositories/{id}/comments/{comment_id}/reactions/{reaction_id}',         'contents',                 'write'),
-            ('GET',     '/repos/{owner}/{repo}/branches',                                           'contents',                 'read'),
-            ('GET',     '/repositories/{id}/branches',                                              'contents',                 'read'),
-
-            ('POST',    '/repos/{owner}/{repo}/merge-upstream',                                     'contents',                 'write'),
-            ('POST',    '/repositories/{id}/merge-upstream',                                        'contents',                 'write'),
-            ('POST',    '/repos/{owner}/{repo}/merges',                                             'contents',                 'write'),
-            ('POST',    '/repositories/{id}/merges',                                                'contents',                 'write'),
-            ('PATCH',   '/repos/{owner}/{repo}/comments/{comment_id}',                              'contents',                 'write'),
-            ('PATCH',   '/repositories/{id}/comments/{comment_id}',                                 'contents',                 'write'),
-            ('DELETE',  '/repos/{owner}/{repo}/comments/{comment_id}',                              'contents',                 'write'),
-            ('DELETE',  '/repositories/{id}/comments/{comment_id}',                                 'contents',                 'write'),
-            ('POST',    '/repos/{owner}/{repo}/dispatches',                                         'contents',                 'write'),
-            ('POST',    '/repositories/{id}/dispatches',                                            'contents',                 'write'),
-
-            ('POST',    '/repos/{owner}/{repo}/issues/{issue_number}/assignees',                    'issues/pull-requests',     'write'),
-            ('POST',    '/repositories/{id}/issues/{issue_number}/assignees',                       'issues/pull-requests',     'write'),
-            ('DELETE',  '/repos/{owner}/{repo}/issues/{issue_number}/assignees',                    'issues/pull-requests',     'write'),
-            ('DELETE',  '/repositories/{id}/issues/{issue_number}/assignees',                       'issues/pull-requests',     'write'),
-            ('GET',     '/repos/{owner}/{repo}/issues/{issue_number}/comments',                     'issues/pull-requests',     'read'),
-            ('GET',     '/repositories/{id}/issues/{issue_number}/comments',                        'issues/pull-requests',     'read'),
-            ('POST',    '/repos/{owner}/{repo}/issues/{issue_number}/comments',                     'issues/pull-requests',     'write'),
-            ('POST',    '/repositories/{id}/issues/{issue_number}/comments',                        'issues/pull-requests',     'write'),
-            ('GET',     '/repos/{owner}/{repo}/issues/comments',                                    'issues,pull-requests',     'read'),
-            ('GET',     '/repositories/{id}/issues/comments',                                       'issues,pull-requests',     'read'),
-            ('GET',     '/repos/{owner}/{repo}/issues/comments/{comment_id}',                       'issues/pull-requests',     'read'),
-            ('GET',     '/repositories/{id}/issues/comments/{comment_id}',                          'issues/pull-requests',     'read'),
-            ('PATCH',   '/repos/{owner}/{repo}/issues/comments/{comment_id}',                       'issues/pull-requests',     'write'),
-            ('PATCH',   '/repositories/{id}/issues/comments/{comment_id}',                          'issues/pull-requests',     'write'),
-            ('DELETE',  '/repos/{owner}/{repo}/issues/comments/{comment_id}',                       'issues/pull-requests',     'write'),
-            ('DELETE',  '/repositories/{id}/issues/comments/{comment_id}',                          'issues/pull-requests',     'write'),
-            ('GET',     '/repos/{owner}/{repo}/issues/{issue_number}/events',                       'issues/pull-requests',     'read'),
-            ('GET',     '/repositories/{id}/issues/{issue_number}/events',                          'issues/pull-requests',     'read'),
-            ('GET',     '/repos/{owner}/{repo}/issues/events',                                      'issues,pull-requests',     'read'),
-            ('GET',     '/repositories/{id}/issues/events',                                         'issues,pull-requests',     'read'),
-            ('GET',     '/repos/{owner}/{repo}/issues/events/{event_id}',                           'issues/pull-requests',     'read'),
-            ('GET',     '/repositories/{id}/issues/events/{event_id}',                              'issues/pull-requests',     'read'),
-            ('GET',     '/repos/{owner}/{repo}/issues/{issue_number}/timeline',                     'issues/pull-requests',     'read'),
-            ('GET',     '/repositories/{id}/issues/{issue_number}/timeline',                        'issues/pull-requests',     'read'),
-            ('GET',     '/repos/{owner}/{repo}/assignees',                                          'issues,pull-requests',     'read'),
-            ('GET',     '/repositories/{id}/assignees',                                             'issues,pull-requests',     'read'),
-            ('GET',     '/repos/{owner}/{repo}/issues',                                             'issues,pull-requests',     'read'),
-            ('GET',     '/repositories/{id}/issues',                                                'issues,pull-requests',     'read'),
-            ('POST',    '/repos/{owner}/{repo}/issues',                                             'issues',                   'write'),
-            ('POST',    '/repositories/{id}/issues',                                                'issues',                   'write'),
-            ('GET',     '/repos/{owner}/{repo}/issues/{issue_number}',                              'issues/pull-requests',     'read'),
-            ('GET',     '/repositories/{id}/issues/{issue_number}',                                 'issues/pull-requests',     'read'),
-            ('PATCH',   '/repos/{owner}/{repo}/issues/{issue_number}',                              'issues/pull-requests',     'write'),
-            ('PATCH',   '/repositories/{id}/issues/{issue_number}',                                 'issues/pull-requests',     'write'),
-            ('PUT',     '/repos/{owner}/{repo}/issues/{issue_number}/lock',                         'issues/pull-requests',     'write'),
-            ('PUT',     '/repositories/{id}/issues/{issue_number}/lock',                            'issues/pull-requests',     'write'),
-            ('DELETE',  '/repos/{owner}/{repo}/issues/{issue_number}/lock',                         'issues/pull-requests',     'write'),
-            ('DELETE',  '/repositories/{id}/issues/{issue_number}/lock',                            'issues/pull-requests',     'write'),
-            ('GET',     '/repos/{owner}/{repo}/issues/{issue_number}/labels',                       'issues/pull-requests',     'read'),
-            ('GET',     '/repositories/{id}/issues/{issue_number}/labels',                          'issues/pull-requests',     'read'),
-            ('POST',    '/repos/{owner}/{repo}/issues/{issue_number}/labels',                       'issues/pull-requests',     'write'),
-            ('POST',    '/repositories/{id}/issues/{issue_number}/labels',                          'issues/pull-requests',     'write'),
-            ('PUT',     '/repos/{owner}/{repo}/issues/{issue_number}/labels',                       'issues/pull-requests',     'write'),
-            ('PUT',     '/repositories/{id}/issues/{issue_number}/labels',                          'issues/pull-requests',     'write'),
-            ('DELETE',  '/repos/{owner}/{repo}/issues/{issue_number}/labels',                       'issues/pull-requests',     'write'),
-            ('DELETE',  '/repositories/{id}/issues/{issue_number}/labels',                          'issues/pull-requests',     'write'),
-            ('GET',     '/repos/{owner}/{repo}/labels',                                             'issues',                   'read'),
-            ('GET',     '/repositories/{id}/labels',                                                'issues',                   'read'),
-            ('POST',    '/repos/{owner}/{repo}/labels',                                             'issues',                   'write'),
-            ('POST',    '/repositories/{id}/labels',                                                'issues',                   'write'),
-            ('GET',     '/repos/{owner}/{repo}/milestones/{milestone_number}/labels',               'issues',                   'read'),
-            ('GET',     '/repositories/{id}/milestones/{milestone_number}/labels',                  'issues',                   'read'),
-            ('GET',     '/repos/{owner}/{repo}/milestones',                                         'issues',                   'read'),
-            ('GET',     '/repositories/{id}/milestones',                                            'issues',                   'read'),
-            ('POST',    '/repos/{owner}/{repo}/milestones',                                         'issues',                   'write'),
-            ('POST',    '/repositories/{id}/milestones',                                            'issues',                   'write'),
-            ('GET',     '/repos/{owner}/{repo}/milestones/{milestone_number}',                      'issues',                   'read'),
-            ('GET',     '/repositories/{id}/milestones/{milestone_number}',                         'issues',                   'read'),
-            ('PATCH',   '/repos/{owner}/{repo}/milestones/{milestone_number}',                      'issues',                   'write'),
-            ('PATCH',   '/repositories/{id}/milestones/{milestone_number}',                         'issues',                   'write'),
-            ('DELETE',  '/repos/{owner}/{repo}/milestones/{milestone_number}',                      'issues',                   'write'),
-            ('DELETE',  '/repositories/{id}/milestones/{milestone_number}',                         'issues',                   'write'),
-            ('GET',     '/repos/{owner}/{repo}/issues/{issue_number}/reactions',                    'issues/pull-requests',     'read'),
-            ('GET',     '/repositories/{id}/issues/{issue_number}/reactions',                       'issues/pull-requests',     'read'),
-            ('POST',    '/repos/{owner}/{repo}/issues/{issue_number}/reactions',                    'issues/pull-requests',     'write'),
-            ('POST',    '/repositories/{id}/issues/{issue_number}/reactions',                       'issues/pull-requests',     'write'),
-            ('DELETE',  '/repos/{owner}/{repo}/issues/{issue_number}/reactions/{reaction_id}',      'issues/pull-requests',     'write'),
-            ('DELETE',  '/repositories/{id}/issues/{issue_number}/reactions/{reaction_id}',         'issues/pull-requests',     'write'),
-            ('GET',     '/repos/{owner}/{repo}/issues/comments/{comment_id}/reactions',             'issues/pull-requests',     'read'),
-            ('GET',     '/repositories/{id}/issues/comments/{comment_id}/reactions',                'issues/pull-requests',     'read'),
-            ('POST',    '/repos/{owner}/{repo}/issues/comments/{comment_id}/reactions',             'issues/pull-requests',     'write'),
-            ('POST',    '/repositories/{id}/issues/comments/{comment_id}/reactions',                'issues/pull-requests',     'write'),
-            ('DELETE',  '/repos/{owner}/{repo}/issues/comments/{comment_id}/reactions',             'issues/pull-requests',     'write'),
-            ('DELETE',  '/repositories/{id}/issues/comments/{comment_id}/reactions',                'issues/pull-requests',     'write'),
-            ('DELETE',  '/repos/{owner}/{repo}/issues/{issue_number}/labels/{name}',                'issues/pull-requests',     'write'),
-            ('DELETE',  '/repositories/{id}/issues/{issue_number}/labels/{name}',                   'issues/pull-requests',     'write'),
-            ('GET',     '/repos/{owner}/{repo}/labels/{name}',                                      'issues',                   'read'),
-            ('GET',     '/repositories/{id}/labels/{name}',                                         'issues',                   'read'),
-            ('PATCH',   '/repos/{owner}/{repo}/labels/{name}',                                      'issues',                   'write'),
-            ('PATCH',   '/repositories/{id}/labels/{name}',                                         'issues',                   'write'),
-            ('DELETE',  '/repos/{owner}/{repo}/labels/{name}',                                      'issues',                   'write'),
-            ('DELETE',  '/repositories/{id}/labels/{name}',                                         'issues',                   'write'),
+
+class Metrics:
+    # the cost of the monitor itself: latency histograms and counters, saved as JSON for the post step
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if not histogram:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def save(self, path, counters):
+        # the counters kept by the other components are passed in at the time of saving
+        if not path:
+            return
+
+        metrics = {
+            'histograms': {name: histogram.to_json() for name, histogram in self.histograms.items()},
+            'counters': {**self.counters, **counters},
         }
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w') as f:
+            json.dump(metrics, f)
+        os.replace(tmp, path)
+
+
+class EnrichmentCache:
+    # a disk backed LRU cache of enrichment lookups (repository visibility, issue vs pull request)
+    # the file may be saved and restored between the jobs and runs, so every entry keeps the time it was stored
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.path = ''
+        self.ttl = 0
+        self.max_size = 0
+        self.dirty = False
+
+    def load(self, path, ttl, max_size):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+
+        now = time.time()
+        # the entries are stored from the least to the most recently used
+        for key, value, stored in data.get('entries', []):
+            if now - stored < self.ttl:
+                self.entries[key] = (value, stored)
+        self.evict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        if time.time() - entry[1] >= self.ttl:
+            del self.entries[key]
+            self.dirty = True
+            return None
+
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    async def fetch(self, key):
+        # looks up an entry missing in memory, only the shared cache may have it
+        return None
+
+    def set(self, key, value):
+        self.entries[key] = (value, time.time())
+        self.entries.move_to_end(key)
+        self.evict()
+        self.dirty = True
+
+    def evict(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+
+        # write to a temporary file first, so a concurrent reader never sees a partially written cache
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as f:
+            json.dump({'entries': [[key, value, stored] for key, (value, stored) in self.entries.items()]}, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+
+class SharedEnrichmentCache(EnrichmentCache):
+    # The enrichment cache shared by the proxy workers: the entries are kept in a SQLite database in WAL mode,
+    # so a lookup made by one worker is not repeated by the others. The in-memory entries are the worker's own LRU in front of it.
+    # The file restored from the previous runs is imported into the database and the database is exported back to it on save.
+    # The database is used from a thread of its own, the event loop doesn't wait for the disk:
+    # the entries missing in memory are fetched from it and the new entries are written in batches.
+    def __init__(self, database):
+        super().__init__()
+        self.database = database
+        self.connection = None
+        # the connection is used by this thread only, in the order of the submitted operations
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='enrichment-cache')
+        # the entries set since the last batch was submitted
+        self.unwritten = []
+
+    def load(self, path, ttl, max_size):
+        super().load(path, ttl, max_size)
+        rows = [(key, json.dumps(value), stored) for key, (value, stored) in self.entries.items()]
+        # at the start, before the proxy handles any flow
+        self.executor.submit(self.open, ttl, rows).result()
+
+    def open(self, ttl, rows):
+        if self.connection:
+            self.connection.close()
+        # autocommit, every batch is visible to the other workers as soon as it is written
+        self.connection = sqlite3.connect(self.database, timeout=5, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, stored REAL)')
+        self.connection.execute('DELETE FROM entries WHERE stored <= ?', (time.time() - ttl,))
+        self.connection.executemany('INSERT OR IGNORE INTO entries VALUES (?, ?, ?)', rows)
+
+    async def fetch(self, key):
+        if not self.connection:
+            return None
+
+        row = await asyncio.get_running_loop().run_in_executor(self.executor, self.select, key)
+        if row is None or time.time() - row[1] >= self.ttl:
+            return None
+
+        value = json.loads(row[0])
+        self.entries[key] = (value, row[1])
+        self.evict()
+        return value
+
+    def select(self, key):
+        return self.connection.execute('SELECT value, stored FROM entries WHERE key = ?', (key,)).fetchone()
+
+    def set(self, key, value):
+        super().set(key, value)
+        if not self.connection:
+            return
+
+        self.unwritten.append((key, json.dumps(value), time.time()))
+        if len(self.unwritten) == 1:
+            # the entries set by the other flows in the same event loop iteration go in the same transaction
+            asyncio.get_running_loop().call_soon(self.write)
+
+    def write(self):
+        if self.unwritten:
+            # best effort, an entry not written is looked up again by the other workers
+            self.executor.submit(self.insert, self.unwritten)
+            self.unwritten = []
+
+    def insert(self, rows):
+        self.connection.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)', rows)
+
+    def save(self):
+        if not self.path or not self.connection:
+            return
+
+        # the export waits for the batches submitted before it
+        self.write()
+        rows = self.executor.submit(self.export).result()
+        # the workers save at the same time, each one writes its own temporary file
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'entries': [[key, json.loads(value), stored] for key, value, stored in reversed(rows)]}, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def export(self):
+        # every worker exports the same entries, the most recently stored ones up to the maximum size
+        return self.connection.execute(
+            'SELECT key, value, stored FROM entries WHERE stored > ? ORDER BY stored DESC LIMIT ?',
+            (time.time() - self.ttl, self.max_size)).fetchall()
+
+
+class RateLimiter:
+    # a token bucket sized by the remaining GitHub API quota of the token, refilled from the rate limit headers
+    # the monitor shares the quota with the job itself, so a part of it is always kept in reserve for the job
+    def __init__(self, rate=1.0, burst=20, reserve=100, max_wait=5.0):
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # returns False if the request shouldn't be made, because the quota is exhausted or the wait is too long
+        if time.monotonic() < self.blocked_until:
+            return False
+
+        self.refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return True
+
+        if self.rate <= 0 or -self.tokens / self.rate > self.max_wait:
+            self.tokens += 1
+            return False
+
+        await asyncio.sleep(-self.tokens / self.rate)
+        return True
+
+    def update(self, response):
+        headers = response.headers
+        now = time.monotonic()
 
+        # secondary rate limits
+        retry_after = headers.get('Retry-After')
+        if retry_after and response.status_code in (403, 429):
+            delay = self.retry_delay(retry_after)
+            if delay is not None:
+                self.blocked_until = now + delay
+                return
+
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+
+        window = max(int(reset) - time.time(), 1)
+        available = int(remaining) - self.reserve
+        self.refill()
+        if available <= 0:
+            self.rate = 0
+            self.tokens = min(self.tokens, 0)
+            self.blocked_until = now + window
+        else:
+            # the quota reported by GitHub is authoritative, it includes the calls made by the job itself
+            # but it doesn't refill the bucket, the tokens spent since are still spent
+            self.burst = available
+            self.tokens = min(self.tokens, available)
+            self.rate = available / window
+
+    @staticmethod
+    def retry_delay(retry_after):
+        # Retry-After is either a number of seconds or an HTTP date, the values that are neither are ignored
+        try:
+            return max(int(retry_after), 0)
+        except ValueError:
+            pass
         try:
-            # build an optimized tree for faster lookup from the map
-            self.rest_api_map = {}
-            for entry in map:
-                path_segments = entry[1].split('/')
-                node = self.rest_api_map
-                for segment in path_segments[1:]:
-                    # we keep {milestone_number}, {issue_number} and etc. just for readability
-                    # for mapping any path segment we use special character '*'
-                    if segment.startswith('{'):
-                        segment = '*'
-
-                    next_node = node.get(segment)
-                    if not next_node:
-                        next_node = {}
-                        node[segment] = next_node
-
-                    node = next_node
+            return max(email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
 
-                # Every pull request is an issue, but not every issue is a pull request.
-                # issues/pull-requests is a special case, we need to check if the issue is a pull request
-                # The check depends on the available information from the request
-                # To identify the type of check we append the id to the permission type
-                type = entry[2]
-                if type == 'issues/pull-requests':
-                    if path_segments[1] == 'repos':
-                        if path_segments[5] == '{issue_number}':
-                            type += '/issue_number'
-                        elif path_segments[6] == '{comment_id}':
-                            type += '/comment_id'
-                        elif path_segments[6] == '{event_id}':
-                            type += '/event_id'
-                    elif path_segments[1] == 'repositories':
-                        if path_segments[4] == '{issue_number}':
-                            type += '/issue_number'
-                        elif path_segments[5] == '{comment_id}':
-                            type += '/comment_id'
-                        elif path_segments[5] == '{event_id}':
-                            type += '/event_id'
-
-                # A tree node may contain the link to the next node if the lookup path is long enough
-                # or a link to the HTTP method type (GET, POST, etc.) node with the permission type
-                # Here is the trick: the HTTP method type is enum/integer while next path segment is string
-                # We use both types as keys in the same dictionary
-                # It prevents from unlikely collision if the next path segment name was the same as the HTTP method type
-                node[self.methods_map[entry[0]]] = (type, entry[3])
+
+class GitHubClient:
+    # a shared client for the GitHub API lookups:
+    # keeps the connections alive and respects the rate limits
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10, keepalive_expiry=60),
+            timeout=httpx.Timeout(10.0))
+        self.limiter = RateLimiter()
+        # the GraphQL API has its own rate limit
+        self.graphql_limiter = RateLimiter()
+        self.token = ''
+        # url -> the future of the request in flight, concurrent lookups of the same url are coalesced
+        self.pending = {}
+
+    def configure(self, token):
+        self.token = token
+
+    async def get(self, url):
+        # returns the response or None if the request couldn't be made because of the rate limits
+        future = self.pending.get(url)
+        if future:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # the task making the request was cancelled, not this one, make it again
+                if not future.cancelled() or asyncio.current_task().cancelling():
+                    raise
+            return await self.get(url)
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[url] = future
+        try:
+            response = await self.fetch(url)
+            future.set_result(response)
+            return response
+        except Exception as e:
+            future.set_exception(e)
+            # mark the exception as retrieved if nobody else was waiting for it
+            future.exception()
+            raise
+        finally:
+            # the task was cancelled, don't leave the waiters hanging
+            if not future.done():
+                future.cancel()
+            del self.pending[url]
+
+    async def fetch(self, url):
+        if not await self.limiter.acquire():
+            self.metrics.count('github_api_rate_limited')
+            return None
+
+        headers = {
+            'Authorization': 'Bearer %s' % self.token,
+            'Accept': 'application/vnd.github+json',
+            'X-GitHub-Api-Version': '2022-11-28',
+        }
+
+        started = time.perf_counter()
+        try:
+            response = await self.client.get(url, headers=headers)
+        finally:
+            self.metrics.observe('github_api', time.perf_counter() - started)
+        self.limiter.update(response)
+        return response
+
+    async def query(self, url, query):
+        # returns the GraphQL response or None if the request couldn't be made because of the rate limits
+        if not await self.graphql_limiter.acquire():
+            self.metrics.count('github_api_rate_limited')
+            return None
+
+        started = time.perf_counter()
+        try:
+            response = await self.client.post(url, json={'query': query}, headers={'Authorization': 'Bearer %s' % self.token})
+        finally:
+            self.metrics.observe('github_api', time.perf_counter() - started)
+        self.graphql_limiter.update(response)
+        return response
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class IssueTypeBatcher:
+    # Coalesces the issue vs pull request lookups of a repository made within a short window into a single GraphQL query,
+    # a job commenting on 50 pull requests makes one lookup instead of 50.
+    # The issue numbers are looked up with the aliased issueOrPullRequest fields of the repository
+    # and the comment ids with the legacy global node ids of the issue comments.
+    def __init__(self, github, window=0.02, max_size=100):
+        self.github = github
+        self.window = window
+        self.max_size = max_size
+        self.url = ''
+        # repo -> {(id, number): future} of the batch being collected
+        self.pending = {}
+        self.tasks = set()
+
+    def configure(self, api_url):
+        # https://api.github.com/graphql or https://HOST/api/graphql for GitHub Enterprise Server (https://HOST/api/v3)
+        api_url = api_url.rstrip('/')
+        if api_url.endswith('/api/v3'):
+            self.url = api_url[:-len('/v3')] + '/graphql'
+        else:
+            self.url = api_url + '/graphql'
+
+    async def resolve(self, id, repo, number):
+        # returns 'pull-requests', 'issues' or None if it couldn't be determined
+        repo = repo.lower()
+        batch = self.pending.get(repo)
+        if batch is None:
+            batch = self.pending[repo] = {}
+            task = asyncio.create_task(self.send(repo, batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        future = batch.get((id, number))
+        if future is None:
+            future = batch[(id, number)] = asyncio.get_running_loop().create_future()
+            if len(batch) >= self.max_size:
+                # the batch is full, the next lookups start a new one
+                del self.pending[repo]
+        return await asyncio.shield(future)
+
+    async def send(self, repo, batch):
+        await asyncio.sleep(self.window)
+        if self.pending.get(repo) is batch:
+            del self.pending[repo]
+
+        self.github.metrics.count('issue_batches')
+        self.github.metrics.count('issue_batch_lookups', len(batch))
+        keys = list(batch)
+        try:
+            response = await self.github.query(self.url, issue_type_query(repo, keys))
+            types = issue_types(response, keys)
+        except Exception:
+            # the lookups fall back to the REST API one by one
+            self.github.metrics.count('issue_batch_errors')
+            types = [None] * len(keys)
+
+        for key, type in zip(keys, types):
+            batch[key].set_result(type)
+
+
+def issue_type_query(repo, keys):
+    # the aliases are the positions of the keys
+    numbers = []
+    fields = []
+    for i, (id, number) in enumerate(keys):
+        if id == 'issue_number':
+            numbers.append('i%d: issueOrPullRequest(number: %s) { __typename }' % (i, number))
+        else:
+            fields.append('c%d: node(id: "%s") { ... on IssueComment { pullRequest { number } } }' % (i, legacy_node_id('IssueComment', number)))
+
+    if numbers:
+        if '/' in repo:
+            owner, name = repo.split('/', 1)
+            fields.append('repository(owner: %s, name: %s) { %s }' % (json.dumps(owner), json.dumps(name), ' '.join(numbers)))
+        else:
+            fields.append('repository: node(id: "%s") { ... on Repository { %s } }' % (legacy_node_id('Repository', repo), ' '.join(numbers)))
+    return 'query { %s }' % ' '.join(fields)
+
+
+def issue_types(response, keys):
+    # the answers of issue_type_query in the order of the keys, None if the type couldn't be determined
+    if response is None or response.status_code != 200:
+        return [None] * len(keys)
+
+    data = response.json().get('data') or {}
+    repository = data.get('repository')
+    types = []
+    for i, (id, number) in enumerate(keys):
+        if id == 'issue_number':
+            node = (repository or {}).get('i%d' % i)
+            if node is None:
+                # a missing issue or an error, the REST API lookup tells them apart
+                types.append(None)
+            else:
+                types.append('pull-requests' if node['__typename'] == 'PullRequest' else 'issues')
+        else:
+            node = data.get('c%d' % i)
+            if node is None:
+                types.append(None)
+            else:
+                types.append('pull-requests' if node.get('pullRequest') else 'issues')
+    return types
+
+
+class HostResolver:
+    # in case of transparent proxy, host name is not available, so we keep a map of ip -> host for the monitored hosts
+    # All the A and AAAA records are kept, the load balancers may return different addresses over time,
+    # so the known addresses are refreshed in the background and on demand when an unknown address shows up.
+    # The on demand refreshes are rate limited and the unrelated addresses are remembered for a while.
+    def __init__(self, ttl=60, min_interval=5, negative_ttl=300):
+        self.ttl = ttl
+        self.min_interval = min_interval
+        self.negative_ttl = negative_ttl
+        self.hosts = []
+        self.ip_map = {}
+        # ip -> the time it is considered unrelated until
+        self.negative = {}
+        self.refreshed = 0
+        self.refreshing = None
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.refreshes = 0
+
+    def configure(self, hosts):
+        self.hosts = hosts
+
+    async def lookup(self, host):
+        # returns all the addresses of the host
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        return {info[4][0] for info in infos}
+
+    async def refresh(self):
+        # concurrent refreshes are coalesced
+        if not self.refreshing:
+            self.refreshing = asyncio.create_task(self.lookup_all())
+        try:
+            await asyncio.shield(self.refreshing)
+        finally:
+            self.refreshing = None
+
+    async def lookup_all(self):
+        self.refreshes += 1
+        self.refreshed = time.monotonic()
+        results = await asyncio.gather(*[self.lookup(host) for host in self.hosts], return_exceptions=True)
+        for host, addresses in zip(self.hosts, results):
+            if isinstance(addresses, Exception):
+                # keep the addresses known so far
+                continue
+            for ip in addresses:
+                self.ip_map[ip] = host
+                self.negative.pop(ip, None)
+
+    async def refresh_periodically(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            await self.refresh()
+
+    async def resolve(self, ip):
+        # returns the monitored host name of the address or None
+        host = self.ip_map.get(ip)
+        if host:
+            self.hits += 1
+            return host
+
+        now = time.monotonic()
+        if self.negative.get(ip, 0) > now:
+            self.negative_hits += 1
+            return None
+
+        self.misses += 1
+        # we hit a load balancer, let's try to refresh the known ips
+        if self.refreshing or now - self.refreshed >= self.min_interval:
+            await self.refresh()
+            host = self.ip_map.get(ip)
+            if host:
+                return host
+
+        self.negative[ip] = now + self.negative_ttl
+        return None
+
+
+class BufferedWriter:
+    # a long-lived append-only file handle that batches the lines
+    # the lines are written out when the batch is big enough, when it is older than the interval or on flush
+    def __init__(self, path, max_lines=100, interval=1.0):
+        self.path = path
+        self.max_lines = max_lines
+        self.interval = interval
+        self.lines = []
+        self.flushed = time.monotonic()
+        self.file = open(path, 'a')
+
+    def write(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.max_lines or time.monotonic() - self.flushed >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.file.write(''.join(self.lines))
+            self.lines = []
+        self.file.flush()
+        self.flushed = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class BackgroundLog:
+    # The debug and error messages, written out by a background thread so the event loop doesn't wait for the disk.
+    # The debug messages are kept in a ring buffer of buffer_size bytes until the thread writes them,
+    # if it falls behind the oldest ones are dropped and a note of how many is written instead.
+    # The message arguments other than strings and numbers are formatted when the message is logged,
+    # so the buffer doesn't keep the responses and the parsed bodies alive, and the long messages are truncated.
+    # The debug log stops growing at max_size bytes, the ring buffer keeps the latest messages then and is dumped
+    # on an error (at most once per dump_interval seconds) and on flush, up to another max_size bytes, and at the end.
+    # The errors are not bounded, they are rare and the post step fails the job if the error log exists.
+    def __init__(self, debug_path='debug.log', error_path='error.log', buffer_size=4 * 1024 * 1024, max_size=0,
+                 interval=0.5, dump_interval=60, max_message=4096):
+        self.debug_path = debug_path
+        self.error_path = error_path
+        self.buffer = deque()
+        self.buffer_size = buffer_size
+        self.buffered = 0  # the size of the buffered messages
+        self.max_message = max_message
+        self.errors = deque()
+        self.max_size = max_size
+        self.interval = interval
+        self.dump_interval = dump_interval
+        self.last_dump = None
+        self.sequence = 0
+        self.written = 0  # the sequence number of the last debug message written out or dropped
+        self.size = 0
+        self.dumped = 0  # the size of the dumps after the limit was reached
+        self.limited = False
+        self.dump_requested = False
+        # the lock guards the buffer, the writing lock the files, so the event loop never waits for the disk
+        self.lock = threading.Lock()
+        self.writing = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.closed = False
+
+    def configure(self, buffer_size, max_size):
+        with self.lock:
+            self.buffer_size = buffer_size
+            self.max_size = max_size
+            self.evict()
+
+    def debug(self, msg, args):
+        # called on the event loop
+        if args and not all(type(arg) in (str, int, float) for arg in args):
+            msg, args = self.format(msg, args), ()
+        size = len(msg) + sum(len(arg) for arg in args if type(arg) is str)
+        if size > self.max_message:
+            msg = self.format(msg, args)
+            msg, args = '%s... (%d more characters)' % (msg[:self.max_message], len(msg) - self.max_message), ()
+            size = len(msg)
+
+        with self.lock:
+            self.sequence += 1
+            self.buffer.append((self.sequence, msg, args, size))
+            self.buffered += size
+            self.evict()
+        if self.thread is None:
+            self.start()
+
+    def evict(self):
+        # the oldest messages over the buffer size are dropped, the writer notes the gap in the sequence numbers
+        while self.buffered > self.buffer_size and self.buffer:
+            self.buffered -= self.buffer.popleft()[3]
+
+    def error(self, msg):
+        self.errors.append(msg)
+        # a burst of errors dumps the buffered messages once
+        now = time.monotonic()
+        if self.last_dump is None or now - self.last_dump >= self.dump_interval:
+            self.last_dump = now
+            self.dump_requested = True
+        if self.thread is None:
+            self.start()
+        self.wakeup.set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='BackgroundLog', daemon=True)
+        self.thread.start()
+        # mitmproxy calls close on shutdown, this covers exiting on a configuration or startup error
+        atexit.register(self.close)
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.write(dump=self.dump_requested)
+            except Exception:
+                print(traceback.format_exc())
+
+    def dump(self):
+        # writes out everything that is buffered, past the size limit within the budget of the dumps
+        self.write(dump=True)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+        # the latest messages, whatever the size
+        self.write(dump=True, final=True)
+
+    def write(self, dump=False, final=False):
+        with self.writing:
+            with self.lock:
+                if dump:
+                    self.dump_requested = False
+                errors = []
+                while self.errors:
+                    errors.append('%s\n' % self.errors.popleft())
+
+                # the ring buffer is left alone once the limit is reached, so it keeps the latest messages for the dumps
+                limited = self.limited
+                if limited and self.max_size and not final and (not dump or self.dumped >= self.max_size):
+                    entries = None
+                else:
+                    entries, self.buffer, self.buffered = self.buffer, deque(), 0
+
+            if errors:
+                with open(self.error_path, 'a') as f:
+                    f.write(''.join(errors))
+            if not entries:
+                return
+
+            budget = self.max_size - (self.dumped if limited else self.size) if self.max_size and not final else None
+            lines = []
+            size = 0
+            while entries:
+                sequence, msg, args, _ = entries.popleft()
+                if sequence > self.written + 1:
+                    lines.append('... %d debug messages dropped\n' % (sequence - self.written - 1))
+                self.written = sequence
+                line = '%s\n' % self.format(msg, args)
+                lines.append(line)
+                size += len(line)
+                if budget is not None and size >= budget:
+                    if limited:
+                        lines.append('... the dumps of the debug log reached %d bytes, the latest messages are written at the end\n' % self.max_size)
+                    else:
+                        self.limited = True
+                        lines.append('... the debug log reached %d bytes, only the latest messages are written on an error and at the end\n' % self.max_size)
+                    break
+
+            if entries:
+                # not written, kept in front of the messages logged meanwhile
+                with self.lock:
+                    entries.extend(self.buffer)
+                    self.buffer = entries
+                    self.buffered = sum(entry[3] for entry in entries)
+                    self.evict()
+
+            with open(self.debug_path, 'a') as f:
+                f.write(''.join(lines))
+            if limited:
+                self.dumped += size
+            else:
+                self.size += size
+
+    @staticmethod
+    def format(msg, args):
+        try:
+            return msg % args if args else msg
+        except Exception as e:
+            return '%s %r (%s)' % (msg, args, e)
+
+
+class Session:
+    # The state of a job: its token and repository, the aggregate of its calls and the GitHub client authenticated with its token.
+    # A single job proxy has one session configured by the options,
+    # a persistent proxy begins and ends a session per job over the control socket.
+    def __init__(self, id, metrics):
+        self.id = id
+        self.summary = PermissionSummary()
+        self.github = GitHubClient(metrics)
+        self.issue_types = IssueTypeBatcher(self.github)
+        self.token = ''
+        self.repository = ''
+        self.repository_id = ''
+        self.id_token_request_url = None
+        self.id_token_request_token = None
+        # the time of the last recorded call, the session of a job that never ended it expires after a while
+        self.active = time.monotonic()
+
+    def configure(self, token, repository, repository_id, api_url, id_token_request_url='', id_token_request_token=''):
+        self.token = token
+        self.repository = repository
+        self.repository_id = repository_id
+        self.github.configure(token)
+        self.issue_types.configure(api_url)
+        self.id_token_request_url = urlsplit(id_token_request_url) if id_token_request_url else None
+        self.id_token_request_token = id_token_request_token or None
+
+    def same_repository(self, repo):
+        # the repository is either 'owner/repo' or the repository id
+        if '/' in repo:
+            return self.repository.upper() == repo.upper()
+        return self.repository_id.upper() == repo.upper()
+
+    async def close(self):
+        await self.github.close()
+
+
+class GHActionsProxy:
+    methods_map = {
+        'GET':      HTTP.GET,
+        'HEAD':     HTTP.GET,
+        'POST':     HTTP.POST,
+        'PUT':      HTTP.PUT,
+        'DELETE':   HTTP.DELETE,
+        'PATCH':    HTTP.PATCH,
+        '*':        HTTP.ANY
+    }
+
+    async def is_public_repo(self, session, repo):
+        # returns None if the lookup is deferred to the post step
+        key = 'visibility:%s' % repo.lower()
+        public = self.cache.get(key)
+        if public is None:
+            public = await self.cache.fetch(key)
+        if public is not None:
+            self.metrics.count('visibility_cache_hits')
+            return public
+
+        self.metrics.count('visibility_cache_misses')
+        if self.deferred:
+            return None
+
+        repo_path = 'repos' if '/' in repo else 'repositories'
+        url = f'{ctx.options.GITHUB_API_URL}/{repo_path}/{repo}'
+        # the enrichment lookups run on the mitmproxy event loop, awaiting them lets other flows proceed meanwhile
+        started = time.perf_counter()
+        response = await session.github.get(url)
+        self.metrics.observe('enrichment', time.perf_counter() - started)
+        if response is not None and response.status_code == 200:
+            public = response.json()['private'] == False
+            self.cache.set(key, public)
+            return public
+        else:
+            return False
+
+    async def get_issue_type(self, session, id, repo, number):
+        # Every pull request is an issue, but not every issue is a pull request.
+        # The answer never changes for the given issue number, comment id or event id, so it is cached.
+        # Returns 'pull-requests', 'issues', None if it couldn't be determined or DEFERRED if the lookup is left to the post step.
+        key = '%s:%s:%s' % (id, repo.lower(), number)
+        type = self.cache.get(key)
+        if type is None:
+            type = await self.cache.fetch(key)
+        if type is not None:
+            self.metrics.count('issue_cache_hits')
+            return type
+
+        self.metrics.count('issue_cache_misses')
+        if self.deferred:
+            return DEFERRED
+
+        if id != 'event_id' and number.isdigit():
+            # the events can't be looked up by their id with GraphQL, the REST API lookup is the fallback for them
+            started = time.perf_counter()
+            type = await session.issue_types.resolve(id, repo, number)
+            self.metrics.observe('enrichment', time.perf_counter() - started)
+            if type is not None:
+                self.cache.set(key, type)
+                return type
+
+        repo_path = 'repos' if '/' in repo else 'repositories'
+        if id == 'issue_number':
+            url = f'{ctx.options.GITHUB_API_URL}/{repo_path}/{repo}/pulls/{number}'
+        elif id == 'comment_id':
+            url = f'{ctx.options.GITHUB_API_URL}/{repo_path}/{repo}/issues/comments/{number}'
+        else:
+            url = f'{ctx.options.GITHUB_API_URL}/{repo_path}/{repo}/issues/events/{number}'
+
+        started = time.perf_counter()
+        response = await session.github.get(url)
+        self.metrics.observe('enrichment', time.perf_counter() - started)
+        self.log_debug('get_permission response: %s', response)
+        if response is None:
+            # rate limited, fall back to the same defaults as for the failed requests, but don't cache them
+            return 'issues' if id == 'issue_number' else None
+        elif id == 'issue_number':
+            if response.status_code == 200:
+                type = 'pull-requests'
+            elif response.status_code == 404:
+                type = 'issues'
+            else:
+                # not a definitive answer, don't cache it
+                return 'issues'
+        elif response.status_code == 200:
+            data = response.json()
+            self.log_debug('get_permission data: %s', data)
+            html_url = data['html_url'] if id == 'comment_id' else data['issue']['html_url']
+            type = 'pull-requests' if '/pull/' in html_url else 'issues'
+        else:
+            return None
+
+        self.cache.set(key, type)
+        return type
+
+    def __init__(self):
+        self.output = None
+        self.log = BackgroundLog()
+        self.flush_task = None
+        self.expire_task = None
+        self.resolver = HostResolver()
+        self.resolve_task = None
+        self.memo = Memo()
+        self.documents = Memo()
+        self.hosts = set()
+        self.cache = EnrichmentCache()
+        self.metrics = Metrics()
+        # the session of the job configured by the options, None for a persistent proxy
+        self.session = None
+        # session id -> Session, the sessions share the caches, but not the tokens, the clients and the aggregates
+        self.sessions = {}
+        self.control = None
+        self.deferred = False
+        # the authorization header value -> (session, whether it is the ID token), see token_fingerprints
+        self.fingerprints = {}
+        # the hosts of the sessions' ID token request URLs, intercepted besides the monitored hosts
+        self.id_token_hosts = set()
+        # the options read for every flow
+        self.debug = False
+        self.stream_bodies = True
+        self.graphql_max_size = 0
+
+        try:
+            self.routes = load_index(INDEX_PATH)
+            if self.routes is None:
+                self.routes = compile_routes(ROUTES, self.methods_map)
         except Exception as e:
             print(traceback.format_exc())
             self.log_error(traceback.format_exc())
             sys.exit(1)
 
-    def get_permission(self, path, method, query):
-        path_segments = path.split('/')
+    def find_route(self, segments, method):
+        # HEAD is answered like GET
+        method = self.methods_map.get(method)
+        return self.match_route(self.routes, segments, method.value if method else None)
 
-        if len(path_segments) >= 3:
-            if path_segments[1] == 'repos' and not self.same_repository(path_segments[2], path_segments[3]):
-                return []
-        elif len(path_segments) >= 2:
-            if path_segments[1] == 'repositories' and not self.same_repository(path_segments[2]):
-                return []
-
-        # First try to find the permission in the tree of special cases
-        node = self.rest_api_map
-        for segment in path_segments[1:]:
+    def match_route(self, node, segments, method):
+        # the most specific route wins: a literal segment before a placeholder before a prefix
+        # A placeholder is followed only if the segment isn't a literal, so the lookup never backtracks,
+        # the deepest prefix on the way is the fallback if the path ends without a route
+        fallback = None
+        for segment in segments:
+            prefix = node.get(PREFIX_SEGMENT)
+            if prefix:
+                fallback = prefix.get(method) or prefix.get(HTTP.ANY.value) or fallback
             next_node = node.get(segment)
-            if not next_node:
-                next_node = node.get('*')
-                if not next_node:
-                    node = next_node
-                    break
+            if next_node is None:
+                next_node = node.get(ANY_SEGMENT)
+                if next_node is None:
+                    return fallback
             node = next_node
 
-        # If the node was found extract the permission
-        if node:
-            permissions = node.get(self.methods_map[method])
-            if permissions:  # If the node was found, but the HTTP method wasn't, fall through to search by path pattern
-                if permissions[0].startswith('issues/pull-requests'):
-                    # Every pull request is an issue, but not every issue is a pull request case. Try to find out the type.
-                    id = permissions[0].split('/')[2]
-                    if id == 'issue_number':
-                        url = ''
-                        if path_segments[1] == 'repos':
-                            url = f'{ctx.options.GITHUB_API_URL}/repos/{path_segments[2]}/{path_segments[3]}/pulls/{path_segments[5]}'
-                        elif path_segments[1] == 'repositories':
-                            url = f'{ctx.options.GITHUB_API_URL}/repositories/{path_segments[2]}/pulls/path_segments[4]'
-                        response = requests.get(
-                            url, headers={'Authorization': 'Bearer %s' % ctx.options.token})
-                        self.log_debug(
-                            "get_permission response: %s" % response)
-                        if response.status_code == 200:
-                            return [('pull-requests', permissions[1])]
-                        else:
-                            return [('issues', permissions[1])]
-                    elif id == 'comment_id':
-                        url = ''
-                        if path_segments[1] == 'repos':
-                            url = f'{ctx.options.GITHUB_API_URL}/repos/{path_segments[2]}/{path_segments[3]}/issues/comments/{path_segments[6]}'
-                        elif path_segments[1] == 'repositories':
-                            url = f'{ctx.options.GITHUB_API_URL}/repositories/{path_segments[2]}/issues/comments/{path_segments[5]}'
-                        response = requests.get(
-                            url, headers={'Authorization': 'Bearer %s' % ctx.options.token})
-                        self.log_debug(
-                            "get_permission response: %s" % response)
-                        if response.status_code == 200:
-                            data = response.json()
-                            self.log_debug("get_permission data: %s" % data)
-                            if '/pull/' in data['html_url']:
-                                return [('pull-requests', permissions[1])]
-                            else:
-                                return [('issues', permissions[1])]
-                        else:
-                            return [('unknown', 'unknown')]
-                    elif id == 'event_id':
-                        url = ''
-                        if path_segments[1] == 'repos':
-                            url = f'{ctx.options.GITHUB_API_URL}/repos/{path_segments[2]}/{path_segments[3]}/issues/events/{path_segments[6]}'
-                        elif path_segments[1] == 'repositories':
-                            url = f'{ctx.options.GITHUB_API_URL}/repositories/{path_segments[2]}/issues/events/{path_segments[5]}'
-                        response = requests.get(
-                            url, headers={'Authorization': 'Bearer %s' % ctx.options.token})
-                        self.log_debug(
-                            "get_permission response: %s" % response)
-                        if response.status_code == 200:
-                            data = response.json()
-                            self.log_debug("get_permission data: %s" % data)
-                            if '/pull/' in data['issue']['html_url']:
-                                return [('pull-requests', permissions[1])]
-                            else:
-                                return [('issues', permissions[1])]
-                        else:
-                            return [('unknown', 'unknown')]
-                elif 'issues,pull-requests' == permissions[0]:
-                    # It is impossible to distinguish between issues and pull requests
-                    # The safest bet is to return both
-                    # Also, assuming the workflow runs with full permissions the request would return both issues and pull requests anyway
-                    return [('issues', permissions[1]), ('pull-requests', permissions[1])]
-
-                return [permissions]
-
-        # Get the permission by the pattern of (GET|POST|etc) /repos/{owner}/{repo}/{what}/{id} -> {what, permission}
-        if len(path_segments) >= 5:
-            if path_segments[1] == 'repos' and path_segments[4] == 'actions':
-                if method == 'GET' and self.is_public_repo(f'{path_segments[2]}/{path_segments[3]}'):
-                    return []
-                return [('actions', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repos' and path_segments[4] == 'environments':
-                if method == 'GET' and self.is_public_repo(f'{path_segments[2]}/{path_segments[3]}'):
-                    return []
-                return [('actions', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repos' and (path_segments[4] == 'check-runs' or path_segments[4] == 'check-suites'):
-                return [('checks', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repos' and (path_segments[4] == 'releases' or path_segments[4] == 'git' or path_segments[4] == 'commits'):
-                if method == 'GET' and self.is_public_repo(f'{path_segments[2]}/{path_segments[3]}'):
-                    return []
-                return [('contents', 'read' if method == 'GET' else 'write')]
-            elif path_segments[3] == 'releases' and path_segments[4] == 'download':
-                return []
-            elif path_segments[1] == 'repos' and path_segments[4] == 'deployments':
-                return [('deployments', 'read' if method == 'GET' else 'write')]
-            # Issues are covered by the mapping above
-            # TODO: only GraphQL API for discussions?
-            elif ((path_segments[1] == 'orgs' or path_segments[1] == 'users') and path_segments[3] == 'packages') or (path_segments[1] == 'user' and path_segments[2] == 'packages'):
-                return [('packages', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repos' and path_segments[4] == 'pages':
-                return [('pages', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repos' and path_segments[4] == 'pulls':
-                return [('pull-requests', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'projects' or (path_segments[1] == 'repos' and path_segments[4] == 'projects'):
-                return [('repository-projects', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repos' and path_segments[4] == 'code-scanning':
-                return [('security-events', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repos' and path_segments[4] == 'statuses':
-                return [('statuses', 'read' if method == 'GET' else 'write')]
-            elif path_segments[3] == 'info' and path_segments[4] == 'refs':
-                if query['service'][0] == 'git-upload-pack':
-                    if self.is_public_repo(f'{path_segments[1]}/{path_segments[2]}'):
-                        return []
-                    return [('contents', 'read')]
-                elif query['service'][0] == 'git-receive-pack':
-                    return [('contents', 'write')]
-
-        if len(path_segments) >= 4:
-            if path_segments[1] == 'repositories' and path_segments[3] == 'actions':
-                if method == 'GET' and self.is_public_repo(path_segments[2]):
-                    return []
-                return [('actions', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repositories' and path_segments[3] == 'environments':
-                if method == 'GET' and self.is_public_repo(path_segments[2]):
-                    return []
-                return [('actions', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repositories' and (path_segments[3] == 'check-runs' or path_segments[3] == 'check-suites'):
-                return [('checks', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repositories' and (path_segments[3] == 'releases' or path_segments[3] == 'git' or path_segments[3] == 'commits'):
-                if method == 'GET' and self.is_public_repo(path_segments[2]):
-                    return []
-                return [('contents', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repositories' and path_segments[3] == 'deployments':
-                return [('deployments', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repositories' and path_segments[3] == 'pages':
-                return [('pages', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repositories' and path_segments[3] == 'pulls':
-                return [('pull-requests', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repositories' and path_segments[3] == 'projects':
-                return [('repository-projects', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repositories' and path_segments[3] == 'code-scanning':
-                return [('security-events', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repositories' and path_segments[3] == 'statuses':
-                return [('statuses', 'read' if method == 'GET' else 'write')]
-            elif path_segments[1] == 'repos' and method == 'GET' and len(path_segments) == 4:
-                return [] # it successfully returns the repository even with permissions: {}
-            elif path_segments[1] == 'projects':
-                return [('repository-projects', 'read' if method == 'GET' else 'write')]
-            elif path_segments[3] == 'git-upload-pack':
-                if self.is_public_repo(f'{path_segments[1]}/{path_segments[2]}'):
-                    return []
-                return [('contents', 'read')]
-            elif path_segments[3] == 'git-receive-pack':
-                return [('contents', 'write')]
-        elif len(path_segments) == 3:
-            if (path_segments[1] == 'repositories' or path_segments[1] == 'users') and method == 'GET':
-                return [] # it successfully returns even with permissions: {}
-            elif path_segments[1] == 'projects':
-                return [('repository-projects', 'read' if method == 'GET' else 'write')]
+        route = node.get(method) or node.get(HTTP.ANY.value)
+        if route:
+            return route
+        prefix = node.get(PREFIX_SEGMENT)
+        if prefix:
+            return prefix.get(method) or prefix.get(HTTP.ANY.value) or fallback
+        return fallback
+
+    async def get_permission(self, path, method, query, session=None):
+        _, permissions = await self.get_route_permission(path, method, query, session)
+        return permissions
 
+    async def get_route_permission(self, path, method, query, session=None):
+        # returns the path of the matched route (None if there is none) and the permissions
+        session = session or self.session
+        repo, segments = normalize_path(path)
+        if repo is not None and not session.same_repository(repo):
+            return None, []
+
+        # a literal segment of a route is never a number or a sha, so collapsing them doesn't change the route
+        key = (method, tuple(collapse_ids(segments)))
+        route = self.memo.get(key)
+        if route is Memo.MISSING:
+            route = self.find_route(segments, method)
+            self.memo.set(key, route)
+
+        if not route:
+            return None, [('unknown', 'unknown')]
+
+        type, permission, lookup, index, template = route
+        if type is None:
+            return template, []
+
+        if permission == 'read/write':
+            permission = 'read' if method in ('GET', 'HEAD') else 'write'
+        elif permission == 'service':
+            service = query.get('service', [''])[0]
+            if service == 'git-upload-pack':
+                permission = 'read'
+            elif service == 'git-receive-pack':
+                permission = 'write'
+            else:
+                return template, [('unknown', 'unknown')]
+
+        # the lookup left to the post step, the permissions are recorded with it
+        deferred = None
+        if lookup == 'public':
+            if permission == 'read':
+                repo = repo or f'{segments[0]}/{segments[1]}'
+                public = await self.is_public_repo(session, repo)
+                if public is None:
+                    deferred = ('public', repo)
+                elif public:
+                    return template, []
+        elif lookup:
+            # Every pull request is an issue, but not every issue is a pull request case. Try to find out the type.
+            type = await self.get_issue_type(session, lookup, repo, segments[index])
+            if type == DEFERRED:
+                type = 'issues/pull-requests'
+                deferred = (lookup, repo, segments[index])
+            elif type is None:
+                return template, [('unknown', 'unknown')]
+
+        if ',' in type:
+            # Several permissions are required, for example it is impossible to distinguish between issues and pull requests
+            # The safest bet is to return both
+            # Also, assuming the workflow runs with full permissions the request would return both issues and pull requests anyway
+            # The permission is either the same for all of them or a comma separated list of the same length
+            permissions = permission.split(',')
+            permissions = [(t, permissions[i] if len(permissions) > 1 else permission) for i, t in enumerate(type.split(','))]
+        else:
+            permissions = [(type, permission)]
+
+        if deferred:
+            return template, [(t, p, deferred) for t, p in permissions]
+        return template, permissions
+
+    async def get_graphql_permission(self, body, session=None):
+        session = session or self.session
+        try:
+            request = json.loads(body)
+            query = request['query']
+            variables = request.get('variables') or {}
+            operation_name = request.get('operationName')
+        except (ValueError, KeyError, TypeError, AttributeError, RecursionError):
+            return [('unknown', 'unknown')]
+
+        # the same few queries repeat many times in a job, only the variables differ
+        key = hashlib.blake2b(query.encode(), digest_size=16).digest()
+        document = self.documents.get(key)
+        if document is Memo.MISSING:
+            try:
+                document = parse_graphql(query)
+            except ValueError as e:
+                self.log_debug('Failed to parse the GraphQL query: %s', e)
+                document = None
+            self.documents.set(key, document)
+
+        if document is None:
+            return [('unknown', 'unknown')]
+
+        operations, fragments = document
+        if operation_name in operations:
+            operation = operations[operation_name]
+        elif len(operations) == 1:
+            operation = next(iter(operations.values()))
+        else:
+            return [('unknown', 'unknown')]
+
+        type, selections = operation
+        permissions = []
+        try:
+            for field in expand_fields(selections, fragments):
+                permissions.extend(await self.get_graphql_field_permission(session, type, field, fragments, variables))
+        except RecursionError:
+            # the deeply nested variables
+            return [('unknown', 'unknown')]
+        return list(dict.fromkeys(permissions))
+
+    async def get_graphql_field_permission(self, session, operation, field, fragments, variables):
+        name, arguments, selections = field
+        arguments = resolve_variables(arguments, variables)
+        if operation == 'mutation':
+            type = GRAPHQL_MUTATIONS.get(name)
+            if type is None:
+                return [('unknown', 'unknown')]
+            if type == 'issues/pull-requests':
+                # the type of the node the mutation is applied to, the safest bet is to return both if it is unknown
+                types = [GRAPHQL_NODE_TYPES.get(node_type(id)) for id in node_ids(arguments)]
+                type = next((t for t in types if t), 'issues,pull-requests')
+            return [(t, 'write') for t in type.split(',')]
+
+        if name == 'repository':
+            owner, repo_name = arguments.get('owner'), arguments.get('name')
+            repo = f'{owner}/{repo_name}' if isinstance(owner, str) and isinstance(repo_name, str) else None
+            return await self.get_graphql_repository_permission(session, repo, selections, fragments)
+        elif name in GRAPHQL_OWNER_FIELDS:
+            return await self.get_graphql_owner_permission(session, field, fragments, variables)
+        elif name in ('node', 'nodes'):
+            ids = arguments.get('ids') if name == 'nodes' else [arguments.get('id')]
+            permissions = []
+            for id in ids if isinstance(ids, list) else []:
+                type = node_type(id) if isinstance(id, str) else None
+                if type not in GRAPHQL_NODE_TYPES:
+                    return [('unknown', 'unknown')]
+                if GRAPHQL_NODE_TYPES[type]:
+                    permissions.extend((t, 'read') for t in GRAPHQL_NODE_TYPES[type].split(','))
+            return permissions
+        elif name in GRAPHQL_PUBLIC_FIELDS:
+            return []
         return [('unknown', 'unknown')]
 
-    def same_repository(self, id):
-        return ctx.options.GITHUB_REPOSITORY_ID.upper() == id.upper()
+    async def get_graphql_repository_permission(self, session, repo, selections, fragments):
+        # repo is None if the repository is not known from the query, e.g. a connection of the repositories
+        if repo is not None and not session.same_repository(repo):
+            return []
+
+        types = [GRAPHQL_REPOSITORY_FIELDS.get(child[0]) for child in expand_fields(selections, fragments)]
+        permissions = [(t, 'read') for type in types if type for t in type.split(',')]
+        if ('contents', 'read') in permissions and repo is not None:
+            # reading the contents of a public repository doesn't require the permission
+            public = await self.is_public_repo(session, repo)
+            if public:
+                permissions = [p for p in permissions if p != ('contents', 'read')]
+            elif public is None:
+                permissions = [p + (('public', repo),) if p == ('contents', 'read') else p for p in permissions]
+        return permissions
 
-    def same_repository(self, owner, repo):
-        return ctx.options.GITHUB_REPOSITORY.upper() == f'{owner}/{repo}'.upper()
+    async def get_graphql_owner_permission(self, session, field, fragments, variables):
+        # The owners are public, but their repositories are not: organization(login:) { repository(name:) { issues ... } }
+        # The whole subtree is searched for the repositories, the owner's login names only its own repository fields.
+        name, arguments, selections = field
+        login = resolve_variables(arguments, variables).get('login')
+        permissions = []
+        pending = [(child, login) for child in expand_fields(selections, fragments)]
+        searched = 0
+        while pending:
+            searched += 1
+            if searched > GRAPHQL_MAX_FIELDS:
+                return [('unknown', 'unknown')]
+            (child_name, child_arguments, child_selections), owner = pending.pop()
+            if child_name == 'repository':
+                repo_name = resolve_variables(child_arguments, variables).get('name')
+                repo = f'{owner}/{repo_name}' if isinstance(owner, str) and isinstance(repo_name, str) else None
+                permissions.extend(await self.get_graphql_repository_permission(session, repo, child_selections, fragments))
+            elif child_name == 'repositories':
+                # a connection, the repository fields are selected on its nodes or on the nodes of its edges
+                for connection_field in expand_fields(child_selections, fragments):
+                    if connection_field[0] == 'nodes':
+                        permissions.extend(await self.get_graphql_repository_permission(session, None, connection_field[2], fragments))
+                    elif connection_field[0] == 'edges':
+                        for edge_field in expand_fields(connection_field[2], fragments):
+                            if edge_field[0] == 'node':
+                                permissions.extend(await self.get_graphql_repository_permission(session, None, edge_field[2], fragments))
+            else:
+                pending.extend((grandchild, None) for grandchild in expand_fields(child_selections, fragments))
+        return permissions
 
     def load(self, loader):
         loader.add_option(
             name='output',
             typespec=str,
             default='',
-            help='Output file path',
+            help='Raw per-request log file path, no log is written if empty',
+        )
+        loader.add_option(
+            name='summary',
+            typespec=str,
+            default='',
+            help='Summary file path',
         )
         loader.add_option(
             name='token',
@@ -417,6 +1905,18 @@ class GHActionsProxy:
             default='',
             help='Enable debug logging',
         )
+        loader.add_option(
+            name='log_buffer',
+            typespec=int,
+            default=4 * 1024 * 1024,
+            help='Maximum size in bytes of the debug messages buffered in memory, the oldest ones are dropped if the log writer falls behind',
+        )
+        loader.add_option(
+            name='log_max_size',
+            typespec=int,
+            default=16 * 1024 * 1024,
+            help='Size in bytes the debug log stops growing at, only the latest buffered messages are written after it on an error, up to the same size, and at the end, unlimited if 0',
+        )
         loader.add_option(
             name='ACTIONS_ID_TOKEN_REQUEST_URL',
             typespec=str,
@@ -453,39 +1953,122 @@ class GHActionsProxy:
             default='',
             help='GITHUB_API_URL environment variable',
         )
+        loader.add_option(
+            name='ready',
+            typespec=str,
+            default='',
+            help='The file written with the process id once the proxy is ready to intercept the requests',
+        )
+        loader.add_option(
+            name='control',
+            typespec=str,
+            default='',
+            help='Control socket path of a persistent proxy, the jobs begin and end their sessions over it instead of setting the token and the repository',
+        )
+        loader.add_option(
+            name='session_timeout',
+            typespec=int,
+            default=24 * 60 * 60,
+            help='Seconds without any recorded call after which a session of a persistent proxy that was not ended is dropped, 0 to keep them',
+        )
+        loader.add_option(
+            name='metrics',
+            typespec=str,
+            default='',
+            help='Metrics file path, no metrics are written if empty',
+        )
+        loader.add_option(
+            name='defer_lookups',
+            typespec=bool,
+            default=False,
+            help='Leave the enrichment lookups not answered by the cache to the post step',
+        )
+        loader.add_option(
+            name='stream_bodies',
+            typespec=bool,
+            default=True,
+            help='Stream the request and response bodies the addon does not inspect instead of buffering them',
+        )
+        loader.add_option(
+            name='graphql_max_size',
+            typespec=int,
+            default=65536,
+            help='Maximum size of the GraphQL request body to classify, the larger bodies are not parsed',
+        )
+        loader.add_option(
+            name='memo_size',
+            typespec=int,
+            default=1024,
+            help='Maximum number of the memoized routes by the method and path template and of the parsed GraphQL documents',
+        )
+        loader.add_option(
+            name='cache',
+            typespec=str,
+            default='',
+            help='Enrichment cache file path, the cache is kept in memory only if empty',
+        )
+        loader.add_option(
+            name='shared_cache',
+            typespec=str,
+            default='',
+            help='SQLite database path of the enrichment cache shared by the proxy workers, the cache is not shared if empty',
+        )
+        loader.add_option(
+            name='cache_ttl',
+            typespec=int,
+            default=7 * 24 * 60 * 60,
+            help='Enrichment cache entry time to live in seconds',
+        )
+        loader.add_option(
+            name='cache_size',
+            typespec=int,
+            default=10000,
+            help='Maximum number of the enrichment cache entries',
+        )
 
-    def log_debug(self, msg):
-        if ctx.options.debug:
-            with open('debug.log', 'a+') as f:
-                f.write('%s\n' % msg)
+    def log_debug(self, msg, *args):
+        # the message is recorded only if the debug logging is enabled and formatted by the background thread
+        if self.debug:
+            self.log.debug(msg, args)
 
     def log_error(self, msg):
-        with open('error.log', 'a+') as f:
-            f.write('%s\n' % msg)
+        # the background thread writes the error out right away together with the buffered debug messages
+        self.log.error(msg)
 
     def configure(self, updates):
+        self.debug = bool(ctx.options.debug)
+        self.stream_bodies = ctx.options.stream_bodies
+        self.graphql_max_size = ctx.options.graphql_max_size
+        self.log.configure(ctx.options.log_buffer, ctx.options.log_max_size)
         self.log_debug('Proxy debug messages enabled')
 
-        with open(ctx.options.output, 'a+') as f:
-            pass  # create empty file
+        if not self.output or self.output.path != ctx.options.output:
+            if self.output:
+                self.output.close()
+            self.output = None
+            if bool(ctx.options.output):
+                self.output = BufferedWriter(ctx.options.output)  # creates an empty file
+
+        if not bool(ctx.options.summary) and not ctx.options.control:
+            print('error: Summary argument is empty')
+            sys.exit(1)
 
         if not bool(ctx.options.hosts):
             print('error: Hosts argument is empty')
             sys.exit(1)
 
-        self.rebuild_cache()
-        print(self.ip_map)
-        self.log_debug(self.ip_map)
+        self.hosts = {host.strip().lower() for host in ctx.options.hosts.split(',')}
+        self.resolver.configure(sorted(self.hosts))
 
-        if not bool(ctx.options.token):
+        if not bool(ctx.options.token) and not ctx.options.control:
             print('error: GitHub token is empty')
             sys.exit(1)
 
-        if not bool(ctx.options.GITHUB_REPOSITORY_ID):
+        if not bool(ctx.options.GITHUB_REPOSITORY_ID) and not ctx.options.control:
             print('error: GITHUB_REPOSITORY_ID is empty')
             sys.exit(1)
 
-        if not bool(ctx.options.GITHUB_REPOSITORY):
+        if not bool(ctx.options.GITHUB_REPOSITORY) and not ctx.options.control:
             print('error: GITHUB_REPOSITORY is empty')
             sys.exit(1)
 
@@ -493,13 +2076,170 @@ class GHActionsProxy:
             print('error: GITHUB_API_URL is empty')
             sys.exit(1)
 
-        self.id_token_request_url = None
-        if bool(ctx.options.ACTIONS_ID_TOKEN_REQUEST_URL):
-            self.id_token_request_url = urlsplit(ctx.options.ACTIONS_ID_TOKEN_REQUEST_URL)
+        if not ctx.options.control:
+            if self.session is None:
+                self.session = self.sessions[''] = Session('', self.metrics)
+            self.session.configure(
+                ctx.options.token, ctx.options.GITHUB_REPOSITORY, ctx.options.GITHUB_REPOSITORY_ID, ctx.options.GITHUB_API_URL,
+                ctx.options.ACTIONS_ID_TOKEN_REQUEST_URL, ctx.options.ACTIONS_ID_TOKEN_REQUEST_TOKEN)
+            self.fingerprint_sessions()
 
-        self.id_token_request_token = None
-        if bool(ctx.options.ACTIONS_ID_TOKEN_REQUEST_TOKEN):
-            self.id_token_request_token = ctx.options.ACTIONS_ID_TOKEN_REQUEST_TOKEN
+        self.deferred = ctx.options.defer_lookups
+        self.memo.max_size = ctx.options.memo_size
+        self.documents.max_size = ctx.options.memo_size
+
+        if ctx.options.shared_cache and getattr(self.cache, 'database', None) != ctx.options.shared_cache:
+            self.cache = SharedEnrichmentCache(ctx.options.shared_cache)
+
+        try:
+            self.cache.load(ctx.options.cache, ctx.options.cache_ttl, ctx.options.cache_size)
+        except Exception as e:
+            # a corrupted or incompatible cache is not fatal, start from scratch
+            self.log_debug('Failed to load the cache: %s', e)
+
+    async def running(self):
+        await self.resolver.refresh()
+        print(self.resolver.ip_map)
+        # a copy, the message is formatted later and the map is refreshed meanwhile
+        self.log_debug('%s', dict(self.resolver.ip_map))
+        self.resolve_task = asyncio.create_task(self.resolver.refresh_periodically())
+
+        # the post step sends SIGUSR1 to persist the state before it reads the results
+        with open('mitmdump.pid', 'w') as f:
+            f.write(str(os.getpid()))
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.flush)
+        self.flush_task = asyncio.create_task(self.flush_periodically())
+        if ctx.options.control:
+            # the existing socket file of a previous run is replaced
+            self.control = await asyncio.start_unix_server(self.handle_control, ctx.options.control)
+            # the jobs run as the runner user, the setup grants its group the access
+            os.chmod(ctx.options.control, 0o660)
+            self.expire_task = asyncio.create_task(self.expire_sessions_periodically())
+        self.signal_ready()
+
+    def signal_ready(self):
+        # The setup waits for the ready file instead of probing the port.
+        # The proxyserver addon starts listening in its own running hook, which is called before the scripts' ones,
+        # and by now the options are configured and the monitored hosts are resolved.
+        if not ctx.options.ready:
+            return
+
+        proxyserver = ctx.master.addons.get('proxyserver')
+        if proxyserver and not proxyserver.listen_addrs():
+            self.log_error('The proxy is not listening, the ready file is not written')
+            return
+
+        tmp = '%s.tmp' % ctx.options.ready
+        with open(tmp, 'w') as f:
+            f.write(str(os.getpid()))
+        os.replace(tmp, ctx.options.ready)
+
+    async def handle_control(self, reader, writer):
+        # one JSON command per line, each is answered with one JSON line
+        try:
+            while line := await reader.readline():
+                try:
+                    response = await self.control_command(json.loads(line))
+                except Exception as e:
+                    print(traceback.format_exc())
+                    self.log_error(traceback.format_exc())
+                    response = {'error': str(e)}
+                writer.write(('%s\n' % json.dumps(response)).encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def control_command(self, command):
+        # {"command": "begin-session", "token": ..., "repository": ..., "repository_id": ...,
+        #  "id_token_request_url": ..., "id_token_request_token": ...} -> {"session": id}
+        # {"command": "end-session", "session": id} -> {"summary": the aggregate of the session}
+        name = command.get('command')
+        self.log_debug('Control command: %s', name)
+        if name == 'begin-session':
+            for key in ('token', 'repository', 'repository_id'):
+                if not command.get(key):
+                    return {'error': '%s is empty' % key}
+            session = Session(secrets.token_hex(16), self.metrics)
+            session.configure(
+                command['token'], command['repository'], str(command['repository_id']), ctx.options.GITHUB_API_URL,
+                command.get('id_token_request_url') or '', command.get('id_token_request_token') or '')
+            self.sessions[session.id] = session
+            self.fingerprint_sessions()
+            return {'session': session.id}
+        elif name == 'end-session':
+            id = command.get('session')
+            session = self.sessions.pop(id, None) if id else None
+            if session is None:
+                return {'error': 'Unknown session'}
+            self.fingerprint_sessions()
+            await session.close()
+            # persist what the job has looked up for the next ones
+            self.cache.save()
+            return {'summary': session.summary.to_json()}
+        return {'error': 'Unknown command %s' % name}
+
+    async def expire_sessions_periodically(self):
+        while True:
+            await asyncio.sleep(60)
+            await self.expire_sessions()
+
+    async def expire_sessions(self):
+        # the jobs cancelled or failed before their post step never end their sessions
+        # the GITHUB_TOKEN expires within 24 hours, so by default an idle session is kept as long as its token may be used
+        timeout = ctx.options.session_timeout
+        if not timeout:
+            return
+
+        now = time.monotonic()
+        expired = [session for id, session in self.sessions.items() if id and now - session.active > timeout]
+        if not expired:
+            return
+
+        for session in expired:
+            self.log_debug('Session %s expired', session.id)
+            del self.sessions[session.id]
+        self.metrics.count('sessions_expired', len(expired))
+        self.fingerprint_sessions()
+        for session in expired:
+            await session.close()
+
+    async def flush_periodically(self):
+        # don't keep the last records of a quiet job in memory for too long
+        while True:
+            await asyncio.sleep(1)
+            self.flush_outputs()
+
+    def flush_outputs(self):
+        if self.session:
+            self.session.summary.save(ctx.options.summary)
+        if self.output:
+            self.output.flush()
+
+    def save_metrics(self):
+        self.metrics.save(ctx.options.metrics, {
+            'route_memo_hits': self.memo.hits,
+            'route_memo_misses': self.memo.misses,
+            'graphql_memo_hits': self.documents.hits,
+            'graphql_memo_misses': self.documents.misses,
+            'dns_hits': self.resolver.hits,
+            'dns_misses': self.resolver.misses,
+            'dns_negative_hits': self.resolver.negative_hits,
+            'dns_refreshes': self.resolver.refreshes,
+        })
+
+    def flush(self):
+        try:
+            self.flush_outputs()
+            self.save_metrics()
+            self.cache.save()
+        except Exception as e:
+            print(traceback.format_exc())
+            self.log_error(traceback.format_exc())
+        finally:
+            # the post step reads the logs next
+            self.log.dump()
+            with open('flush.done', 'w') as f:
+                pass  # signal the post step
 
     def contains_token(self, header, token):
         if header.upper().strip().startswith('BASIC '):
@@ -507,65 +2247,187 @@ class GHActionsProxy:
 
         return token in header
 
-    def requestheaders(self, flow):
+    def find_session(self, header):
+        # the session whose token or ID token the authorization header contains and whether it is the ID token
+        for session in self.sessions.values():
+            if self.contains_token(header, session.token):
+                return session, False
+            if session.id_token_request_token and self.contains_token(header, session.id_token_request_token):
+                return session, True
+        return None, False
+
+    def fingerprint_sessions(self):
+        # called whenever the sessions change, so the flows don't search the headers for the tokens
+        self.fingerprints = {}
+        self.id_token_hosts = set()
+        for session in self.sessions.values():
+            for token, id_token in ((session.token, False), (session.id_token_request_token, True)):
+                if token:
+                    for fingerprint in token_fingerprints(token):
+                        self.fingerprints.setdefault(fingerprint, (session, id_token))
+            if session.id_token_request_url and session.id_token_request_url.hostname:
+                self.id_token_hosts.add(session.id_token_request_url.hostname.lower())
+
+    def match_token(self, header):
+        # the exact forms of the tokens are looked up first, the header is searched for them only if it has another form
+        scheme, _, credentials = header.strip().partition(b' ')
+        match = self.fingerprints.get(scheme.lower() + b' ' + credentials.strip())
+        if match:
+            return match
+        return self.find_session(header.decode('utf-8', 'surrogateescape'))
+
+    async def requestheaders(self, flow):
+        started = time.perf_counter()
+        intercepted = False
         try:
-            url_parts = urlsplit(flow.request.url)
-            parsed_url = urlparse(flow.request.url)
-            hostname = url_parts.hostname.lower()
-
-            host = None
-            for k, v in flow.request.headers.items():
-                if k.upper().strip() == 'HOST':
-                    host = v
-                    break
+            intercepted = await self.intercept(flow)
+        except Exception as e:
+            print(traceback.format_exc())
+            self.log_error(traceback.format_exc())
 
-            if host:
-                hostname = host.lower().strip()
+        # only the GraphQL request bodies are inspected, the rest pass through without being buffered in memory
+        if self.stream_bodies and GRAPHQL_METADATA not in flow.metadata:
+            flow.request.stream = True
+
+        self.metrics.observe('requestheaders', time.perf_counter() - started)
+        self.metrics.count('flows_intercepted' if intercepted else 'flows_ignored')
+
+    async def intercept(self, flow):
+        # Returns whether the flow was recorded.
+        # The most of the traffic is not to the monitored hosts, it is let through after a single pass over the headers
+        # and the URL is parsed only for the flows to the monitored hosts.
+        host = None
+        authorizations = []
+        for name, value in flow.request.headers.fields:
+            name = name.lower()
+            if name == b'host':
+                if host is None:
+                    host = value
+            elif name.startswith(b'authorization'):
+                authorizations.append(value)
+
+        if host:
+            hostname = host.decode('utf-8', 'surrogateescape').lower().strip()
+        elif flow.request.authority:
+            # the :authority pseudo header of HTTP/2, which carries no Host header
+            hostname = flow.request.authority.lower()
+        else:
+            # in the transparent mode the host is the destination address, the resolver maps it back to a monitored host
+            hostname = flow.request.host.lower()
+            if hostname not in self.hosts:
+                hostname = await self.resolver.resolve(hostname) or hostname
+
+        if hostname not in self.hosts and hostname not in self.id_token_hosts:
+            if self.debug:
+                self.log_debug('%s %s', flow.request.method, flow.request.url.replace(flow.request.host, hostname))
+            return False
+
+        method = flow.request.method
+        if self.debug:
+            self.log_debug('%s %s', method, flow.request.url.replace(flow.request.host, hostname))
+
+        intercepted = False
+        path = None
+        for authorization in authorizations:
+            self.log_debug('The request contains an authorization header')
+            session, id_token = self.match_token(authorization)
+            if session is None:
+                continue
+
+            if path is None:
+                path, _, query = flow.request.path.partition('?')
+
+            if not id_token:
+                if hostname in self.hosts and method == 'POST' and path in GRAPHQL_PATHS:
+                    intercepted = True
+                    size = flow.request.headers.get('content-length', '')
+                    if size.isdigit() and int(size) > self.graphql_max_size:
+                        # don't keep the large bodies in memory, pass them through
+                        flow.request.stream = True
+                        self.record(session, [('unknown', 'unknown')], method, hostname, path)
+                    else:
+                        # the permissions depend on the body, the request hook classifies it once it is read
+                        flow.metadata[GRAPHQL_METADATA] = (session.id, hostname, path)
+                elif hostname in self.hosts:
+                    intercepted = True
+                    permission_started = time.perf_counter()
+                    template, permissions = await self.get_route_permission(path, method, parse_qs(query) if query else {}, session)
+                    self.metrics.observe('get_permission', time.perf_counter() - permission_started)
+                    self.record(session, permissions, method, hostname, path, template)
             else:
-                if not hostname in self.dns_map and not hostname in self.ip_map:
-                    # we hit a load balancer, let's try to refresh the known ips
-                    self.rebuild_cache()
-
-                if hostname in self.ip_map or hostname in self.dns_map:
-                    # if the hostname if found, let's replace the ip with the hostname for more readable logs
-                    if url_parts.hostname in self.ip_map:
-                        hostname = self.ip_map[url_parts.hostname]
-
-            self.log_debug('%s %s' % (
-                flow.request.method, flow.request.url.replace(url_parts.hostname, hostname)))
-
-            # log a JSON like (no comma separators between objects and no wrapping array) list of objects, that will be post-processed later
-            for k, v in flow.request.headers.items():
-                if k.upper().strip().startswith('AUTHORIZATION'):
-                    self.log_debug('The request contains an authorization header')
-                    if self.contains_token(v, ctx.options.token):
-                        if hostname in self.ip_map or hostname in self.dns_map:
-                            permissions = self.get_permission(
-                                url_parts.path, flow.request.method, parse_qs(parsed_url.query))
-                            self.write_json(permissions, flow.request.method, hostname, url_parts.path)
-                    elif self.id_token_request_token and self.contains_token(v, self.id_token_request_token):
-                        if self.id_token_request_url and flow.request.method == 'GET' and hostname == self.id_token_request_url.hostname.lower() and url_parts.path.lower() == self.id_token_request_url.path.lower():
-                            self.write_json([('id-token', 'write')], flow.request.method, hostname, url_parts.path)
+                id_token_request_url = session.id_token_request_url
+                if id_token_request_url and method == 'GET' and hostname == id_token_request_url.hostname.lower() and path.lower() == id_token_request_url.path.lower():
+                    intercepted = True
+                    self.record(session, [('id-token', 'write')], method, hostname, path)
+
+        return intercepted
 
+    def responseheaders(self, flow):
+        # the response bodies are never inspected
+        if self.stream_bodies:
+            flow.response.stream = True
+
+    async def request(self, flow):
+        graphql = flow.metadata.pop(GRAPHQL_METADATA, None)
+        if not graphql:
+            return
+
+        started = time.perf_counter()
+        try:
+            id, hostname, path = graphql
+            session = self.sessions.get(id)
+            if session is None:
+                # the session has ended in the meantime
+                return
+            # the body may have come without the content length
+            if len(flow.request.raw_content or b'') > self.graphql_max_size:
+                permissions = [('unknown', 'unknown')]
+            else:
+                permissions = await self.get_graphql_permission(flow.request.content, session)
+            self.record(session, permissions, flow.request.method, hostname, path)
         except Exception as e:
             print(traceback.format_exc())
             self.log_error(traceback.format_exc())
 
+        self.metrics.observe('graphql', time.perf_counter() - started)
+
+    async def done(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+        if self.resolve_task:
+            self.resolve_task.cancel()
+        if self.expire_task:
+            self.expire_task.cancel()
+        if self.control:
+            self.control.close()
+        self.log_debug('Route memo hits: %d, misses: %d', self.memo.hits, self.memo.misses)
+        self.cache.save()
+        if self.session:
+            self.session.summary.save(ctx.options.summary)
+        self.save_metrics()
+        if self.output:
+            self.output.close()
+        self.log.close()
+        for session in self.sessions.values():
+            await session.close()
+
+    def record(self, session, permissions, method, host, path, template=None):
+        session.active = time.monotonic()
+        # the ID token host of a session of a persistent proxy is not among the monitored hosts
+        if host in self.hosts or (session.id_token_request_url and host == session.id_token_request_url.hostname.lower()):
+            session.summary.add(permissions, method, host, path, template)
+        if self.output:
+            self.write_json(permissions, method, host, path)
+
     def write_json(self, permissions, method, host, path):
-        with open(ctx.options.output, 'a+') as f:
-            f.write('{ ')
-            f.write('"method": "%s"' % method)
-            f.write(', "host": "%s"' % host)
-            f.write(', "path": "%s"' % path)
-            f.write(', "permissions": [')
-            first = True
-            for p in permissions:
-                if not first:
-                    f.write(', ')
-                f.write('{"%s": "%s"}' % (p[0], p[1]))
-                first = False
-
-            f.write(']}\n')
+        # one JSON object per line (NDJSON), that will be post-processed later
+        record = {
+            'method': method,
+            'host': host,
+            'path': path,
+            'permissions': [{p[0]: p[1]} for p in permissions],
+        }
+        self.output.write('%s\n' % json.dumps(record))
 
 
 addons = [GHActionsProxy()]
@@ -0,0 +1,246 @@
+"""
+Offline replay harness and benchmark for the GHActionsProxy addon.
+
+Feeds recorded or synthetic requests into the addon without GitHub and without a real proxy:
+the addon runs with stubbed options, the monitored hosts resolve to fixed local addresses
+and the enrichment lookups are served by a local stand-in for the GitHub API.
+
+Usage:
+    python replay.py [--trace FILE] [--requests N] [--target requestheaders|get_permission] [--latency MS] [--concurrency N]
+
+The trace is a mitmproxy flow file, a HAR file (.har) or a JSON lines file (.jsonl) with
+[method, url, headers] per line. Without a trace a synthetic one of --requests requests is generated.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from mitmproxy import http
+from mitmproxy import io
+from mitmproxy.test import taddons
+from mitmproxy.test import tflow
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mitm_plugin  # noqa: E402
+
+
+REPOSITORY = 'octo-org/octo-repo'
+REPOSITORY_ID = '42'
+TOKEN = 'ghs_replay'
+HOSTS = ('api.github.com', 'github.com')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # answers the enrichment lookups (REST and GraphQL): odd numbers and ids are pull requests, even ones are issues
+    latency = 0.0
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+        path = urlsplit(self.path).path
+        status, body = 404, {'message': 'Not Found'}
+        match = re.search(r'/(pulls|issues/comments|issues/events)/(\d+)$', path)
+        if match:
+            kind, number = match.group(1), int(match.group(2))
+            html_url = 'https://github.com/%s/%s/%d' % (REPOSITORY, 'pull' if number % 2 else 'issues', number)
+            if kind == 'pulls':
+                status, body = (200, {'number': number}) if number % 2 else (404, body)
+            elif kind == 'issues/comments':
+                status, body = 200, {'html_url': html_url}
+            else:
+                status, body = 200, {'issue': {'html_url': html_url}}
+        elif re.fullmatch(r'/(repos/[^/]+/[^/]+|repositories/\d+)', path):
+            status, body = 200, {'private': True}
+
+        self.respond(status, body)
+
+    def do_POST(self):
+        # the batched issue vs pull request lookups, see IssueTypeBatcher
+        if self.latency:
+            time.sleep(self.latency)
+
+        query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['query']
+        data = {'repository': {}}
+        for alias, number in re.findall(r'(i\d+): issueOrPullRequest\(number: (\d+)\)', query):
+            data['repository'][alias] = {'__typename': 'PullRequest' if int(number) % 2 else 'Issue'}
+        for alias, id in re.findall(r'(c\d+): node\(id: "([^"]+)"\)', query):
+            number = int(re.search(r'\d+$', base64.b64decode(id).decode()).group())
+            data[alias] = {'pullRequest': {'number': number} if number % 2 else None}
+        self.respond(200, {'data': data})
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', '"%x"' % hash(data))
+        self.send_header('X-RateLimit-Remaining', '5000')
+        self.send_header('X-RateLimit-Reset', str(int(time.time()) + 3600))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in(latency):
+    StandInHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def synthetic_trace(count, seed=0):
+    # a mix resembling a CI job: polling, paging, issue comments, git traffic and a lot of unrelated downloads
+    rng = random.Random(seed)
+    auth = {'Authorization': 'Bearer %s' % TOKEN}
+    api = 'https://api.github.com/repos/%s' % REPOSITORY
+    templates = (
+        (20, lambda: ('GET', '%s/actions/runs/%d' % (api, rng.randint(1, 50)), auth)),
+        (10, lambda: ('GET', '%s/pulls?page=%d' % (api, rng.randint(1, 20)), auth)),
+        (15, lambda: ('GET', '%s/issues/%d/comments' % (api, rng.randint(1, 200)), auth)),
+        (5, lambda: ('POST', '%s/issues/%d/comments' % (api, rng.randint(1, 200)), auth)),
+        (5, lambda: ('GET', '%s/issues/comments/%d' % (api, rng.randint(1, 1000)), auth)),
+        (5, lambda: ('GET', '%s/labels' % api, auth)),
+        (5, lambda: ('POST', '%s/statuses/%040x' % (api, rng.getrandbits(160)), auth)),
+        (5, lambda: ('GET', 'https://github.com/%s/info/refs?service=git-upload-pack' % REPOSITORY, auth)),
+        (5, lambda: ('GET', '%s/unknown/%d' % (api, rng.randint(1, 10)), auth)),
+        (25, lambda: ('GET', 'https://registry.npmjs.org/package-%d' % rng.randint(1, 500), {})),
+    )
+    weights = [weight for weight, _ in templates]
+    for _ in range(count):
+        yield rng.choices(templates, weights)[0][1]()
+
+
+def read_trace(path):
+    if path.endswith('.har'):
+        with open(path) as f:
+            har = json.load(f)
+        for entry in har['log']['entries']:
+            request = entry['request']
+            yield request['method'], request['url'], {h['name']: h['value'] for h in request['headers']}
+    elif path.endswith('.jsonl') or path.endswith('.ndjson'):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    method, url, headers = json.loads(line)
+                    yield method, url, headers
+    else:
+        with open(path, 'rb') as f:
+            for flow in io.FlowReader(f).stream():
+                if isinstance(flow, http.HTTPFlow):
+                    yield flow.request.method, flow.request.url, dict(flow.request.headers.items())
+
+
+def make_flow(method, url, headers):
+    flow = tflow.tflow()
+    flow.request = http.Request.make(method, url, headers=headers)
+    return flow
+
+
+def resolver(hosts):
+    # monitored hosts resolve to fixed local addresses, the replay must not depend on DNS
+    addresses = {host: {'127.0.0.%d' % (i + 1)} for i, host in enumerate(hosts)}
+
+    async def lookup(host):
+        return addresses[host]
+    return lookup
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def replay(requests, target, api_url, token, hosts, concurrency):
+    addon = mitm_plugin.GHActionsProxy()
+    addon.resolver.lookup = resolver(hosts)
+    latencies = []
+    with taddons.context(addon) as tctx:
+        tctx.configure(
+            addon,
+            summary='summary.json',
+            token=token,
+            hosts=','.join(hosts),
+            GITHUB_REPOSITORY=REPOSITORY,
+            GITHUB_REPOSITORY_ID=REPOSITORY_ID,
+            GITHUB_API_URL=api_url,
+        )
+        await addon.running()
+
+        async def worker(requests):
+            for method, url, headers in requests:
+                if target == 'get_permission':
+                    parts = urlsplit(url)
+                    query = mitm_plugin.parse_qs(parts.query)
+                    begin = time.perf_counter()
+                    await addon.get_permission(parts.path, method, query)
+                else:
+                    flow = make_flow(method, url, headers)
+                    begin = time.perf_counter()
+                    await addon.requestheaders(flow)
+                latencies.append(time.perf_counter() - begin)
+
+        # the proxy handles the flows of the concurrent connections at the same time
+        started = time.perf_counter()
+        requests = iter(requests)
+        await asyncio.gather(*[worker(requests) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - started
+        await addon.done()
+
+    return latencies, elapsed
+
+
+def report(latencies, elapsed):
+    latencies.sort()
+    print('requests:   %d' % len(latencies))
+    print('throughput: %.0f requests/s' % (len(latencies) / elapsed))
+    print('mean:       %.1f us' % (statistics.fmean(latencies) * 1e6))
+    print('p50:        %.1f us' % (percentile(latencies, 50) * 1e6))
+    print('p99:        %.1f us' % (percentile(latencies, 99) * 1e6))
+    print('max:        %.1f us' % (latencies[-1] * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay requests through the GHActionsProxy addon offline.')
+    parser.add_argument('--trace', help='mitmproxy flow file, HAR (.har) or JSON lines (.jsonl) trace')
+    parser.add_argument('--requests', type=int, default=100000, help='size of the synthetic trace')
+    parser.add_argument('--target', choices=('requestheaders', 'get_permission'), default='requestheaders')
+    parser.add_argument('--token', default=TOKEN, help='the token used in the recorded trace')
+    parser.add_argument('--hosts', default=','.join(HOSTS), help='comma delimited list of hosts to monitor')
+    parser.add_argument('--latency', type=float, default=0, help='stand-in GitHub API latency in milliseconds')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of the requests replayed at the same time')
+    args = parser.parse_args()
+
+    if args.trace:
+        requests = list(read_trace(os.path.abspath(args.trace)))
+    else:
+        requests = list(synthetic_trace(args.requests))
+
+    hosts = [host.strip() for host in args.hosts.split(',')]
+    server = start_stand_in(args.latency / 1000)
+    api_url = 'http://127.0.0.1:%d' % server.server_address[1]
+
+    # the addon writes its output and logs to the current directory
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        latencies, elapsed = asyncio.run(replay(requests, args.target, api_url, args.token, hosts, args.concurrency))
+
+    server.shutdown()
+    report(latencies, elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Scaling benchmark of the proxy workers sharing the enrichment cache.
+
+Runs 1, 2, 4... mitmdump workers with the addon as regular (not transparent) proxies on consecutive ports,
+the same way setup.sh runs them on Linux, with the enrichment cache shared through a SQLite database.
+A synthetic CI job trace (see replay.py) is sent through them by several client processes,
+every client connection goes to one of the workers like the iptables rules spread them.
+The monitored hosts and the GitHub API lookups are served by a local stand-in running in its own process.
+The throughput of every number of workers is reported together with the number of the API lookups made.
+
+Usage:
+    python scale_bench.py [--workers 1,2,4] [--requests N] [--clients N] [--latency MS] [--mitmdump PATH]
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from replay import REPOSITORY, REPOSITORY_ID, TOKEN, StandInHandler, synthetic_trace  # noqa: E402
+from stream_bench import free_port  # noqa: E402
+
+
+class CountingHandler(StandInHandler):
+    # counts the enrichment lookups and accepts the writes of the trace
+    lookups = None
+
+    def do_GET(self):
+        if self.headers.get('X-GitHub-Api-Version'):
+            with self.lookups.get_lock():
+                self.lookups.value += 1
+        super().do_GET()
+
+    def do_POST(self):
+        if self.path.endswith('/graphql'):
+            with self.lookups.get_lock():
+                self.lookups.value += 1
+            super().do_POST()
+        else:
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.respond(201, {})
+
+
+def serve(port, latency, lookups):
+    CountingHandler.latency = latency
+    CountingHandler.lookups = lookups
+    ThreadingHTTPServer(('127.0.0.1', port), CountingHandler).serve_forever()
+
+
+def local_trace(count, port):
+    # the monitored hosts are served by the stand-in as 127.0.0.1, the rest of the traffic as localhost
+    for method, url, headers in synthetic_trace(count):
+        parts = urlsplit(url)
+        host = '127.0.0.1' if parts.hostname in ('api.github.com', 'github.com') else 'localhost'
+        yield method, 'http://%s:%d%s%s' % (host, port, parts.path, '?' + parts.query if parts.query else ''), headers
+
+
+def run_client(proxy_port, requests):
+    with httpx.Client(proxy='http://127.0.0.1:%d' % proxy_port, timeout=60) as client:
+        for method, url, headers in requests:
+            client.request(method, url, headers=headers)
+    return len(requests)
+
+
+def start_workers(mitmdump, count, directory, upstream_port, ports):
+    plugin = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mitm_plugin.py')
+    processes = []
+    for worker, port in enumerate(ports[:count]):
+        # every worker writes its state to its own directory, the same way setup.sh starts them
+        worker_dir = os.path.join(directory, 'worker-%d' % worker)
+        os.makedirs(worker_dir)
+        processes.append(subprocess.Popen([
+            mitmdump, '-q', '--listen-port', str(port), '-s', plugin,
+            '--set', 'summary=%s' % os.path.join(worker_dir, 'summary.json'),
+            '--set', 'token=%s' % TOKEN,
+            '--set', 'hosts=127.0.0.1:%d' % upstream_port,
+            '--set', 'GITHUB_REPOSITORY=%s' % REPOSITORY,
+            '--set', 'GITHUB_REPOSITORY_ID=%s' % REPOSITORY_ID,
+            '--set', 'GITHUB_API_URL=http://127.0.0.1:%d' % upstream_port,
+            '--set', 'cache=%s' % os.path.join(directory, 'cache.json'),
+            '--set', 'shared_cache=%s' % os.path.join(directory, 'cache.db'),
+            '--set', 'ready=%s' % os.path.join(worker_dir, 'ready'),
+        ], cwd=worker_dir, stdout=subprocess.DEVNULL))
+
+    deadline = time.monotonic() + 30
+    for worker in range(count):
+        while not os.path.exists(os.path.join(directory, 'worker-%d' % worker, 'ready')):
+            if time.monotonic() > deadline:
+                raise TimeoutError('the workers did not get ready in time')
+            time.sleep(0.1)
+    return processes
+
+
+def bench(mitmdump, workers, requests, clients, upstream_port, lookups):
+    ports = [free_port() for _ in range(workers)]
+    with tempfile.TemporaryDirectory() as directory:
+        processes = start_workers(mitmdump, workers, directory, upstream_port, ports)
+        try:
+            lookups.value = 0
+            # the client i connects to the worker i % workers, every client replays its share of the trace
+            shares = [(ports[i % workers], requests[i::clients]) for i in range(clients)]
+            with multiprocessing.Pool(clients) as pool:
+                started = time.perf_counter()
+                count = sum(pool.starmap(run_client, shares))
+                elapsed = time.perf_counter() - started
+            return count / elapsed, lookups.value
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the throughput of the proxy workers sharing the enrichment cache.')
+    parser.add_argument('--workers', default='1,2,4', help='comma delimited numbers of the workers to benchmark')
+    parser.add_argument('--requests', type=int, default=20000, help='size of the synthetic trace')
+    parser.add_argument('--clients', type=int, default=16, help='number of the client processes sending the trace')
+    parser.add_argument('--latency', type=float, default=0, help='stand-in GitHub API latency in milliseconds')
+    parser.add_argument('--mitmdump', default=shutil.which('mitmdump') or os.path.join(os.path.dirname(sys.executable), 'mitmdump'))
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    lookups = multiprocessing.Value('i', 0)
+    server = multiprocessing.Process(target=serve, args=(upstream_port, args.latency / 1000, lookups), daemon=True)
+    server.start()
+    requests = list(local_trace(args.requests, upstream_port))
+
+    print('cores: %d' % os.cpu_count())
+    print('%-8s %14s %10s %14s' % ('workers', 'requests/s', 'speedup', 'API lookups'))
+    baseline = None
+    for workers in [int(count) for count in args.workers.split(',')]:
+        throughput, count = bench(args.mitmdump, workers, requests, args.clients, upstream_port, lookups)
+        baseline = baseline or throughput
+        print('%-8d %14.0f %9.2fx %14d' % (workers, throughput, throughput / baseline, count))
+
+    server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,59 @@ for arg in "${args[@]}"; do
 done
 filter+=')(:\d+)?|$'
 
+# wait for the proxy addon to signal it is ready to intercept the requests
+wait_for_ready() {
+  counter=0
+  while [ ! -f "$1" ]
+  do
+    sleep 0.1
+    counter=$((counter+1))
+    if [ $counter -gt 300 ]; then
+      echo "mitmdump didn't get ready in time"
+      exit 1
+    fi
+  done
+  echo "mitmdump is ready, pid is $(cat "$1")"
+}
+
+# the per-job options, a persistent proxy gets them from every job over the control socket instead
+session_args() {
+  if [ -n "$PERMISSIONS_DAEMON_SOCKET" ]; then
+    echo "--set control='$PERMISSIONS_DAEMON_SOCKET'"
+  else
+    echo "--set summary='$1/summary.json' \
+          --set token='$INPUT_TOKEN' \
+          --set ACTIONS_ID_TOKEN_REQUEST_URL='$ACTIONS_ID_TOKEN_REQUEST_URL' \
+          --set ACTIONS_ID_TOKEN_REQUEST_TOKEN='$ACTIONS_ID_TOKEN_REQUEST_TOKEN' \
+          --set GITHUB_REPOSITORY_ID='$GITHUB_REPOSITORY_ID' \
+          --set GITHUB_REPOSITORY='$GITHUB_REPOSITORY'"
+  fi
+}
+
+# the jobs run as the runner user, let them connect to the control socket of a persistent proxy
+grant_control_access() {
+  if [ -n "$PERMISSIONS_DAEMON_SOCKET" ]; then
+    sudo chgrp "$(id -gn)" "$PERMISSIONS_DAEMON_SOCKET"
+  fi
+}
+
+# Install the precompiled permission index shipped with the action, it is built from pinned inputs before a release.
+# It is optional, the plugin compiles its hand written routes if the index is missing or was built from other routes.
+install_permission_index() {
+  # the descriptions of GitHub Enterprise Server differ, it uses the hand written routes only
+  if [ "$GITHUB_API_URL" != "https://api.github.com" ] || [ ! -f permissions.index ]; then
+    return
+  fi
+  sudo cp permissions.index "$1/permissions.index"
+}
+
+# the directory of the control socket must be writable by mitmproxyuser, an existing one is left as is
+create_control_directory() {
+  if [ -n "$PERMISSIONS_DAEMON_SOCKET" ] && [ ! -d "$(dirname "$PERMISSIONS_DAEMON_SOCKET")" ]; then
+    sudo install -d -o mitmproxyuser -m 755 "$(dirname "$PERMISSIONS_DAEMON_SOCKET")"
+  fi
+}
+
 if [ "$RUNNER_OS" = "macOS" ]; then
 
   echo "runner ALL=(ALL) NOPASSWD: ALL" | sudo tee -a /etc/sudoers
@@ -23,30 +76,28 @@ if [ "$RUNNER_OS" = "macOS" ]; then
 
   sudo -u mitmproxyuser -H bash -e -c 'cd /Users/mitmproxyuser && \
                                        python -m venv venv && \
-                                       venv/bin/pip install mitmproxy==11.1.3 requests==2.32.3'
+                                       venv/bin/pip install mitmproxy==11.1.3 httpx==0.28.1'
 
   # install requests for mitm plugin
   sudo cp mitm_plugin.py /Users/mitmproxyuser/mitm_plugin.py
 
-  # start mitmdump in simple mode for now to generate CA certificate
-  sudo -u mitmproxyuser -H bash -e -c "cd /Users/mitmproxyuser && \
-                                       /Users/mitmproxyuser/venv/bin/mitmdump &"
+  # the raw per-request log is written in debug mode only, the post step reads the summary
+  output=''
+  if [ -n "$RUNNER_DEBUG" ]; then
+    output='/Users/mitmproxyuser/out.txt'
+  fi
 
-  # wait for mitmdump to start and generate CA certificate
-  counter=0
-  while [ ! -f /Users/mitmproxyuser/.mitmproxy/mitmproxy-ca-cert.pem ]
-  do
-    echo "waiting for mitmdump to generate the certificate..."
-    sleep 1
-    counter=$((counter+1))
-    if [ $counter -gt 10 ]; then
-      exit 1
-    fi
-  done
+  install_permission_index /Users/mitmproxyuser
 
-  # kill mitmdump, we'll start it again in transparent mode
-  pid=$(sudo lsof -i -P -n 2>/dev/null | sed -En "s/Python *([0-9]*) *mitmproxyuser *.*TCP \*:8080 \(LISTEN\)/\1/p" | head -1)
-  sudo kill $pid
+  # restore the enrichment cache from the previous runs
+  if [ -n "$PERMISSIONS_CACHE" ] && [ -f "$PERMISSIONS_CACHE" ]; then
+    sudo cp "$PERMISSIONS_CACHE" /Users/mitmproxyuser/cache.json
+    sudo chown mitmproxyuser /Users/mitmproxyuser/cache.json
+  fi
+
+  # generate the CA certificate, the same way mitmdump does on its first start
+  sudo -u mitmproxyuser -H bash -e -c "cd /Users/mitmproxyuser && \
+                                       venv/bin/python -c 'from mitmproxy.certs import CertStore; CertStore.from_store(\".mitmproxy\", \"mitmproxy\", 2048)'"
 
   # install mitmproxy certificate as CA
   # disable any GUI prompts for certificate installation
@@ -76,6 +127,8 @@ if [ "$RUNNER_OS" = "macOS" ]; then
   # Configure sudoers to allow mitmproxy to access pfctl.
   echo "ALL ALL=NOPASSWD: /sbin/pfctl -s state" | sudo tee -a /etc/sudoers
 
+  create_control_directory
+
   # finally, start mitmdump in transparent mode
   sudo -u mitmproxyuser -H bash -e -c "cd /Users/mitmproxyuser && /Users/mitmproxyuser/venv/bin/mitmdump \
           --mode transparent \
@@ -85,31 +138,20 @@ if [ "$RUNNER_OS" = "macOS" ]; then
           `#--set termlog_verbosity=debug` \
           `#--set proxy_debug=true` \
           -s /Users/mitmproxyuser/mitm_plugin.py \
-          --set output='/Users/mitmproxyuser/out.txt' \
-          --set token='$INPUT_TOKEN' \
+          --set output='$output' \
+          $(session_args /Users/mitmproxyuser) \
           --set hosts=$@ \
           --set debug='$RUNNER_DEBUG' \
-          --set ACTIONS_ID_TOKEN_REQUEST_URL='$ACTIONS_ID_TOKEN_REQUEST_URL' \
-          --set ACTIONS_ID_TOKEN_REQUEST_TOKEN='$ACTIONS_ID_TOKEN_REQUEST_TOKEN' \
-          --set GITHUB_REPOSITORY_ID='$GITHUB_REPOSITORY_ID' \
-          --set GITHUB_REPOSITORY='$GITHUB_REPOSITORY' \
           --set GITHUB_API_URL='$GITHUB_API_URL' \
+          --set cache='/Users/mitmproxyuser/cache.json' \
+          --set metrics='/Users/mitmproxyuser/metrics.json' \
+          --set defer_lookups='${PERMISSIONS_DEFER_LOOKUPS:-false}' \
+          --set ready='/Users/mitmproxyuser/ready' \
           &"
           # >>/Users/mitmproxyuser/out.txt 2>&1
 
-  # wait for mitmdump to start
-  counter=0
-  while [ ! $(sudo lsof -i -P -n 2>/dev/null | sed -En "s/Python *([0-9]*) *mitmproxyuser *.*TCP \*:8080 \(LISTEN\)/\1/p" | head -1) ]
-  do
-    echo "waiting for mitmdump to start..."
-    sleep 1
-    counter=$((counter+1))
-    if [ $counter -gt 10 ]; then
-      exit 1
-    fi
-  done
-
-  echo "pid is $(sudo lsof -i -P -n 2>/dev/null | sed -En "s/Python *([0-9]*) *mitmproxyuser *.*/\1/p" | head -1)"
+  wait_for_ready /Users/mitmproxyuser/ready
+  grant_control_access
 
 elif [ "$RUNNER_OS" = "Linux" ]; then
 
@@ -134,42 +176,79 @@ elif [ "$RUNNER_OS" = "Linux" ]; then
   # install mitmproxy
   sudo -u mitmproxyuser -H bash -e -c 'cd ~ && \
                                        "$(command -v python3.12 || command -v python3)" -m venv venv && \
-                                       venv/bin/pip install mitmproxy==11.1.3 requests==2.32.3'
+                                       venv/bin/pip install mitmproxy==11.1.3 httpx==0.28.1'
 
   sudo cp mitm_plugin.py /home/mitmproxyuser/mitm_plugin.py
+
+  install_permission_index /home/mitmproxyuser
+
+  # restore the enrichment cache from the previous runs
+  if [ -n "$PERMISSIONS_CACHE" ] && [ -f "$PERMISSIONS_CACHE" ]; then
+    sudo cp "$PERMISSIONS_CACHE" /home/mitmproxyuser/cache.json
+    sudo chown mitmproxyuser /home/mitmproxyuser/cache.json
+  fi
+
+  create_control_directory
+
+  # Several workers listen on the consecutive ports and the connections are spread over them,
+  # each worker keeps its output in its own directory and they share the enrichment cache.
+  # A persistent proxy keeps the sessions in its memory, so it runs a single worker.
+  workers=${PERMISSIONS_WORKERS:-1}
+  shared_cache=''
+  if [ -n "$PERMISSIONS_DAEMON_SOCKET" ]; then
+    workers=1
+  elif [ "$workers" -gt 1 ]; then
+    shared_cache='/home/mitmproxyuser/cache.db'
+  fi
+
+  # generate the CA certificate the workers share, the same way mitmdump does on its first start
   sudo -u mitmproxyuser -H bash -e -c "cd /home/mitmproxyuser && \
-      /home/mitmproxyuser/venv/bin/mitmdump \
-          --mode transparent \
-          --showhost \
-          --allow-hosts '$filter' \
-          -q \
-          `#--set termlog_verbosity=debug` \
-          `#--set proxy_debug=true` \
-          -s /home/mitmproxyuser/mitm_plugin.py \
-          --set output='/home/mitmproxyuser/out.txt' \
-          --set token='$INPUT_TOKEN' \
-          --set hosts=$@ \
-          --set debug='$RUNNER_DEBUG' \
-          --set ACTIONS_ID_TOKEN_REQUEST_URL='$ACTIONS_ID_TOKEN_REQUEST_URL' \
-          --set ACTIONS_ID_TOKEN_REQUEST_TOKEN='$ACTIONS_ID_TOKEN_REQUEST_TOKEN' \
-          --set GITHUB_REPOSITORY_ID='$GITHUB_REPOSITORY_ID' \
-          --set GITHUB_REPOSITORY='$GITHUB_REPOSITORY' \
-          --set GITHUB_API_URL='$GITHUB_API_URL' \
-          &"
-          # >>/home/mitmproxyuser/out.txt 2>&1
+                                       venv/bin/python -c 'from mitmproxy.certs import CertStore; CertStore.from_store(\".mitmproxy\", \"mitmproxy\", 2048)'"
 
-  # wait for mitmdump to start and generate CA certificate
-  counter=0
-  while [ ! -f /home/mitmproxyuser/.mitmproxy/mitmproxy-ca-cert.pem ]
-  do
-    echo "waiting for mitmdump to generate the certificate..."
-    sleep 1
-    counter=$((counter+1))
-    if [ $counter -gt 10 ]; then
-      exit 1
+  worker_dirs=()
+  for ((worker = 0; worker < workers; worker++)); do
+    worker_dir=/home/mitmproxyuser
+    if [ "$workers" -gt 1 ]; then
+      worker_dir=/home/mitmproxyuser/worker-$worker
+      sudo -u mitmproxyuser mkdir -p $worker_dir
+    fi
+    worker_dirs+=($worker_dir)
+
+    # the raw per-request log is written in debug mode only, the post step reads the summary
+    output=''
+    if [ -n "$RUNNER_DEBUG" ]; then
+      output="$worker_dir/out.txt"
     fi
+
+    sudo -u mitmproxyuser -H bash -e -c "cd $worker_dir && \
+        /home/mitmproxyuser/venv/bin/mitmdump \
+            --mode transparent \
+            --listen-port $((8080 + worker)) \
+            --showhost \
+            --allow-hosts '$filter' \
+            -q \
+            `#--set termlog_verbosity=debug` \
+            `#--set proxy_debug=true` \
+            -s /home/mitmproxyuser/mitm_plugin.py \
+            --set output='$output' \
+            $(session_args $worker_dir) \
+            --set hosts=$@ \
+            --set debug='$RUNNER_DEBUG' \
+            --set GITHUB_API_URL='$GITHUB_API_URL' \
+            --set cache='/home/mitmproxyuser/cache.json' \
+            --set shared_cache='$shared_cache' \
+            --set metrics='$worker_dir/metrics.json' \
+            --set defer_lookups='${PERMISSIONS_DEFER_LOOKUPS:-false}' \
+            --set ready='$worker_dir/ready' \
+            &"
+            # >>$worker_dir/out.txt 2>&1
   done
 
+  for worker_dir in "${worker_dirs[@]}"; do
+    wait_for_ready $worker_dir/ready
+  done
+  grant_control_access
+
   # install mitmproxy certificate as CA
   sudo mkdir /usr/local/share/ca-certificates/extra
   sudo openssl x509 -in /home/mitmproxyuser/.mitmproxy/mitmproxy-ca-cert.pem -inform PEM -out ~/mitmproxy-ca-cert.crt
@@ -191,10 +270,18 @@ elif [ "$RUNNER_OS" = "Linux" ]; then
   sudo sysctl -w net.ipv4.ip_forward=1
   sudo sysctl -w net.ipv6.conf.all.forwarding=1
   sudo sysctl -w net.ipv4.conf.all.send_redirects=0
-  sudo iptables -t nat -A OUTPUT -p tcp -m owner ! --uid-owner mitmproxyuser --dport 80 -j REDIRECT --to-port 8080
-  sudo iptables -t nat -A OUTPUT -p tcp -m owner ! --uid-owner mitmproxyuser --dport 443 -j REDIRECT --to-port 8080
-  sudo ip6tables -t nat -A OUTPUT -p tcp -m owner ! --uid-owner mitmproxyuser --dport 80 -j REDIRECT --to-port 8080
-  sudo ip6tables -t nat -A OUTPUT -p tcp -m owner ! --uid-owner mitmproxyuser --dport 443 -j REDIRECT --to-port 8080
+  # The nat rules apply to the first packet of a connection only, so the connections are spread over the workers:
+  # the rule of the worker n matches every (workers - n)th of the connections the rules before it didn't match.
+  for ((worker = 0; worker < workers; worker++)); do
+    balance=''
+    if [ $((workers - worker)) -gt 1 ]; then
+      balance="-m statistic --mode nth --every $((workers - worker)) --packet 0"
+    fi
+    for port in 80 443; do
+      sudo iptables -t nat -A OUTPUT -p tcp -m owner ! --uid-owner mitmproxyuser --dport $port $balance -j REDIRECT --to-port $((8080 + worker))
+      sudo ip6tables -t nat -A OUTPUT -p tcp -m owner ! --uid-owner mitmproxyuser --dport $port $balance -j REDIRECT --to-port $((8080 + worker))
+    done
+  done
 
 elif [ "$RUNNER_OS" = "Windows" ]; then
 
@@ -207,5 +294,3 @@ else
   exit 1
 
 fi
-
-echo "--all done--"
@@ -0,0 +1,172 @@
+"""
+Memory and throughput benchmark of the proxy addon on a large clone workload.
+
+Runs mitmdump with the addon as a regular (not transparent) proxy in front of a local stand-in
+for a git server and sends the traffic of a large clone, a large push and a release download through it:
+    POST /{owner}/{repo}/git-upload-pack      a small request with a --size MB packfile in the response
+    POST /{owner}/{repo}/git-receive-pack     a --size MB packfile in the request
+    GET  /{owner}/{repo}/releases/download/   a --size MB asset
+Every workload runs with the body streaming on and off (stream_bodies option) and the throughput
+and the peak resident memory of mitmdump are reported. The peak memory is read from /proc, so Linux only.
+
+Usage:
+    python stream_bench.py [--size MB] [--mitmdump PATH]
+"""
+import argparse
+import base64
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import httpx
+
+
+REPOSITORY = 'octo-org/octo-repo'
+TOKEN = 'ghs_bench'
+CHUNK = b'\0' * (1 << 20)
+
+
+class GitServerHandler(BaseHTTPRequestHandler):
+    # sends and receives the packfiles and assets of the given size without keeping them in memory
+    protocol_version = 'HTTP/1.1'
+    size = 0
+
+    def send_body(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(self.size))
+        self.end_headers()
+        sent = 0
+        while sent < self.size:
+            chunk = CHUNK[:self.size - sent]
+            self.wfile.write(chunk)
+            sent += len(chunk)
+
+    def read_body(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            remaining -= len(self.rfile.read(min(remaining, len(CHUNK))))
+
+    def do_GET(self):
+        self.send_body()
+
+    def do_POST(self):
+        self.read_body()
+        if self.path.endswith('/git-upload-pack'):
+            self.send_body()
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError('mitmdump did not start listening on %d' % port)
+
+
+def peak_rss(pid):
+    # the peak resident set size in MB
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+def upload(size):
+    sent = 0
+    while sent < size:
+        chunk = CHUNK[:size - sent]
+        yield chunk
+        sent += len(chunk)
+
+
+def run_workload(name, proxy_port, server_port, size):
+    url = 'http://localhost:%d/%s' % (server_port, REPOSITORY)
+    # git sends the token with the basic authentication
+    headers = {'Authorization': 'Basic %s' % base64.b64encode(('x-access-token:%s' % TOKEN).encode()).decode()}
+    with httpx.Client(proxy='http://127.0.0.1:%d' % proxy_port, timeout=300) as client:
+        started = time.perf_counter()
+        if name == 'clone':
+            request = client.build_request('POST', url + '/git-upload-pack', headers=headers, content=b'0032want')
+        elif name == 'push':
+            request = client.build_request('POST', url + '/git-receive-pack', headers={**headers, 'Content-Length': str(size)}, content=upload(size))
+        else:
+            request = client.build_request('GET', url + '/releases/download/v1.0/asset.tar.gz', headers=headers)
+        response = client.send(request, stream=True)
+        for _ in response.iter_bytes(len(CHUNK)):
+            pass
+        response.close()
+        return time.perf_counter() - started
+
+
+def bench(mitmdump, workload, stream, server_port, size):
+    proxy_port = free_port()
+    plugin = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mitm_plugin.py')
+    # the addon writes its state to the current directory
+    with tempfile.TemporaryDirectory() as directory:
+        process = subprocess.Popen([
+            mitmdump, '-q', '--listen-port', str(proxy_port), '-s', plugin,
+            '--set', 'summary=%s' % os.path.join(directory, 'summary.json'),
+            '--set', 'token=%s' % TOKEN,
+            '--set', 'hosts=localhost',
+            '--set', 'GITHUB_REPOSITORY=%s' % REPOSITORY,
+            '--set', 'GITHUB_REPOSITORY_ID=42',
+            '--set', 'GITHUB_API_URL=http://localhost:%d' % server_port,
+            '--set', 'stream_bodies=%s' % ('true' if stream else 'false'),
+        ], cwd=directory)
+        try:
+            wait_for_port(proxy_port)
+            baseline = peak_rss(process.pid)
+            elapsed = run_workload(workload, proxy_port, server_port, size)
+            return elapsed, baseline, peak_rss(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the memory and throughput of the proxy on large transfers.')
+    parser.add_argument('--size', type=int, default=512, help='size of the transferred packfiles and assets in MB')
+    parser.add_argument('--mitmdump', default=shutil.which('mitmdump') or os.path.join(os.path.dirname(sys.executable), 'mitmdump'))
+    args = parser.parse_args()
+
+    size = args.size << 20
+    GitServerHandler.size = size
+    server = ThreadingHTTPServer(('127.0.0.1', 0), GitServerHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    print('%-8s %-10s %12s %14s %14s' % ('workload', 'streaming', 'MB/s', 'startup MB', 'peak MB'))
+    for workload in ('clone', 'push', 'download'):
+        for stream in (True, False):
+            elapsed, baseline, peak = bench(args.mitmdump, workload, stream, server.server_address[1], size)
+            print('%-8s %-10s %12.1f %14.1f %14.1f' % (workload, 'on' if stream else 'off', args.size / elapsed, baseline, peak))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
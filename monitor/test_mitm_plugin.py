@@ -0,0 +1,701 @@
+"""
+Tests of the proxy addon, run in process with the mitmproxy test helpers and without any network.
+
+Usage:
+    pip install mitmproxy httpx
+    python -m unittest monitor/test_mitm_plugin.py
+"""
+import asyncio
+import email.utils
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import httpx
+from mitmproxy import http
+from mitmproxy.test import taddons
+from mitmproxy.test import tflow
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mitm_plugin  # noqa: E402
+
+
+REPOSITORY = 'octo-org/octo-repo'
+TOKEN = 'ghs_test'
+ADDRESS = '140.82.112.6'
+
+
+def make_flow(method, url, headers, http_version='HTTP/1.1'):
+    flow = tflow.tflow()
+    flow.request = http.Request.make(method, url)
+    flow.request.http_version = http_version
+    # set after the URL, which would replace the Host header with the address
+    flow.request.headers.update(headers)
+    return flow
+
+
+class AddonTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # the addon writes its state to the current directory
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        self.addon = mitm_plugin.GHActionsProxy()
+        self.context = taddons.context(self.addon)
+        self.tctx = self.context.__enter__()
+        self.tctx.configure(
+            self.addon,
+            summary='summary.json',
+            token=TOKEN,
+            hosts='api.github.com,github.com',
+            GITHUB_REPOSITORY=REPOSITORY,
+            GITHUB_REPOSITORY_ID='42',
+            GITHUB_API_URL='https://api.github.com',
+        )
+
+    async def asyncTearDown(self):
+        # calls the done hook of the addon and removes the log handler of the master bound to the event loop of the test
+        await self.context.master.done()
+        self.context.__exit__(None, None, None)
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def calls(self):
+        return [(call['method'], call['host'], call['path']) for call in self.addon.session.summary.to_json()['calls']]
+
+
+class InterceptTest(AddonTestCase):
+    async def test_host_header(self):
+        flow = make_flow('POST', 'https://%s/repos/%s/statuses/abc' % (ADDRESS, REPOSITORY),
+                         {'Host': 'api.github.com', 'Authorization': 'Bearer %s' % TOKEN})
+        self.assertTrue(await self.addon.intercept(flow))
+        self.assertEqual(self.addon.session.summary.permissions, {'statuses': 'write'})
+
+    async def test_http2_without_host_header(self):
+        # the HTTP/2 clients send the :authority pseudo header only, the transparent proxy sees the destination address
+        flow = make_flow('POST', 'https://%s/repos/%s/statuses/abc' % (ADDRESS, REPOSITORY),
+                         {'Authorization': 'Bearer %s' % TOKEN}, 'HTTP/2.0')
+        flow.request.authority = 'api.github.com'
+        self.assertTrue(await self.addon.intercept(flow))
+        self.assertEqual(self.addon.session.summary.permissions, {'statuses': 'write'})
+        self.assertEqual(self.calls(), [('POST', 'api.github.com', '/repos/{owner}/{repo}/statuses/**')])
+
+    async def test_address_only(self):
+        # no Host header at all, the address is mapped back to the monitored host
+        self.addon.resolver.ip_map[ADDRESS] = 'api.github.com'
+        flow = make_flow('POST', 'https://%s/repos/%s/statuses/abc' % (ADDRESS, REPOSITORY),
+                         {'Authorization': 'Bearer %s' % TOKEN})
+        self.assertTrue(await self.addon.intercept(flow))
+        self.assertEqual(self.calls(), [('POST', 'api.github.com', '/repos/{owner}/{repo}/statuses/**')])
+
+    async def test_other_host(self):
+        flow = make_flow('GET', 'https://registry.npmjs.org/package',
+                         {'Host': 'registry.npmjs.org', 'Authorization': 'Bearer %s' % TOKEN})
+        self.assertFalse(await self.addon.intercept(flow))
+        self.assertEqual(self.calls(), [])
+
+
+class OutputTest(AddonTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.tctx.configure(self.addon, output='out.txt')
+
+    def records(self):
+        # the raw log the post step prints in debug mode, one JSON object per line
+        self.addon.output.flush()
+        with open('out.txt') as f:
+            return [json.loads(line) for line in f]
+
+    async def test_records(self):
+        for path in ('/repos/%s/labels' % REPOSITORY, '/repos/%s/contents/a%%22b%%5Cc' % REPOSITORY, '/repos/%s/contents/"b\\c' % REPOSITORY):
+            flow = make_flow('GET', 'https://api.github.com' + path, {'Authorization': 'Bearer %s' % TOKEN})
+            self.assertTrue(await self.addon.intercept(flow))
+        records = self.records()
+        self.assertEqual([record['path'] for record in records],
+                         ['/repos/%s/labels' % REPOSITORY, '/repos/%s/contents/a%%22b%%5Cc' % REPOSITORY, '/repos/%s/contents/"b\\c' % REPOSITORY])
+        self.assertEqual(records[0], {'method': 'GET', 'host': 'api.github.com', 'path': '/repos/%s/labels' % REPOSITORY,
+                                      'permissions': [{'issues': 'read'}]})
+
+    def test_batched(self):
+        writer = mitm_plugin.BufferedWriter('batched.txt', max_lines=2, interval=3600)
+        writer.write('{"n": 1}\n')
+        self.assertEqual(os.path.getsize('batched.txt'), 0)
+        writer.write('{"n": 2}\n')
+        writer.write('{"n": 3}\n')
+        writer.close()
+        with open('batched.txt') as f:
+            self.assertEqual([json.loads(line) for line in f], [{'n': 1}, {'n': 2}, {'n': 3}])
+
+
+class HostResolverTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.resolver = mitm_plugin.HostResolver(min_interval=5, negative_ttl=300)
+        self.resolver.configure(['api.github.com'])
+        self.addresses = {'api.github.com': {'140.82.112.5'}}
+        self.lookups = 0
+        self.resolver.lookup = self.lookup
+
+    async def lookup(self, host):
+        self.lookups += 1
+        await asyncio.sleep(0.01)
+        return self.addresses[host]
+
+    async def test_new_address(self):
+        # the load balancer returns another address, the unknown address refreshes the known ones
+        await self.resolver.refresh()
+        self.assertEqual(await self.resolver.resolve('140.82.112.5'), 'api.github.com')
+        self.addresses['api.github.com'] = {'140.82.112.6'}
+        self.resolver.refreshed -= 5
+        self.assertEqual(await self.resolver.resolve('140.82.112.6'), 'api.github.com')
+        self.assertEqual(self.lookups, 2)
+        self.assertEqual(self.resolver.ip_map, {'140.82.112.5': 'api.github.com', '140.82.112.6': 'api.github.com'})
+
+    async def test_unrelated_address(self):
+        self.assertEqual(await asyncio.gather(self.resolver.resolve('10.0.0.1'), self.resolver.resolve('10.0.0.2')), [None, None])
+        self.assertEqual(self.lookups, 1)
+        # the unrelated addresses are remembered, they don't refresh again even after min_interval
+        self.resolver.refreshed -= 5
+        self.assertIsNone(await self.resolver.resolve('10.0.0.1'))
+        self.assertEqual((self.lookups, self.resolver.negative_hits), (1, 1))
+
+        # until they expire, then the refresh is rate limited only
+        self.resolver.negative['10.0.0.1'] -= 300
+        self.assertIsNone(await self.resolver.resolve('10.0.0.1'))
+        self.assertEqual(self.lookups, 2)
+
+    async def test_rate_limited(self):
+        await self.resolver.refresh()
+        self.assertIsNone(await self.resolver.resolve('10.0.0.1'))
+        self.assertEqual(self.lookups, 1)
+
+    async def test_failed_lookup(self):
+        # the addresses known so far are kept
+        await self.resolver.refresh()
+        del self.addresses['api.github.com']
+        await self.resolver.refresh()
+        self.assertEqual(await self.resolver.resolve('140.82.112.5'), 'api.github.com')
+
+
+class RouteTest(AddonTestCase):
+    async def permissions(self, method, path):
+        # a private repository, the reads of the public ones don't require the permission
+        self.addon.cache.set('visibility:%s' % REPOSITORY, False)
+        return await self.addon.get_permission('/repos/%s%s' % (REPOSITORY, path), method, {})
+
+    async def test_head(self):
+        self.assertEqual(await self.permissions('HEAD', '/releases/assets/1'), [('contents', 'read')])
+        self.assertEqual(await self.permissions('HEAD', '/milestones/1'), await self.permissions('GET', '/milestones/1'))
+
+    async def test_literal_before_placeholder(self):
+        # there is no PATCH /issues/comments, it must not match PATCH /issues/{issue_number}
+        self.assertEqual(await self.permissions('PATCH', '/issues/comments'), [('unknown', 'unknown')])
+        self.assertEqual(await self.permissions('GET', '/issues/comments'), [('issues', 'read'), ('pull-requests', 'read')])
+
+    async def test_prefix(self):
+        self.assertEqual(await self.permissions('GET', '/releases/assets/1/extra'), [('contents', 'read')])
+        self.assertEqual(await self.permissions('POST', '/releases'), [('contents', 'write')])
+
+
+class GraphQLTest(AddonTestCase):
+    async def permissions(self, query, variables=None):
+        body = json.dumps({'query': query, 'variables': variables or {}})
+        return sorted(await self.addon.get_graphql_permission(body))
+
+    async def test_repository_of_owner(self):
+        query = 'query($login: String!) { organization(login: $login) { name repository(name: "octo-repo") { issues(first: 1) { totalCount } } } }'
+        self.assertEqual(await self.permissions(query, {'login': 'octo-org'}), [('issues', 'read')])
+
+    async def test_repository_of_other_owner(self):
+        query = '{ user(login: "someone") { repository(name: "octo-repo") { issues(first: 1) { totalCount } } } }'
+        self.assertEqual(await self.permissions(query), [])
+
+    async def test_repositories_of_owner(self):
+        query = """
+            { repositoryOwner(login: "octo-org") { ... on Organization { repositories(first: 10) {
+                nodes { name pullRequests(first: 1) { totalCount } }
+                edges { node { discussions(first: 1) { totalCount } } }
+            } } } }"""
+        self.assertEqual(await self.permissions(query), [('discussions', 'read'), ('pull-requests', 'read')])
+
+    async def test_owner_only(self):
+        self.assertEqual(await self.permissions('{ viewer { login } organization(login: "octo-org") { name } }'), [])
+
+    async def test_nested_too_deep(self):
+        query = '{ viewer ' + '{ a ' * 5000 + '}' * 5001
+        self.assertEqual(await self.permissions(query), [('unknown', 'unknown')])
+        value = '{ repository(owner: "octo-org", name: "octo-repo", x: ' + '[' * 5000 + ']' * 5000 + ') { issues { totalCount } } }'
+        self.assertEqual(await self.permissions(value), [('unknown', 'unknown')])
+
+
+class GitHubClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.github = mitm_plugin.GitHubClient(mitm_plugin.Metrics())
+        self.requests = []
+        self.github.fetch = self.fetch
+
+    async def asyncTearDown(self):
+        await self.github.close()
+
+    async def fetch(self, url):
+        self.requests.append(url)
+        await asyncio.sleep(0.01)
+        return 'response %d' % len(self.requests)
+
+    async def test_coalesced(self):
+        url = 'https://api.github.com/repos/%s' % REPOSITORY
+        self.assertEqual(await asyncio.gather(self.github.get(url), self.github.get(url)), ['response 1', 'response 1'])
+        self.assertEqual(self.github.pending, {})
+
+    async def test_owner_cancelled(self):
+        # the waiter makes the request itself instead of waiting forever for the cancelled one
+        url = 'https://api.github.com/repos/%s' % REPOSITORY
+        owner = asyncio.create_task(self.github.get(url))
+        waiter = asyncio.create_task(self.github.get(url))
+        await asyncio.sleep(0)
+        owner.cancel()
+        self.assertEqual(await asyncio.wait_for(waiter, 1), 'response 2')
+        self.assertTrue(owner.cancelled())
+        self.assertEqual(self.github.pending, {})
+
+    async def test_waiter_cancelled(self):
+        url = 'https://api.github.com/repos/%s' % REPOSITORY
+        owner = asyncio.create_task(self.github.get(url))
+        waiter = asyncio.create_task(self.github.get(url))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        self.assertEqual(await owner, 'response 1')
+        self.assertTrue(waiter.cancelled())
+
+
+class RateLimiterTest(unittest.TestCase):
+    def response(self, status_code=200, **headers):
+        return httpx.Response(status_code, headers={name.replace('_', '-'): str(value) for name, value in headers.items()})
+
+    def test_shrinking_quota(self):
+        # the bucket follows the remaining quota down instead of being refilled to it after every response
+        limiter = mitm_plugin.RateLimiter(burst=20, reserve=100)
+        reset = int(time.time()) + 3600
+        spent = 0
+        for remaining in range(130, 100, -1):
+            limiter.update(self.response(X_RateLimit_Remaining=remaining, X_RateLimit_Reset=reset))
+            if limiter.tokens >= 1:
+                limiter.tokens -= 1
+                spent += 1
+        self.assertLessEqual(limiter.tokens, 1)
+        self.assertLess(spent, 30)
+        limiter.update(self.response(X_RateLimit_Remaining=100, X_RateLimit_Reset=reset))
+        self.assertEqual(limiter.rate, 0)
+        self.assertLessEqual(limiter.tokens, 0)
+
+    def test_retry_after(self):
+        limiter = mitm_plugin.RateLimiter()
+        limiter.update(self.response(429, Retry_After=60))
+        self.assertAlmostEqual(limiter.blocked_until - time.monotonic(), 60, delta=1)
+
+        limiter = mitm_plugin.RateLimiter()
+        limiter.update(self.response(403, Retry_After=email.utils.formatdate(time.time() + 120, usegmt=True)))
+        self.assertAlmostEqual(limiter.blocked_until - time.monotonic(), 120, delta=2)
+
+        limiter = mitm_plugin.RateLimiter()
+        limiter.update(self.response(429, Retry_After='soon'))
+        self.assertEqual(limiter.blocked_until, 0)
+
+
+class IssueTypeTest(AddonTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.requests = []
+        self.addon.session.github.query = self.query
+        self.addon.session.github.get = self.get
+        self.batch = {}
+        self.error = None
+
+    async def query(self, url, query):
+        if self.error:
+            raise self.error
+        return httpx.Response(200, json={'data': {'repository': self.batch}})
+
+    async def get(self, url):
+        self.requests.append(url)
+        return httpx.Response(404)
+
+    async def issue_type(self, number):
+        return await self.addon.get_issue_type(self.addon.session, 'issue_number', REPOSITORY, number)
+
+    async def test_batched(self):
+        self.batch = {'i0': {'__typename': 'PullRequest'}, 'i1': {'__typename': 'Issue'}}
+        self.assertEqual(await asyncio.gather(self.issue_type('1'), self.issue_type('2')), ['pull-requests', 'issues'])
+        self.assertEqual(self.requests, [])
+
+    async def test_null_alias(self):
+        # a missing issue or an error, it is looked up with the REST API and not cached as an issue right away
+        self.batch = {'i0': None}
+        self.assertEqual(await self.issue_type('1'), 'issues')
+        self.assertEqual(self.requests, ['https://api.github.com/repos/%s/pulls/1' % REPOSITORY])
+
+    async def test_failed_batch(self):
+        self.error = httpx.ConnectError('connection refused')
+        self.assertEqual(await asyncio.gather(self.issue_type('1'), self.issue_type('2')), ['issues', 'issues'])
+        self.assertEqual(sorted(self.requests), ['https://api.github.com/repos/%s/pulls/%d' % (REPOSITORY, number) for number in (1, 2)])
+        self.assertEqual(self.addon.metrics.counters['issue_batch_errors'], 1)
+
+
+class DeferredTest(AddonTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.tctx.configure(self.addon, defer_lookups=True)
+        self.addon.session.github.get = self.get
+
+    async def get(self, url):
+        self.fail('%s was looked up by the proxy' % url)
+
+    async def request(self, method, path):
+        flow = make_flow(method, 'https://api.github.com/repos/%s%s' % (REPOSITORY, path), {'Authorization': 'Bearer %s' % TOKEN})
+        self.assertTrue(await self.addon.intercept(flow))
+
+    async def test_deferred(self):
+        # the lookups are left to the post step, the summary lists them once with the count of their calls
+        await self.request('POST', '/issues/5/comments')
+        await self.request('POST', '/issues/5/comments')
+        await self.request('GET', '/issues/comments/7')
+        await self.request('GET', '/commits/abc')
+        summary = self.addon.session.summary.to_json()
+        self.assertEqual(summary['permissions'], {})
+        self.assertEqual(summary['deferred'], [
+            {'kind': 'issues/pull-requests', 'permission': 'write', 'lookup': 'issue_number', 'repo': REPOSITORY, 'number': '5', 'count': 2},
+            {'kind': 'issues/pull-requests', 'permission': 'read', 'lookup': 'comment_id', 'repo': REPOSITORY, 'number': '7', 'count': 1},
+            {'kind': 'contents', 'permission': 'read', 'lookup': 'public', 'repo': REPOSITORY, 'number': None, 'count': 1},
+        ])
+
+    async def test_cached(self):
+        # the answers cached by the previous runs resolve the lookups in the proxy
+        self.addon.cache.set('issue_number:%s:5' % REPOSITORY, 'pull-requests')
+        self.addon.cache.set('visibility:%s' % REPOSITORY, True)
+        await self.request('POST', '/issues/5/comments')
+        await self.request('GET', '/commits/abc')
+        summary = self.addon.session.summary.to_json()
+        self.assertEqual(summary['permissions'], {'pull-requests': 'write'})
+        self.assertEqual(summary['deferred'], [])
+
+
+class SummaryTest(AddonTestCase):
+    async def request(self, method, path):
+        flow = make_flow(method, 'https://api.github.com' + path, {'Authorization': 'Bearer %s' % TOKEN})
+        self.assertTrue(await self.addon.intercept(flow))
+
+    async def test_calls_by_route(self):
+        for number in range(3):
+            await self.request('GET', '/repos/%s/milestones/%d' % (REPOSITORY, number))
+            await self.request('GET', '/repos/%s/labels/label-%d' % (REPOSITORY, number))
+        self.assertEqual(self.addon.session.summary.to_json()['calls'], [
+            {'method': 'GET', 'host': 'api.github.com', 'path': '/repos/{owner}/{repo}/milestones/{milestone_number}', 'count': 3},
+            {'method': 'GET', 'host': 'api.github.com', 'path': '/repos/{owner}/{repo}/labels/{name}', 'count': 3},
+        ])
+
+    async def test_calls_capped(self):
+        # the paths without a route don't collapse, the distinct ones beyond the cap are only counted
+        self.addon.session.summary.max_calls = 2
+        for number in range(5):
+            await self.request('GET', '/unknown-%d' % number)
+        await self.request('GET', '/unknown-0')
+        summary = self.addon.session.summary.to_json()
+        self.assertEqual([(call['path'], call['count']) for call in summary['calls']], [('/unknown-0', 2), ('/unknown-1', 1)])
+        self.assertEqual(summary['calls_overflow'], 3)
+        self.assertEqual(summary['unknown_count'], 6)
+
+
+class ReadyTest(AddonTestCase):
+    class ProxyServer:
+        # the proxyserver addon of mitmdump, it starts listening before the running hook of the scripts
+        name = 'proxyserver'
+
+        def __init__(self, addresses):
+            self.addresses = addresses
+
+        def listen_addrs(self):
+            return self.addresses
+
+    def test_ready(self):
+        self.tctx.configure(self.addon, ready='ready')
+        self.addon.signal_ready()
+        with open('ready') as f:
+            self.assertEqual(f.read(), str(os.getpid()))
+        self.assertFalse(os.path.exists('ready.tmp'))
+
+    def test_listening(self):
+        self.context.master.addons.add(self.ProxyServer([('127.0.0.1', 8080)]))
+        self.tctx.configure(self.addon, ready='ready')
+        self.addon.signal_ready()
+        self.assertTrue(os.path.exists('ready'))
+
+    def test_not_listening(self):
+        # the setup times out and the post step fails the job on the error instead of a proxy that doesn't intercept anything
+        self.context.master.addons.add(self.ProxyServer([]))
+        self.tctx.configure(self.addon, ready='ready')
+        self.addon.signal_ready()
+        self.assertFalse(os.path.exists('ready'))
+        self.addon.log.close()
+        with open('error.log') as f:
+            self.assertEqual(f.read(), 'The proxy is not listening, the ready file is not written\n')
+
+    def test_disabled(self):
+        self.addon.signal_ready()
+        self.assertEqual(os.listdir('.'), [])
+
+
+class SessionTest(AddonTestCase):
+    async def begin(self, token, **command):
+        command.update(command='begin-session', token=token, repository=REPOSITORY, repository_id=42)
+        response = await self.addon.control_command(command)
+        return response['session']
+
+    async def request(self, token):
+        flow = make_flow('GET', 'https://api.github.com/repos/%s/issues' % REPOSITORY, {'Authorization': 'Bearer %s' % token})
+        return await self.addon.intercept(flow)
+
+    async def test_idle_expired(self):
+        # the job was cancelled before its post step ended the session
+        idle = await self.begin('ghs_idle')
+        active = await self.begin('ghs_active')
+        self.addon.sessions[idle].active -= 24 * 60 * 60 + 1
+        self.addon.sessions[active].active -= 24 * 60 * 60 + 1
+        self.addon.session.active -= 24 * 60 * 60 + 1
+        self.assertTrue(await self.request('ghs_active'))
+
+        await self.addon.expire_sessions()
+        self.assertEqual(set(self.addon.sessions), {'', active})
+        self.assertFalse(await self.request('ghs_idle'))
+        self.assertEqual(await self.addon.control_command({'command': 'end-session', 'session': idle}), {'error': 'Unknown session'})
+        self.assertEqual(self.addon.metrics.counters['sessions_expired'], 1)
+
+    async def test_id_token(self):
+        # the ID token host depends on the region and the organization, it isn't among the hosts of the proxy
+        url = 'https://pipelinesghubeus6.actions.githubusercontent.com/abc/idtoken/def?api-version=2.0'
+        id = await self.begin('ghs_oidc', id_token_request_url=url, id_token_request_token='oidc_request_token')
+        flow = make_flow('GET', url + '&audience=sts.amazonaws.com', {'Authorization': 'Bearer oidc_request_token'})
+        self.assertTrue(await self.addon.intercept(flow))
+        response = await self.addon.control_command({'command': 'end-session', 'session': id})
+        self.assertEqual(response['summary']['permissions'], {'id-token': 'write'})
+
+    async def test_timeout_disabled(self):
+        idle = await self.begin('ghs_idle')
+        self.addon.sessions[idle].active -= 24 * 60 * 60 + 1
+        self.tctx.configure(self.addon, session_timeout=0)
+        await self.addon.expire_sessions()
+        self.assertIn(idle, self.addon.sessions)
+        self.assertTrue(await self.request('ghs_idle'))
+
+
+class EnrichmentCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cache.json')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def cache(self, ttl=60, max_size=100):
+        cache = mitm_plugin.EnrichmentCache()
+        cache.load(self.path, ttl, max_size)
+        return cache
+
+    def test_round_trip(self):
+        cache = self.cache()
+        cache.set('visibility/%s' % REPOSITORY, 'public')
+        cache.set('issue/%s/1' % REPOSITORY, True)
+        cache.save()
+        self.assertFalse(cache.dirty)
+
+        restored = self.cache()
+        self.assertEqual(restored.get('visibility/%s' % REPOSITORY), 'public')
+        self.assertEqual(restored.get('issue/%s/1' % REPOSITORY), True)
+        self.assertIsNone(restored.get('issue/%s/2' % REPOSITORY))
+
+    def test_expired(self):
+        cache = self.cache()
+        cache.set('fresh', 'public')
+        cache.set('stale', 'public')
+        cache.entries['stale'] = ('public', time.time() - 61)
+        self.assertEqual(cache.get('fresh'), 'public')
+        self.assertIsNone(cache.get('stale'))
+        self.assertNotIn('stale', cache.entries)
+
+        # the entries expired between the runs are dropped on load
+        cache.set('stale', 'public')
+        cache.entries['stale'] = ('public', time.time() - 61)
+        cache.save()
+        self.assertEqual(list(self.cache().entries), ['fresh'])
+
+    def test_least_recently_used(self):
+        cache = self.cache(max_size=2)
+        cache.set('first', 1)
+        cache.set('second', 2)
+        cache.get('first')
+        cache.set('third', 3)
+        cache.save()
+        self.assertEqual(list(self.cache().entries), ['first', 'third'])
+        self.assertEqual(list(self.cache(max_size=1).entries), ['third'])
+
+    def test_not_dirty(self):
+        # a cache that wasn't changed doesn't rewrite the file restored from the previous runs
+        self.cache().save()
+        self.assertFalse(os.path.exists(self.path))
+
+
+class SharedCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        database = os.path.join(self.directory.name, 'cache.db')
+        self.path = os.path.join(self.directory.name, 'cache.json')
+        self.workers = [mitm_plugin.SharedEnrichmentCache(database) for _ in range(2)]
+        for cache in self.workers:
+            cache.load(self.path, 60, 100)
+
+    async def asyncTearDown(self):
+        for cache in self.workers:
+            cache.executor.shutdown()
+            cache.connection.close()
+        self.directory.cleanup()
+
+    async def written(self, cache):
+        # the batch is submitted in the next event loop iteration and written by the thread of the cache
+        await asyncio.sleep(0)
+        await asyncio.get_running_loop().run_in_executor(cache.executor, lambda: None)
+
+    async def test_shared(self):
+        first, second = self.workers
+        first.set('visibility:octo-org/octo-repo', True)
+        first.set('issue_number:octo-org/octo-repo:1', 'issues')
+        self.assertEqual(len(first.unwritten), 2)
+        await self.written(first)
+        self.assertEqual(first.unwritten, [])
+
+        self.assertIsNone(second.get('visibility:octo-org/octo-repo'))
+        self.assertTrue(await second.fetch('visibility:octo-org/octo-repo'))
+        # kept in memory after the fetch
+        self.assertTrue(second.get('visibility:octo-org/octo-repo'))
+        self.assertIsNone(await second.fetch('visibility:octo-org/other'))
+
+    async def test_save(self):
+        first = self.workers[0]
+        first.set('visibility:octo-org/octo-repo', False)
+        # the entries not written yet are exported too
+        first.save()
+        with open(self.path) as f:
+            self.assertEqual([entry[:2] for entry in json.load(f)['entries']], [['visibility:octo-org/octo-repo', False]])
+
+
+class BackgroundLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'debug.log')
+        self.log = mitm_plugin.BackgroundLog(self.path, os.path.join(self.directory.name, 'error.log'), max_message=100)
+        # the test writes the log itself instead of the background thread
+        self.log.thread = threading.current_thread()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def lines(self):
+        with open(self.path) as f:
+            return f.read().splitlines()
+
+    def test_formatted_when_logged(self):
+        # the buffer doesn't keep the objects alive, the message shows them as they were when logged
+        data = {'html_url': 'https://github.com/octo-org/octo-repo/pull/1'}
+        self.log.debug('data: %s', (data,))
+        data.clear()
+        self.log.debug('%s %s', ('GET', 'https://api.github.com/'))
+        self.assertEqual([args for _, _, args, _ in self.log.buffer], [(), ('GET', 'https://api.github.com/')])
+        self.log.write()
+        self.assertEqual(self.lines(), ["data: {'html_url': 'https://github.com/octo-org/octo-repo/pull/1'}", 'GET https://api.github.com/'])
+
+    def test_truncated(self):
+        self.log.debug('%s', ('x' * 1000,))
+        self.log.write()
+        self.assertEqual(self.lines(), ['x' * 100 + '... (900 more characters)'])
+
+    def test_buffer_size(self):
+        self.log.configure(100, 0)
+        for i in range(20):
+            self.log.debug('message %03d', (i,))
+        self.assertLessEqual(self.log.buffered, 100)
+        self.log.write()
+        lines = self.lines()
+        self.assertEqual(lines[0], '... 12 debug messages dropped')
+        self.assertEqual(lines[1:], ['message %03d' % i for i in range(12, 20)])
+
+    def test_limit_and_dumps(self):
+        self.log.configure(1000, 100)
+        for i in range(10):
+            self.log.debug('before limit %d', (i,))
+        self.log.write()
+        self.assertTrue(self.log.limited)
+        self.assertTrue(self.lines()[-1].startswith('... the debug log reached 100 bytes'))
+        written = len(self.lines())
+
+        # only the latest messages are kept and written on an error, a burst of errors dumps them once
+        for i in range(10):
+            self.log.debug('after limit %d', (i,))
+        self.log.write()
+        self.assertEqual(len(self.lines()), written)
+        self.log.error('first error')
+        self.log.error('second error')
+        self.assertTrue(self.log.dump_requested)
+        self.log.write(dump=self.log.dump_requested)
+        self.assertFalse(self.log.dump_requested)
+        self.assertIn('after limit 0', self.lines())
+
+        # the dumps stop at the size limit too, the rest is written at the end
+        for i in range(20):
+            self.log.debug('dumped %d', (i,))
+        self.log.dump()
+        self.assertTrue(self.lines()[-1].startswith('... the dumps of the debug log reached 100 bytes'))
+        self.log.debug('last', ())
+        self.log.dump()
+        self.assertNotIn('last', self.lines())
+        self.log.close()
+        self.assertEqual(self.lines()[-1], 'last')
+        with open(os.path.join(self.directory.name, 'error.log')) as f:
+            self.assertEqual(f.read(), 'first error\nsecond error\n')
+
+
+class IndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'permissions.index')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def build(self, routes):
+        tree = mitm_plugin.compile_routes(routes, mitm_plugin.GHActionsProxy.methods_map)
+        mitm_plugin.save_index(self.path, tree, routes)
+        return tree
+
+    def test_same_routes(self):
+        tree = self.build(mitm_plugin.ROUTES)
+        self.assertEqual(mitm_plugin.load_index(self.path), tree)
+
+    def test_other_routes(self):
+        # an index built before the hand written routes were edited must not shadow them
+        routes = mitm_plugin.ROUTES[:-1] + (('GET', '/repos/{owner}/{repo}/labels', 'contents', 'read', None),)
+        self.build(routes)
+        self.assertIsNone(mitm_plugin.load_index(self.path))
+
+    def test_missing(self):
+        self.assertIsNone(mitm_plugin.load_index(self.path))
+
+    def test_shipped(self):
+        # the index shipped with the action must be rebuilt whenever the hand written routes change
+        if not os.path.exists(mitm_plugin.INDEX_PATH):
+            self.skipTest('no permission index is shipped')
+        self.assertIsNotNone(mitm_plugin.load_index(mitm_plugin.INDEX_PATH))
+
+
+if __name__ == '__main__':
+    unittest.main()